@@ -0,0 +1,392 @@
+"""Benchmarks of the set operations of the stock, Python and Cython versions.
+
+Run it with the Python of the buildout::
+
+  bin/zopepy -m experimental.btree.benchmark --json results.json
+  bin/zopepy -m experimental.btree.benchmark --compare results.json
+
+Every case is run in all versions, for the 32-bit `IIBTree` and the 64-bit
+`LLBTree` family. The dispatch cases time picking a strategy for a small
+set and a big tree set against the strategy alone. The results are checked
+against the stock version and timed with warmup and repeated runs. The
+median, percentiles and minimum of the runs are reported. Compare mode
+reads a stored result file and reports the cases which got slower than the
+threshold allows. It exits with a non-zero status if any did.
+"""
+from optparse import OptionParser
+import gc
+import platform
+import random
+import sys
+from timeit import default_timer
+
+OPERATIONS = ('intersection', 'difference', 'weightedIntersection', 'union')
+FAMILIES = ('II', 'LL')
+DISTRIBUTIONS = ('heavy_start', 'heavy_end', 'even', 'clustered', 'random')
+SMALLSIZES = (30, 1000)
+BIGSIZES = (100000, )
+
+# The kinds of operands, per operation
+KINDS = {
+    'intersection': (('set', 'set'), ('set', 'treeset'),
+                     ('treeset', 'set'), ('treeset', 'treeset')),
+    'difference': (('set', 'set'), ('set', 'treeset'),
+                   ('treeset', 'set'), ('treeset', 'treeset'),
+                   ('tree', 'treeset')),
+    'weightedIntersection': (('set', 'tree'), ('tree', 'tree'),
+                             ('treeset', 'tree')),
+    'union': (('set', 'set'), ('set', 'treeset'), ('treeset', 'treeset')),
+}
+
+# The sizes of the small set and the big tree set of the dispatch cases,
+# see dispatch()
+DISPATCHSIZES = (50, 300000)
+
+# The keys of the 64-bit family are moved past the range of 32-bit integers
+OFFSETS = {'II': 0, 'LL': 2 ** 32}
+
+# Compare mode reports cases slower than the baseline by this fraction
+THRESHOLD = 0.1
+
+
+def keys(distribution, size, space, seed=0):
+    """Return size sorted keys out of xrange(space)."""
+    rand = random.Random(seed)
+    size = min(size, space)
+    if distribution == 'heavy_start':
+        return range(size)
+    elif distribution == 'heavy_end':
+        return range(space - size, space)
+    elif distribution == 'even':
+        return range(0, space, space // size)[:size]
+    elif distribution == 'clustered':
+        # Ten runs of consecutive keys at random places
+        runs = min(10, size)
+        length = size // runs
+        slots = rand.sample(xrange(space // length), runs)
+        result = []
+        for slot in sorted(slots):
+            result.extend(xrange(slot * length, (slot + 1) * length))
+        return result
+    elif distribution == 'random':
+        return sorted(rand.sample(xrange(space), size))
+    raise ValueError('Unknown distribution %r' % distribution)
+
+
+def module(family, name='BTrees._%sBTree'):
+    name = name % family
+    return __import__(name, fromlist=[name.split('.')[-1]])
+
+
+def build(kind, keys, family='II'):
+    m = module(family)
+    offset = OFFSETS[family]
+    keys = [k + offset for k in keys]
+    if kind == 'set':
+        return getattr(m, family + 'Set')(keys)
+    elif kind == 'treeset':
+        return getattr(m, family + 'TreeSet')(keys)
+    elif kind == 'tree':
+        return getattr(m, family + 'BTree')([(k, k % 7 + 1) for k in keys])
+    raise ValueError('Unknown kind %r' % kind)
+
+
+def backends(family='II'):
+    """Return the implementations of the operations, by version."""
+    from experimental.btree import setpatches
+    stock = module(family)
+    settype = getattr(stock, family + 'Set')
+    treesettype = getattr(stock, family + 'TreeSet')
+    prefix = 'c' + family.lower()
+
+    result = {}
+    result['stock'] = dict(
+        intersection=stock.intersection,
+        difference=stock.difference,
+        weightedIntersection=stock.weightedIntersection,
+        union=stock.union,
+    )
+    result['python'] = dict(
+        intersection=setpatches.make_intersection(stock, settype),
+        difference=setpatches.make_difference(stock, settype),
+        weightedIntersection=setpatches.make_weightedIntersection(
+            stock, (settype, treesettype)),
+        union=setpatches.make_union(stock, settype),
+    )
+    try:
+        from experimental.btree import difference, intersection
+    except ImportError:
+        pass
+    else:
+        # There is no compiled weightedIntersection or union
+        result['cython'] = dict(
+            intersection=setpatches.make_intersection(
+                stock, settype, cintersection=getattr(
+                    intersection, prefix + 'intersection')),
+            difference=setpatches.make_difference(
+                stock, settype, cdifference=getattr(
+                    difference, prefix + 'difference')),
+        )
+    return result
+
+
+def cases(operations=OPERATIONS, distributions=DISTRIBUTIONS,
+          smallsizes=SMALLSIZES, bigsizes=BIGSIZES, families=FAMILIES):
+    """Yield the name, family, operation and operands of all cases.
+
+    The big operand has every other key on average, the small one is taken
+    from the same key space by the distribution.
+    """
+    for family in families:
+        for operation in operations:
+            for bigsize in bigsizes:
+                space = 2 * bigsize
+                bigkeys = keys('random', bigsize, space, seed=1)
+                for distribution in distributions:
+                    for smallsize in smallsizes:
+                        smallkeys = keys(distribution, smallsize, space)
+                        for skind, bkind in KINDS[operation]:
+                            small = build(skind, smallkeys, family)
+                            big = build(bkind, bigkeys, family)
+                            name = '%s %s %s %s%d %s%d' % (
+                                operation, family, distribution, skind,
+                                smallsize, bkind, bigsize)
+                            yield name, family, operation, (small, big)
+                            if operation == 'difference':
+                                name = '%s %s %s %s%d %s%d' % (
+                                    operation, family, distribution, bkind,
+                                    bigsize, skind, smallsize)
+                                yield name, family, operation, (big, small)
+
+
+def percentile(timings, p):
+    # timings must be sorted
+    return timings[int(round(p * (len(timings) - 1)))]
+
+
+def measure(func, args, repeat=7, warmup=2, mintime=0.005):
+    """Time func(*args) and return the statistics in seconds per call."""
+    for i in xrange(warmup):
+        func(*args)
+    # Run as many loops per repeat as we need to measure mintime
+    loops = 1
+    while True:
+        start = default_timer()
+        for i in xrange(loops):
+            func(*args)
+        elapsed = default_timer() - start
+        if elapsed >= mintime or loops >= 1000000:
+            break
+        loops *= 10
+    timings = []
+    for i in xrange(repeat):
+        start = default_timer()
+        for i in xrange(loops):
+            func(*args)
+        timings.append((default_timer() - start) / loops)
+    timings.sort()
+    return dict(
+        loops=loops,
+        repeat=repeat,
+        min=timings[0],
+        median=percentile(timings, 0.5),
+        p10=percentile(timings, 0.1),
+        p90=percentile(timings, 0.9),
+        max=timings[-1],
+    )
+
+
+def allocations(func, args):
+    """Count the objects func(*args) leaves behind, the result included.
+
+    They are counted by the garbage collector, which only tracks containers,
+    like the tuples, sets and buckets, not the ints in them. Objects freed
+    before func returns don't count.
+    """
+    gc.collect()
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        before = len(gc.get_objects())
+        result = func(*args)
+        count = len(gc.get_objects()) - before
+    finally:
+        if enabled:
+            gc.enable()
+    del result
+    return count
+
+
+def contents(result):
+    if isinstance(result, tuple):
+        # weightedIntersection
+        return result[0], contents(result[1])
+    if hasattr(result, 'items'):
+        return list(result.items())
+    return list(result)
+
+
+def run(repeat=7, warmup=2, mintime=0.005, out=None, **kw):
+    """Run the cases and return a list of results."""
+    families = {}
+    results = []
+    for name, family, operation, args in cases(**kw):
+        if family not in families:
+            families[family] = backends(family)
+        implementations = families[family]
+        expected = contents(implementations['stock'][operation](*args))
+        for backend in sorted(implementations):
+            func = implementations[backend].get(operation)
+            if func is None:
+                continue
+            if contents(func(*args)) != expected:
+                raise AssertionError('%s differs in %s' % (name, backend))
+            stats = measure(func, args, repeat, warmup, mintime)
+            stats['name'] = name
+            stats['backend'] = backend
+            results.append(stats)
+            if out is not None:
+                print >> out, report(stats)
+    return results
+
+
+def dispatch(families=FAMILIES, sizes=DISPATCHSIZES, repeat=7, warmup=2,
+             mintime=0.005, out=None):
+    """Time the patched intersection and difference of a small set and a big
+    tree set against probing the keys of the set directly.
+
+    Both pick probing, the difference between the 'python' and the 'probe'
+    versions is the time it takes to pick it. Returns a list of results
+    like run.
+    """
+    from experimental.btree import setpatches
+    smallsize, bigsize = sizes
+    space = 2 * bigsize
+    results = []
+    for family in families:
+        stock = module(family)
+        settype = getattr(stock, family + 'Set')
+        buckettype = getattr(stock, family + 'Bucket')
+        small = build('set', keys('even', smallsize, space), family)
+        big = build('treeset', keys('random', bigsize, space, seed=1),
+                    family)
+        implementations = (
+            ('intersection', 'python',
+             setpatches.make_intersection(stock, settype), ()),
+            ('intersection', 'probe', setpatches.probe_intersection,
+             (settype, )),
+            ('difference', 'python',
+             setpatches.make_difference(stock, settype), ()),
+            ('difference', 'probe', setpatches.probe_difference,
+             (settype, buckettype)),
+        )
+        for operation, backend, func, extra in implementations:
+            name = 'dispatch %s %s set%d treeset%d' % (
+                operation, family, smallsize, bigsize)
+            args = (small, big) + extra
+            expected = contents(getattr(stock, operation)(small, big))
+            if contents(func(*args)) != expected:
+                raise AssertionError('%s differs in %s' % (name, backend))
+            stats = measure(func, args, repeat, warmup, mintime)
+            stats['name'] = name
+            stats['backend'] = backend
+            results.append(stats)
+            if out is not None:
+                print >> out, report(stats)
+    return results
+
+
+def report(stats):
+    return '%-55s %-7s %10.2f %10.2f %10.2f us' % (
+        stats['name'], stats['backend'], stats['median'] * 1e6,
+        stats['p90'] * 1e6, stats['min'] * 1e6)
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """Return the results which are slower than their baseline as
+    (name, backend, baseline median, median) tuples.
+    """
+    old = {}
+    for stats in baseline:
+        old[stats['name'], stats['backend']] = stats['median']
+    regressions = []
+    for stats in results:
+        key = stats['name'], stats['backend']
+        if key not in old:
+            continue
+        if stats['median'] > old[key] * (1 + threshold):
+            regressions.append(key + (old[key], stats['median']))
+    return regressions
+
+
+def environment():
+    return dict(
+        python=sys.version.split()[0],
+        platform=platform.platform(),
+        machine=platform.machine(),
+    )
+
+
+def main(argv=None):
+    import json
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--json', help='Write the results to this file')
+    parser.add_option('--compare',
+                      help='Compare the results to this baseline file')
+    parser.add_option('--threshold', type='float', default=THRESHOLD,
+                      help='Allowed slowdown against the baseline '
+                           '[default: %default]')
+    parser.add_option('--operation', action='append', dest='operations',
+                      choices=OPERATIONS, help='Only run this operation')
+    parser.add_option('--family', action='append', dest='families',
+                      choices=FAMILIES, help='Only run this family')
+    parser.add_option('--distribution', action='append',
+                      dest='distributions', choices=DISTRIBUTIONS,
+                      help='Only run this distribution')
+    parser.add_option('--small', action='append', type='int',
+                      dest='smallsizes', help='Size of the small operand')
+    parser.add_option('--big', action='append', type='int',
+                      dest='bigsizes', help='Size of the big operand')
+    parser.add_option('--repeat', type='int', default=7)
+    parser.add_option('--warmup', type='int', default=2)
+    options, args = parser.parse_args(argv)
+
+    kw = {}
+    for name in ('operations', 'families', 'distributions', 'smallsizes',
+                 'bigsizes'):
+        value = getattr(options, name)
+        if value:
+            kw[name] = value
+    print '%-55s %-7s %10s %10s %10s' % (
+        'case', 'version', 'median', 'p90', 'min')
+    results = run(repeat=options.repeat, warmup=options.warmup,
+                  out=sys.stdout, **kw)
+    results += dispatch(kw.get('families', FAMILIES), repeat=options.repeat,
+                        warmup=options.warmup, out=sys.stdout)
+
+    if options.json:
+        f = open(options.json, 'w')
+        try:
+            json.dump(dict(environment=environment(), results=results), f,
+                      indent=1, sort_keys=True)
+        finally:
+            f.close()
+
+    if options.compare:
+        f = open(options.compare)
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+        regressions = compare(results, baseline['results'],
+                              options.threshold)
+        for name, backend, old, new in regressions:
+            print 'Regression: %s %s %.2f us -> %.2f us (%+.0f%%)' % (
+                name, backend, old * 1e6, new * 1e6, (new / old - 1) * 100)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,520 @@
+"""Compressed bitmaps of integer keys.
+
+The keys are split into chunks of 65536 by their upper bits. Every chunk
+keeps its lower 16 bits in the smallest of three containers, like roaring
+bitmaps do:
+
+- an array of the sorted keys, for sparse chunks,
+- a bitmap, a Python long with one bit per key, for dense ones,
+- runs of consecutive keys, as (first, last) pairs, for ranges.
+
+Intersections, differences and unions of bitmaps and runs are done on whole
+longs, so they are word-wide AND, ANDNOT and OR operations in C. The
+patched set operations of the integer families accept a `Bitmap` for
+either operand. For an intersection or difference the other operand is
+converted to a bitmap as well if it's dense. If it isn't, the keys of the
+smaller one are looked up in the other. For a union it's always converted.
+The result is a `Bitmap` then.
+
+Two plain sets are never converted, however dense they are. Callers expect
+a plain set back then, and converting the result back alone takes longer
+than the stock merge in C: for two tree sets of 900k and 500k of 1M keys
+the merge takes 48ms, the AND of their bitmaps 20ms and building the set
+from its result 130ms, on top of 500ms for converting both operands.
+Convert the sets which are used again and again once, with
+`Bitmap.fromset`, and keep the bitmaps.
+"""
+from array import array
+from binascii import hexlify
+from binascii import unhexlify
+from bisect import bisect_left
+from bisect import bisect_right
+
+from experimental.btree.buckets import buildbucket
+from experimental.btree.buckets import buildset
+from experimental.btree.buckets import estimate_size
+from experimental.btree.buckets import ismapping
+from experimental.btree.buckets import iterbuckets
+
+ARRAY = 0
+BITMAP = 1
+RUN = 2
+
+CHUNKBITS = 16
+CHUNKSIZE = 1 << CHUNKBITS
+LOWMASK = CHUNKSIZE - 1
+# Arrays of up to this many keys are smaller than a bitmap
+MAXARRAYSIZE = 4096
+# The bytes of a bitmap
+BITMAPSIZE = CHUNKSIZE // 8
+
+# Operands with at least this many keys per possible key between their
+# smallest and largest one are converted to bitmaps.
+DENSITY = float(MAXARRAYSIZE) / CHUNKSIZE
+
+# The positions of the set bits, for every value of a byte
+_BITS = tuple(tuple(i for i in xrange(8) if byte & (1 << i))
+              for byte in xrange(256))
+
+
+def _popcount(x):
+    return bin(x).count('1')
+
+
+def _tolong(lows):
+    # A bitmap of sorted lower bits
+    data = bytearray(BITMAPSIZE)
+    for low in lows:
+        data[low >> 3] |= 1 << (low & 7)
+    data.reverse()
+    return long(hexlify(str(data)), 16)
+
+
+def _tobytes(x):
+    # The bytes of a bitmap, lowest first
+    digits = '%x' % x
+    digits = '0' * (2 * BITMAPSIZE - len(digits)) + digits
+    data = bytearray(unhexlify(digits))
+    data.reverse()
+    return data
+
+
+def _fromlong(x):
+    # The set bits of a bitmap, in order
+    result = []
+    append = result.append
+    for i, byte in enumerate(_tobytes(x)):
+        if byte:
+            base = i << 3
+            for bit in _BITS[byte]:
+                append(base + bit)
+    return result
+
+
+def _runs(lows):
+    # (first, last) pairs of the runs of consecutive keys, flattened
+    runs = array('H')
+    if not lows:
+        return runs
+    first = last = lows[0]
+    for low in lows[1:]:
+        if low != last + 1:
+            runs.append(first)
+            runs.append(last)
+            first = low
+        last = low
+    runs.append(first)
+    runs.append(last)
+    return runs
+
+
+def _runmask(first, last):
+    return ((1 << (last - first + 1)) - 1) << first
+
+
+def fromlows(lows):
+    """Return the smallest container for sorted lower bits, or None."""
+    card = len(lows)
+    if not card:
+        return None
+    if card > MAXARRAYSIZE:
+        # Let the bitmap count the runs
+        return fromlong(_tolong(lows))
+    runs = _runs(lows)
+    # The sizes in bytes: two per array entry, four per run
+    if 2 * len(runs) < min(2 * card, BITMAPSIZE):
+        return RUN, runs, card
+    return ARRAY, array('H', lows), card
+
+
+def fromlong(x):
+    """Return the smallest container for a bitmap, or None."""
+    if not x:
+        return None
+    card = _popcount(x)
+    # A run starts at every set bit which follows a cleared one
+    runs = _popcount(x & ~(x << 1))
+    if 4 * runs < min(2 * card, BITMAPSIZE):
+        return RUN, _runs(_fromlong(x)), card
+    if card <= MAXARRAYSIZE:
+        return ARRAY, array('H', _fromlong(x)), card
+    return BITMAP, x, card
+
+
+def lows(container):
+    """Return the sorted lower bits in a container."""
+    kind, data, card = container
+    if kind == ARRAY:
+        return data
+    elif kind == RUN:
+        result = []
+        for i in xrange(0, len(data), 2):
+            result.extend(xrange(data[i], data[i + 1] + 1))
+        return result
+    return _fromlong(data)
+
+
+def tolong(container):
+    kind, data, card = container
+    if kind == BITMAP:
+        return data
+    elif kind == RUN:
+        x = 0
+        for i in xrange(0, len(data), 2):
+            x |= _runmask(data[i], data[i + 1])
+        return x
+    return _tolong(data)
+
+
+def member(container):
+    """Return a function which tests lower bits for membership."""
+    kind, data, card = container
+    if kind == ARRAY:
+        def contains(low):
+            i = bisect_left(data, low)
+            return i < card and data[i] == low
+    elif kind == RUN:
+        firsts = data[::2]
+        lasts = data[1::2]
+
+        def contains(low):
+            i = bisect_right(firsts, low) - 1
+            return i >= 0 and low <= lasts[i]
+    else:
+        bits = _tobytes(data)
+
+        def contains(low):
+            return bits[low >> 3] & (1 << (low & 7))
+    return contains
+
+
+def _intersectruns(r1, r2):
+    result = array('H')
+    i = j = 0
+    n1 = len(r1)
+    n2 = len(r2)
+    while i < n1 and j < n2:
+        first = max(r1[i], r2[j])
+        last = min(r1[i + 1], r2[j + 1])
+        if first <= last:
+            result.append(first)
+            result.append(last)
+        if r1[i + 1] < r2[j + 1]:
+            i += 2
+        else:
+            j += 2
+    return result
+
+
+def intersect(c1, c2):
+    """Intersect two containers, returns None if nothing is left."""
+    if c1[0] == ARRAY or c2[0] == ARRAY:
+        if c2[0] == ARRAY and (c1[0] != ARRAY or c2[2] < c1[2]):
+            c1, c2 = c2, c1
+        contains = member(c2)
+        return fromlows([low for low in c1[1] if contains(low)])
+    if c1[0] == RUN and c2[0] == RUN:
+        runs = _intersectruns(c1[1], c2[1])
+        if not runs:
+            return None
+        card = sum(runs[i + 1] - runs[i] + 1 for i in xrange(0, len(runs), 2))
+        if 2 * len(runs) < min(2 * card, BITMAPSIZE):
+            return RUN, runs, card
+        return fromlows(lows((RUN, runs, card)))
+    return fromlong(tolong(c1) & tolong(c2))
+
+
+def subtract(c1, c2):
+    """Remove the lower bits in c2 from c1, returns None if nothing is left."""
+    if c1[0] == ARRAY:
+        contains = member(c2)
+        return fromlows([low for low in c1[1] if not contains(low)])
+    return fromlong(tolong(c1) & ~tolong(c2))
+
+
+def unite(c1, c2):
+    """Unite two containers."""
+    if c1[0] == ARRAY and c2[0] == ARRAY and c1[2] + c2[2] <= MAXARRAYSIZE:
+        return fromlows(sorted(set(c1[1]).union(c2[1])))
+    return fromlong(tolong(c1) | tolong(c2))
+
+
+class Bitmap(object):
+    """A sorted set of integer keys, compressed per chunk of 65536 keys."""
+
+    def __init__(self, keys=()):
+        # keys must be sorted. The upper bits of the chunks in order, and
+        # their containers.
+        self.highs = []
+        self.containers = []
+        high = None
+        chunk = []
+        for key in keys:
+            h = key >> CHUNKBITS
+            if h != high:
+                self._add(high, chunk)
+                high = h
+                chunk = []
+            chunk.append(key & LOWMASK)
+        self._add(high, chunk)
+
+    def _add(self, high, lows):
+        container = fromlows(lows)
+        if container is not None:
+            self.highs.append(high)
+            self.containers.append(container)
+
+    @classmethod
+    def fromset(cls, o):
+        """Convert a set, tree set or the keys of a mapping to a Bitmap."""
+        new = cls()
+        high = None
+        chunk = []
+        for keys, values in iterbuckets(o):
+            i = 0
+            n = len(keys)
+            while i < n:
+                h = keys[i] >> CHUNKBITS
+                if h != high:
+                    new._add(high, chunk)
+                    high = h
+                    chunk = []
+                # The keys of this bucket in the same chunk
+                j = bisect_left(keys, (h + 1) << CHUNKBITS, i)
+                base = h << CHUNKBITS
+                chunk.extend([key - base for key in keys[i:j]])
+                i = j
+        new._add(high, chunk)
+        return new
+
+    @classmethod
+    def _fromchunks(cls, highs, containers):
+        new = cls()
+        new.highs = highs
+        new.containers = containers
+        return new
+
+    def __getstate__(self):
+        return self.highs, self.containers
+
+    def __setstate__(self, state):
+        self.highs, self.containers = state
+
+    def __len__(self):
+        return sum(c[2] for c in self.containers)
+
+    def __nonzero__(self):
+        return bool(self.highs)
+
+    def __iter__(self):
+        for high, container in zip(self.highs, self.containers):
+            base = high << CHUNKBITS
+            for low in lows(container):
+                yield base + low
+
+    keys = __iter__
+
+    def __contains__(self, key):
+        return bool(self.member()(key))
+
+    has_key = __contains__
+
+    def member(self):
+        """Return a function which tests keys for membership.
+
+        The chunks are prepared for lookups once, as they are used, so
+        this is faster than `in` for many keys.
+        """
+        highs = self.highs
+        containers = self.containers
+        members = {}
+
+        def contains(key):
+            high = key >> CHUNKBITS
+            found = members.get(high)
+            if found is None:
+                i = bisect_left(highs, high)
+                if i == len(highs) or highs[i] != high:
+                    found = members[high] = lambda low: False
+                else:
+                    found = members[high] = member(containers[i])
+            return found(key & LOWMASK)
+        return contains
+
+    def __repr__(self):
+        return '<%s with %d keys in %d chunks>' % (
+            self.__class__.__name__, len(self), len(self.highs))
+
+    def minKey(self):
+        return (self.highs[0] << CHUNKBITS) + lows(self.containers[0])[0]
+
+    def maxKey(self):
+        return (self.highs[-1] << CHUNKBITS) + lows(self.containers[-1])[-1]
+
+    def toset(self, settype):
+        """Return the keys as a set or tree set of settype."""
+        return buildset(settype, list(self))
+
+    def intersection(self, other):
+        highs = []
+        containers = []
+        h1, c1 = self.highs, self.containers
+        h2, c2 = other.highs, other.containers
+        i = j = 0
+        while i < len(h1) and j < len(h2):
+            if h1[i] < h2[j]:
+                i += 1
+            elif h2[j] < h1[i]:
+                j += 1
+            else:
+                container = intersect(c1[i], c2[j])
+                if container is not None:
+                    highs.append(h1[i])
+                    containers.append(container)
+                i += 1
+                j += 1
+        return self._fromchunks(highs, containers)
+
+    def union(self, other):
+        highs = []
+        containers = []
+        h1, c1 = self.highs, self.containers
+        h2, c2 = other.highs, other.containers
+        i = j = 0
+        while i < len(h1) or j < len(h2):
+            if j == len(h2) or (i < len(h1) and h1[i] < h2[j]):
+                highs.append(h1[i])
+                containers.append(c1[i])
+                i += 1
+            elif i == len(h1) or h2[j] < h1[i]:
+                highs.append(h2[j])
+                containers.append(c2[j])
+                j += 1
+            else:
+                highs.append(h1[i])
+                containers.append(unite(c1[i], c2[j]))
+                i += 1
+                j += 1
+        return self._fromchunks(highs, containers)
+
+    def difference(self, other):
+        highs = []
+        containers = []
+        h2, c2 = other.highs, other.containers
+        j = 0
+        for high, container in zip(self.highs, self.containers):
+            while j < len(h2) and h2[j] < high:
+                j += 1
+            if j < len(h2) and h2[j] == high:
+                container = subtract(container, c2[j])
+                if container is None:
+                    continue
+            highs.append(high)
+            containers.append(container)
+        return self._fromchunks(highs, containers)
+
+
+def isdense(o, n=None):
+    """Whether o, with an estimated n keys, is dense enough to be converted
+    to a bitmap.
+    """
+    if n is None:
+        n = estimate_size(o)
+    if n < MAXARRAYSIZE:
+        return False
+    span = o.maxKey() - o.minKey() + 1
+    return n >= DENSITY * span
+
+
+def asbitmap(o, bitmap):
+    # Convert o if it's dense, otherwise keep the keys of o in bitmap. They
+    # are looked up in whichever of the two has more keys.
+    if isinstance(o, Bitmap):
+        return o
+    n = estimate_size(o)
+    if isdense(o, n):
+        return Bitmap.fromset(o)
+    if len(bitmap) < n:
+        has = o.has_key
+        return Bitmap(key for key in bitmap if has(key))
+    contains = bitmap.member()
+    return Bitmap(key for key in o.keys() if contains(key))
+
+
+def intersection(o1, o2):
+    """Intersect a Bitmap and a Bitmap or an object of the same family."""
+    if o1 is None:
+        return o2
+    if o2 is None:
+        return o1
+    if not isinstance(o1, Bitmap):
+        o1, o2 = o2, o1
+    return o1.intersection(asbitmap(o2, o1))
+
+
+def tobitmap(o):
+    """Convert all keys of o to a Bitmap, an int stands for itself."""
+    if isinstance(o, Bitmap):
+        return o
+    if isinstance(o, (int, long)):
+        return Bitmap([o])
+    if hasattr(o, '__getstate__'):
+        return Bitmap.fromset(o)
+    return Bitmap(o.keys())
+
+
+def union(o1, o2):
+    """Unite a Bitmap and a Bitmap or an object of the same family."""
+    if o1 is None:
+        return o2
+    if o2 is None:
+        return o1
+    return tobitmap(o1).union(tobitmap(o2))
+
+
+def multiunion(seq):
+    """Unite a sequence of Bitmaps, objects of the same family and ints.
+
+    The containers of every chunk are collected first and united once, the
+    bitmaps of a chunk are ORed as one long per operand.
+    """
+    chunks = {}
+    for o in seq:
+        b = tobitmap(o)
+        for high, container in zip(b.highs, b.containers):
+            chunks.setdefault(high, []).append(container)
+    highs = sorted(chunks)
+    containers = []
+    for high in highs:
+        found = chunks[high]
+        if len(found) == 1:
+            containers.append(found[0])
+        elif sum(c[2] for c in found) <= MAXARRAYSIZE and all(
+                c[0] == ARRAY for c in found):
+            lows = set()
+            for c in found:
+                lows.update(c[1])
+            containers.append(fromlows(sorted(lows)))
+        else:
+            x = 0
+            for c in found:
+                x |= tolong(c)
+            containers.append(fromlong(x))
+    return Bitmap._fromchunks(highs, containers)
+
+
+def difference(o1, o2, settype, buckettype):
+    """Subtract a Bitmap from an object of the same family or the other way
+    around. The result is a Bitmap, unless o1 isn't one: then it's a set of
+    settype, or a bucket of buckettype with the values of a mapping o1.
+    """
+    if o1 is None or o2 is None:
+        return o1
+    if isinstance(o1, Bitmap):
+        return o1.difference(asbitmap(o2, o1))
+    contains = o2.member()
+    if ismapping(o1):
+        items = [(k, v) for k, v in o1.iteritems() if not contains(k)]
+        return buildbucket(buckettype, [k for k, v in items],
+                           [v for k, v in items])
+    return buildset(settype, [k for k in o1.keys() if not contains(k)])
@@ -0,0 +1,365 @@
+import sys
+from bisect import bisect_left
+from bisect import bisect_right
+from itertools import islice
+
+
+def istree(o):
+    # BTrees and TreeSets, as opposed to Buckets and Sets
+    return hasattr(o, '_check')
+
+
+def ismapping(o):
+    return hasattr(o, 'items')
+
+
+def buildset(settype, keys):
+    """Build a set from a sorted sequence of unique keys in one step.
+
+    The keys are handed to the set as its state. Inserting them one by one
+    searches the set and moves its tail for every key.
+    """
+    if istree(settype):
+        # Tree sets have to split their keys into buckets
+        return buildtree(settype, keys)
+    new = settype()
+    if keys:
+        new.__setstate__((tuple(keys), ))
+    return new
+
+
+def buildbucket(buckettype, keys, values):
+    """Build a bucket from sorted unique keys and their values."""
+    new = buckettype()
+    if keys:
+        items = [None] * (2 * len(keys))
+        items[::2] = keys
+        items[1::2] = values
+        new.__setstate__((tuple(items), ))
+    return new
+
+
+def buckettype(treetype):
+    """Return the bucket or set type of a tree or tree set type."""
+    module = sys.modules[treetype.__module__]
+    suffix = ismapping(treetype) and 'Bucket' or 'Set'
+    return getattr(module, treetype.__name__[:2] + suffix)
+
+
+def buildtree(treetype, keys, values=None, fill=1.0):
+    """Build a tree or tree set from sorted unique keys in linear time.
+
+    keys and values can be any iterables, arrays are converted to lists
+    first. The buckets are filled to fill times their maximum size as the
+    keys come in, every bucket gets its state once the next one exists so
+    it can be linked to it. The interior nodes are then built level by
+    level on top of them, from their states as well. Nothing is searched
+    or split. Leave room with a fill below 1 if the tree will be changed.
+    """
+    new = treetype()
+    family = treetype.__name__[:2]
+    size = max(int(MAXBUCKETSIZE.get(family, 30) * fill), 1)
+    nodesize = max(int(MAXNODESIZE[family[0]] * fill), 2)
+    bucket = buckettype(treetype)
+    keys = iter(_aslist(keys))
+    if values is not None:
+        values = iter(_aslist(values))
+    children = []
+    # The smallest key under every child
+    lowest = []
+    previous = None
+    while True:
+        data = tuple(islice(keys, size))
+        if not data:
+            break
+        lowest.append(data[0])
+        if values is not None:
+            items = [None] * (2 * len(data))
+            items[::2] = data
+            items[1::2] = islice(values, len(data))
+            data = tuple(items)
+        child = bucket()
+        if previous is not None:
+            previous.__setstate__((state, child))
+        children.append(child)
+        previous, state = child, data
+    if previous is None:
+        return new
+    previous.__setstate__((state, ))
+    # The first bucket under every child
+    firsts = children
+    while len(children) > nodesize:
+        nodes = []
+        for i in xrange(0, len(children), nodesize):
+            node = treetype()
+            node.__setstate__((_interleave(children[i:i + nodesize],
+                                           lowest[i + 1:i + nodesize]),
+                               firsts[i]))
+            nodes.append(node)
+        lowest = lowest[::nodesize]
+        firsts = firsts[::nodesize]
+        children = nodes
+    new.__setstate__((_interleave(children, lowest[1:]), firsts[0]))
+    return new
+
+
+def _aslist(keys):
+    # The items of arrays are no ints, which the buckets require
+    if hasattr(keys, 'tolist'):
+        return keys.tolist()
+    return keys
+
+
+def _interleave(children, separators):
+    data = [None] * (2 * len(children) - 1)
+    data[::2] = children
+    data[1::2] = separators
+    return tuple(data)
+
+
+def iterbuckets(o):
+    """Iterate over the buckets of o as (keys, values) tuples.
+
+    The keys and values are copied out of the bucket states, values is None
+    for sets. Sets and buckets count as a single bucket.
+    """
+    mapping = ismapping(o)
+    if istree(o):
+        state = o.__getstate__()
+        if state is None:
+            return
+        if len(state) == 1:
+            # A single bucket stored inline
+            states = [state[0][0]]
+        else:
+            states = _chain(state[1])
+    else:
+        states = [o.__getstate__()]
+    for state in states:
+        data = state[0]
+        if mapping:
+            yield data[::2], data[1::2]
+        else:
+            yield data, None
+
+
+def _chain(bucket):
+    while bucket is not None:
+        state = bucket.__getstate__()
+        yield state
+        if len(state) > 1:
+            bucket = state[1]
+        else:
+            bucket = None
+
+
+class BucketCursor(object):
+    """Find the buckets covering an increasing sequence of keys.
+
+    Only the pickle states of the tree nodes are read, so the keys of a
+    bucket come back as one sorted tuple. The cursor keeps the path to the
+    current bucket and only moves forward: seeking climbs up as far as the
+    new key requires and then descends again, without restarting at the
+    root for every key. For mappings the values of the current bucket are
+    kept in values, in the same order as the keys.
+    """
+
+    def __init__(self, o):
+        self.treetype = type(o)
+        self.mapping = ismapping(o)
+        # The upper bound (exclusive) of the keys in the current bucket,
+        # None if it's the last one.
+        self.upper = None
+        self.stack = []
+        self.keys = ()
+        self.values = ()
+        if not istree(o):
+            self.keys = self._bucketkeys(o)
+            return
+        state = o.__getstate__()
+        if state is not None:
+            self._push(state, None)
+
+    def _keys(self, state):
+        keys = state[0]
+        if self.mapping:
+            keys = keys[::2]
+        return keys
+
+    def _bucketkeys(self, bucket):
+        # Set buckets can be indexed by position, so there's no need to copy
+        # their keys, the keys of a mapping bucket are a lazy sequence.
+        if self.mapping:
+            self.values = bucket.values()
+            return bucket.keys()
+        return bucket
+
+    def _push(self, state, upper):
+        data = state[0]
+        if len(state) == 1:
+            # A node with a single bucket may store the bucket state inline
+            self.keys = self._keys(data[0])
+            if self.mapping:
+                self.values = data[0][0][1::2]
+            self.upper = upper
+            return False
+        self.stack.append((data[::2], data[1::2], upper))
+        return True
+
+    def seek(self, key):
+        """Return the keys of the bucket which can contain key."""
+        stack = self.stack
+        if not stack:
+            return self.keys
+        while len(stack) > 1:
+            upper = stack[-1][2]
+            if upper is None or key < upper:
+                break
+            stack.pop()
+        children, separators, upper = stack[-1]
+        while True:
+            i = bisect_right(separators, key)
+            if i < len(separators):
+                upper = separators[i]
+            child = children[i]
+            if type(child) is not self.treetype:
+                self.keys = self._bucketkeys(child)
+                self.upper = upper
+                return self.keys
+            if not self._push(child.__getstate__(), upper):
+                return self.keys
+            children, separators, upper = stack[-1]
+
+
+# The maximum number of keys in a bucket, by the key and value types in the
+# name of the tree. Tree sets use the same size for their buckets.
+MAXBUCKETSIZE = {
+    'II': 120, 'IF': 120, 'IO': 60, 'OI': 60, 'OO': 30,
+    'LL': 120, 'LF': 120, 'LO': 60, 'OL': 60,
+}
+# The maximum number of children of an interior node, by the key type
+MAXNODESIZE = {'I': 500, 'L': 500, 'O': 250}
+# How full we expect buckets to be if we can't look at any of them. Buckets
+# are split in half, so this is between half full for ascending keys and
+# the usual 70% for random ones.
+BUCKETFILL = 0.6
+
+
+def isghost(o):
+    return getattr(o, '_p_changed', 0) is None
+
+
+def estimate_size(o, sample=8):
+    """Estimate the number of keys in o without loading any bucket.
+
+    For trees only the root and a sample of the nodes on the first level
+    below it are read, deeper levels are assumed to look like the leftmost
+    path. The fill of the buckets is taken from buckets that are already
+    loaded, or assumed if none are.
+    """
+    if not istree(o):
+        return len(o)
+    state = o.__getstate__()
+    if state is None:
+        return 0
+    mapping = ismapping(o)
+    if len(state) == 1:
+        size = len(state[0][0][0])
+        if mapping:
+            size //= 2
+        return size
+
+    treetype = type(o)
+    children = state[0][::2]
+    nodes = len(children)
+    # Walk down the levels of interior nodes, on the first level we look at
+    # a sample of the nodes, below it only at the leftmost one.
+    while type(children[0]) is treetype:
+        step = max(len(children) // sample, 1)
+        picked = children[::step]
+        fanout = 0
+        below = None
+        for child in picked:
+            cstate = child.__getstate__()
+            if len(cstate) == 1:
+                # A single bucket stored inline
+                fanout += 1
+                continue
+            grandchildren = cstate[0][::2]
+            fanout += len(grandchildren)
+            if below is None:
+                below = grandchildren
+        nodes = nodes * fanout // len(picked)
+        if below is None:
+            break
+        children = below
+
+    # children holds buckets now, or inline bucket states
+    sizes = []
+    for bucket in children:
+        if type(bucket) is tuple or isghost(bucket):
+            continue
+        sizes.append(len(bucket))
+        if len(sizes) >= sample:
+            break
+    if sizes:
+        fill = float(sum(sizes)) / len(sizes)
+    else:
+        fill = MAXBUCKETSIZE.get(treetype.__name__[:2], 30) * BUCKETFILL
+    return int(nodes * fill)
+
+
+def estimate_range(o, lo, hi):
+    """Estimate the number of keys of o from lo to hi.
+
+    Sets are searched. For trees only the interior nodes along the paths to
+    lo and hi are read, the keys are assumed to be spread evenly over the
+    children of a node. Buckets of mappings can't be searched without
+    copying their keys, all of them count.
+    """
+    if not istree(o):
+        if ismapping(o):
+            return len(o)
+        return bisect_right(o, hi) - bisect_left(o, lo)
+    state = o.__getstate__()
+    if state is None:
+        return 0
+    if len(state) == 1:
+        keys = state[0][0][0]
+        if ismapping(o):
+            keys = keys[::2]
+        return bisect_right(keys, hi) - bisect_left(keys, lo)
+    return int(estimate_size(o) * _fraction(state, type(o), lo, hi))
+
+
+def _fraction(state, treetype, lo, hi, left=True, right=True):
+    # The fraction of the keys under a node from lo to hi. Only the children
+    # at the edges of the range are partially in it, the ones in between
+    # count fully. left and right tell whether lo and hi apply at all.
+    data = state[0]
+    if len(state) == 1:
+        # A single bucket stored inline
+        return 1.0
+    children = data[::2]
+    separators = data[1::2]
+    n = len(children)
+    i = 0
+    if left:
+        i = bisect_right(separators, lo)
+    j = n - 1
+    if right:
+        j = bisect_right(separators, hi)
+    if i == j:
+        return _edge(children[i], treetype, lo, hi, left, right) / n
+    full = j - i - 1
+    return (full + _edge(children[i], treetype, lo, hi, left, False) +
+            _edge(children[j], treetype, lo, hi, False, right)) / float(n)
+
+
+def _edge(child, treetype, lo, hi, left, right):
+    if not (left or right):
+        return 1.0
+    if type(child) is treetype:
+        return _fraction(child.__getstate__(), treetype, lo, hi, left, right)
+    # Buckets aren't loaded for this, guess half of one
+    return 0.5
@@ -0,0 +1,242 @@
+"""Opt-in memoization of intersection, difference and union results.
+
+Only calls whose operands are both persistent and unmodified are cached,
+keyed by the identity and the serial of the operands. Results are shared
+between callers, so they must not be modified.
+
+A tree consists of many persistent objects and changing a bucket doesn't
+change the serial of the tree itself. So the cache doesn't trust the
+serials alone: it is bypassed while the connection has modified objects and
+it is cleared at a transaction boundary if anything was committed to the
+database since the previous one.
+
+The caches are per thread, as each thread works on its own connection and
+transaction.
+"""
+from threading import local
+from threading import Lock
+import weakref
+
+# Memory budget of the cache of each thread, in bytes
+BUDGET = 16 * 1024 * 1024
+
+# Rough memory use of the result objects
+ENTRYSIZE = 256
+KEYSIZE = {'I': 4, 'L': 8, 'F': 4, 'O': 8}
+
+_caches = []
+_caches_lock = Lock()
+_local = local()
+# Bumped by reset(), each thread clears its own cache when it notices
+_generation = 0
+
+
+def resultsize(result):
+    size = ENTRYSIZE
+    if result is None:
+        return size
+    name = type(result).__name__
+    keysize = KEYSIZE.get(name[:1], 8)
+    if hasattr(result, 'items'):
+        # Buckets keep their values in a second array
+        keysize += KEYSIZE.get(name[1:2], 8)
+    return size + len(result) * keysize
+
+
+def modified(jar):
+    """Whether the connection jar has changed objects which aren't committed.
+
+    ZODB has no public way to ask, its connections keep them in
+    `_registered_objects`. Connections without that count as modified.
+    """
+    registered = getattr(jar, '_registered_objects', None)
+    return registered is None or bool(registered)
+
+
+def identity(o):
+    # Returns None if o can't be used in a key
+    jar = getattr(o, '_p_jar', None)
+    if jar is None or o._p_oid is None:
+        return None
+    if modified(jar):
+        # Something in this connection was changed, maybe a bucket of o
+        return None
+    if o._p_changed is None:
+        # Load the ghost to learn its current serial, the operation would
+        # load it anyway
+        o._p_activate()
+    return (id(o), o._p_oid, o._p_serial)
+
+
+class ResultCache(object):
+
+    def __init__(self, budget=None):
+        if budget is None:
+            budget = BUDGET
+        self.budget = budget
+        self.generation = _generation
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # The last transaction of each database we cached results from, as
+        # seen at the last transaction boundary
+        self.tids = {}
+        self.clear()
+
+    def clear(self):
+        self.data = {}
+        self.size = 0
+        # Circular doubly linked list of [prev, next, key, result, size,
+        # operands], the root's next is the least recently used entry
+        self.root = root = []
+        root[:] = [root, root, None, None, 0, None]
+
+    def key(self, name, o1, o2):
+        k1 = identity(o1)
+        if k1 is None:
+            return None
+        k2 = identity(o2)
+        if k2 is None:
+            return None
+        return (name, k1, k2)
+
+    def get(self, key):
+        link = self.data.get(key)
+        if link is None:
+            self.misses += 1
+            return None
+        # Move to the most recently used end
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+        root = self.root
+        last = root[0]
+        last[1] = root[0] = link
+        link[0] = last
+        link[1] = root
+        self.hits += 1
+        return link
+
+    def set(self, key, result, operands):
+        size = resultsize(result)
+        if size > self.budget:
+            return
+        for o in operands:
+            db = o._p_jar.db()
+            if db not in self.tids:
+                # We haven't seen a transaction boundary for this database
+                # yet, so the next one will clear the cache.
+                self.tids[db] = None
+        root = self.root
+        last = root[0]
+        link = [last, root, key, result, size, operands]
+        last[1] = root[0] = self.data[key] = link
+        self.size += size
+        while self.size > self.budget:
+            self._remove(root[1])
+            self.evictions += 1
+
+    def _remove(self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+        del self.data[link[2]]
+        self.size -= link[4]
+
+    def reset(self):
+        self.clear()
+        self.tids.clear()
+        self.hits = self.misses = self.evictions = 0
+        self.generation = _generation
+
+    def sweep(self):
+        if self.generation != _generation:
+            self.reset()
+            return
+        changed = False
+        for db, tid in self.tids.items():
+            try:
+                last = db.lastTransaction()
+            except Exception:
+                # Closed, we must not break the transaction because of it
+                del self.tids[db]
+                changed = True
+                continue
+            if last != tid:
+                changed = True
+            self.tids[db] = last
+        if changed:
+            self.clear()
+
+    # Transaction synchronizer API
+
+    def beforeCompletion(self, txn):
+        pass
+
+    def afterCompletion(self, txn):
+        self.sweep()
+
+    def newTransaction(self, txn):
+        self.sweep()
+
+
+def getcache():
+    cache = getattr(_local, 'cache', None)
+    if cache is None:
+        import transaction
+        cache = _local.cache = ResultCache()
+        # Synchronizers are registered per thread
+        transaction.manager.registerSynch(cache)
+        _caches_lock.acquire()
+        try:
+            _caches[:] = [ref for ref in _caches if ref() is not None]
+            _caches.append(weakref.ref(cache))
+        finally:
+            _caches_lock.release()
+    elif cache.generation != _generation:
+        cache.reset()
+    return cache
+
+
+def cached(name, func):
+    def wrapper(o1, o2, **kw):
+        if kw:
+            # The bounds of a window aren't part of the key
+            return func(o1, o2, **kw)
+        cache = getcache()
+        key = cache.key(name, o1, o2)
+        if key is None:
+            return func(o1, o2)
+        link = cache.get(key)
+        if link is not None:
+            return link[3]
+        result = func(o1, o2)
+        cache.set(key, result, (o1, o2))
+        return result
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+
+def stats():
+    """Return the hits, misses, evictions, entries and size of all caches."""
+    result = dict(hits=0, misses=0, evictions=0, entries=0, size=0)
+    _caches_lock.acquire()
+    try:
+        caches = [ref() for ref in _caches]
+    finally:
+        _caches_lock.release()
+    for cache in caches:
+        if cache is None or cache.generation != _generation:
+            continue
+        result['hits'] += cache.hits
+        result['misses'] += cache.misses
+        result['evictions'] += cache.evictions
+        result['entries'] += len(cache.data)
+        result['size'] += cache.size
+    return result
+
+
+def reset():
+    """Clear all caches and their counters."""
+    global _generation
+    _generation += 1
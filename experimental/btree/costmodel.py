@@ -0,0 +1,442 @@
+from logging import getLogger
+from math import log
+from timeit import default_timer
+
+from BTrees import IIBTree
+
+from experimental.btree import querystats
+from experimental.btree.buckets import estimate_range
+from experimental.btree.buckets import estimate_size
+from experimental.btree.buckets import istree
+from experimental.btree.cache import identity
+from experimental.btree.window import bounds
+
+logger = getLogger('experimental.btree')
+
+# The compiled functions only loop over sets smaller than this, see the
+# SMALLSETSIZE in intersection.pyx and difference.pyx
+CSMALLSETSIZE = 1000
+
+# Intersections of operands of at least this size are split into key
+# ranges and merged in a thread pool, if enabled, see parallel.py
+PARALLELSIZE = 1000000
+
+# Restricting operands to the window where their keys overlap is only
+# considered if both have at least this many keys, see window.py
+WINDOWSIZE = 1000
+
+# The stock merge stops at the end of the operand which ends first, so the
+# window only saves the keys before it starts. It is only considered if it
+# cuts the keys the merge would walk down to at most this fraction, below
+# that copying the window out costs more than it saves.
+WINDOWFRACTION = 0.5
+
+# The typical number of keys in a bucket
+BUCKETSIZE = 100
+
+# Sets and buckets smaller than this are probed against a tree without
+# estimating the size of the tree. Probing them costs a few microseconds
+# per level, merging only wins against trees of a few buckets, where the
+# difference is as small.
+SMALLSIZE = 200
+
+# The number of estimated tree sizes kept, see size()
+MAXSIZES = 10000
+
+# Seconds per unit of work, per strategy and kind of the operand it works
+# on. 'set' stands for sets and buckets, which keep their keys in a single
+# array, 'tree' for trees and tree sets. The defaults come from calibrate()
+# on a current x86-64 machine, run it to fit them to yours.
+#
+# merge:  per key of either operand, the stock C implementation
+# probe:  per key of the small operand and level of the big one, has_key
+# gallop: per key of the small operand and level of the gap between keys
+# c:      like probe, for the compiled loop
+# vector: per key of either operand, copying them into NumPy arrays
+# walk:   per key of the first operand of a difference, copied a bucket at
+#         a time
+# visit:  per bucket of the second operand a walk visits
+# window: per key copied out of the window of an operand, the merge of
+#         the copies costs as usual
+COEFFICIENTS = {
+    'merge_set': 6.5e-09,
+    'merge_tree': 2.5e-08,
+    'probe_set': 2.2e-08,
+    'probe_tree': 2.2e-08,
+    'gallop_set': 3.9e-07,
+    'gallop_tree': 6.1e-07,
+    'c_set': 1.7e-08,
+    'c_tree': 1.7e-08,
+    'vector_set': 7.5e-08,
+    'vector_tree': 8.5e-08,
+    'walk_set': 5.0e-08,
+    'walk_tree': 6.0e-08,
+    'visit_set': 1.5e-06,
+    'visit_tree': 5.5e-06,
+    'window_set': 4.5e-08,
+    'window_tree': 6.0e-08,
+}
+
+# BTrees runs its Python implementation on PyPy or with PURE_PYTHON set,
+# BTrees before 4.0 has none. Its merge walks the keys in Python, so copying
+# them into arrays wins. These come from calibrate() on the same machine as
+# the defaults. The compiled functions don't take its types.
+PYTHON_BTREES = (IIBTree.intersection is
+                 getattr(IIBTree, 'intersectionPy', None))
+PYTHON_COEFFICIENTS = {
+    'merge_set': 1.6e-06,
+    'merge_tree': 1.9e-06,
+    'probe_set': 7.5e-07,
+    'probe_tree': 1.5e-06,
+    'gallop_set': 5.1e-06,
+    'gallop_tree': 2.2e-06,
+    'vector_set': 6.0e-08,
+    'vector_tree': 1.8e-07,
+    'walk_set': 4.8e-08,
+    'walk_tree': 3.2e-07,
+    'visit_set': 3.3e-05,
+    'visit_tree': 4.6e-05,
+    'window_set': 3.8e-08,
+    'window_tree': 1.1e-06,
+}
+if PYTHON_BTREES:
+    COEFFICIENTS.update(PYTHON_COEFFICIENTS)
+
+
+# Estimated sizes of persistent trees, by their identity and serial
+_sizes = {}
+
+
+def size(o):
+    """Return the size of a set or bucket, or the estimated size of a tree.
+
+    The estimates of unmodified persistent trees are kept, keyed like the
+    results in `cache`. Changing a bucket doesn't change the serial of the
+    tree, so an estimate can lag behind until the tree itself changes,
+    which is close enough to pick a strategy.
+    """
+    if not istree(o):
+        return len(o)
+    key = identity(o)
+    if key is None:
+        return estimate_size(o)
+    n = _sizes.get(key)
+    if n is None:
+        if len(_sizes) >= MAXSIZES:
+            _sizes.clear()
+        n = _sizes[key] = estimate_size(o)
+    return n
+
+
+def smallset(o, other):
+    # Whether o is a set or bucket small enough to be probed against the
+    # tree other, whatever its size
+    return not istree(o) and istree(other) and len(o) < SMALLSIZE
+
+
+def kind(o):
+    if istree(o):
+        return 'tree'
+    return 'set'
+
+
+def log2(n):
+    return log(n + 2, 2)
+
+
+def visits(n1, n2):
+    # The number of buckets of o2 a walk visits, at most one per bucket of
+    # o2 and key of o1, and at least one per bucket of o1.
+    return min(n1, n2 // BUCKETSIZE) + n1 // BUCKETSIZE + 1
+
+
+def cost(strategy, small, big):
+    # small and big are (size, kind) tuples
+    c = COEFFICIENTS
+    if strategy in ('merge', 'vector'):
+        return (c[strategy + '_' + small[1]] * small[0] +
+                c[strategy + '_' + big[1]] * big[0])
+    elif strategy == 'walk':
+        # small is the first operand here, whatever its size
+        return (c['walk_' + small[1]] * small[0] +
+                c['visit_' + big[1]] * visits(small[0], big[0]))
+    elif strategy == 'gallop':
+        return (c['gallop_' + big[1]] * small[0] *
+                log2(big[0] / max(small[0], 1)))
+    return c[strategy + '_' + big[1]] * small[0] * log2(big[0])
+
+
+def windowed(o, size, lo, hi):
+    # The estimated size of o cut down to lo to hi, and the cost of that
+    n = estimate_range(o, lo, hi)
+    if n >= size:
+        return size, 0.0
+    return n, COEFFICIENTS['window_' + kind(o)] * n
+
+
+def walked(o1, o2):
+    # The estimated number of keys of o2 the stock merge walks before o1
+    # runs out
+    if not o1 or not o2:
+        return 0
+    return estimate_range(o2, o2.minKey(), o1.maxKey())
+
+
+def learned(operation, strategy, s, b, c, estimates):
+    # Keep the estimate, to record it with the time it took, and correct
+    # it by what was recorded so far
+    if estimates is None:
+        return c
+    estimates[strategy] = c
+    return c * querystats.factor((operation, strategy, s[1], b[1]))
+
+
+def intersection(o1, o2, settype, strategies, estimates=None):
+    """Pick the cheapest way to intersect o1 and o2.
+
+    Returns the name of the strategy and the operands as (small, big). If
+    estimates is a dictionary, the estimated costs are stored in it by
+    strategy and the ones corrected by `querystats` are compared.
+    """
+    if estimates is None:
+        # len() decides for a small set against a tree, the size of the
+        # tree doesn't matter. Learning compares the estimates of all.
+        for s, b in ((o1, o2), (o2, o1)):
+            if not smallset(s, b):
+                continue
+            if ('c' in strategies and type(s) is settype and
+                len(s) < CSMALLSETSIZE):
+                return 'c', s, b
+            if 'probe' in strategies:
+                return 'probe', s, b
+    # Estimating the size of a tree only reads its upper levels
+    n1 = size(o1)
+    n2 = size(o2)
+    if n1 <= n2:
+        small, big = o1, o2
+        ssize, bsize = n1, n2
+    else:
+        small, big = o2, o1
+        ssize, bsize = n2, n1
+    s = (ssize, kind(small))
+    b = (bsize, kind(big))
+
+    best = 'merge'
+    bestcost = learned('intersection', 'merge', s, b, cost('merge', s, b),
+                       estimates)
+    for strategy in strategies:
+        if strategy == 'merge':
+            continue
+        if strategy == 'c':
+            # The compiled function only loops if just one of them is a set
+            if (type(small) is not settype or type(big) is settype or
+                ssize >= CSMALLSETSIZE):
+                continue
+        elif strategy == 'parallel':
+            # Switched on by size, there is no cost to compare
+            if ssize >= PARALLELSIZE:
+                return strategy, small, big
+            continue
+        elif strategy == 'window':
+            if ssize < WINDOWSIZE:
+                continue
+            window = bounds(small, big)
+            if window is None:
+                # Nothing to merge at all
+                return strategy, small, big
+            n1, c1 = windowed(small, ssize, *window)
+            n2, c2 = windowed(big, bsize, *window)
+            if n1 + n2 > WINDOWFRACTION * (walked(big, small) +
+                                           walked(small, big)):
+                continue
+            c = c1 + c2 + cost('merge', (n1, s[1]), (n2, b[1]))
+            c = learned('intersection', strategy, s, b, c, estimates)
+            if c < bestcost:
+                best = strategy
+                bestcost = c
+            continue
+        c = learned('intersection', strategy, s, b, cost(strategy, s, b),
+                    estimates)
+        if c < bestcost:
+            best = strategy
+            bestcost = c
+    return best, small, big
+
+
+def difference(o1, o2, settype, strategies, estimates=None):
+    """Pick the cheapest way to compute the difference of o1 and o2.
+
+    estimates is used like for `intersection`.
+    """
+    if estimates is None and 'probe' in strategies and smallset(o1, o2):
+        # Like for intersection. The compiled difference takes the len() of
+        # o2, which loads all buckets of a tree, so it's not used here.
+        return 'probe'
+    n1 = size(o1)
+    n2 = size(o2)
+    s = (n1, kind(o1))
+    b = (n2, kind(o2))
+    # The stock merge copies what's left of o1 once o2 runs out, but stops
+    # once o1 does
+    merged = walked(o1, o2)
+
+    best = 'merge'
+    bestcost = learned('difference', 'merge', s, b,
+                       cost('merge', s, (merged, b[1])), estimates)
+    for strategy in strategies:
+        if strategy == 'merge':
+            continue
+        if strategy == 'c' and (type(o1) is not settype or
+                                n1 >= CSMALLSETSIZE or istree(o2)):
+            # The compiled function only loops over small sets, and takes
+            # the len() of o2 first, which loads every bucket of a tree
+            continue
+        elif strategy == 'window':
+            # All of o1 is kept, o2 is cut down to where o1 has keys
+            if min(n1, n2) < WINDOWSIZE:
+                continue
+            n, c = windowed(o2, n2, o1.minKey(), o1.maxKey())
+            if n > WINDOWFRACTION * merged:
+                continue
+            c += cost('merge', s, (n, b[1]))
+            c = learned('difference', strategy, s, b, c, estimates)
+            if c < bestcost:
+                best = strategy
+                bestcost = c
+            continue
+        c = learned('difference', strategy, s, b, cost(strategy, s, b),
+                    estimates)
+        if c < bestcost:
+            best = strategy
+            bestcost = c
+    return best
+
+
+def union(o1, o2, strategies):
+    """Pick the cheapest way to unite o1 and o2.
+
+    Every strategy has to look at all keys, so only the stock merge and
+    copying the keys into arrays compete.
+    """
+    s = (size(o1), kind(o1))
+    b = (size(o2), kind(o2))
+    best = 'merge'
+    bestcost = cost('merge', s, b)
+    if 'vector' in strategies and cost('vector', s, b) < bestcost:
+        best = 'vector'
+    return best
+
+
+def weightedIntersection(o1, o2, strategies):
+    """Pick the cheapest way to compute the weighted intersection.
+
+    Returns the name of the strategy and the operands as (small, big).
+    """
+    n1 = size(o1)
+    n2 = size(o2)
+    if n1 <= n2:
+        small, big = o1, o2
+        ssize, bsize = n1, n2
+    else:
+        small, big = o2, o1
+        ssize, bsize = n2, n1
+    s = (ssize, kind(small))
+    b = (bsize, kind(big))
+
+    best = 'merge'
+    bestcost = cost('merge', s, b)
+    for strategy in strategies:
+        if strategy == 'merge':
+            continue
+        c = cost(strategy, s, b)
+        if c < bestcost:
+            best = strategy
+            bestcost = c
+    return best, small, big
+
+
+def _timing(func, args, repeat):
+    timings = []
+    for i in xrange(repeat):
+        start = default_timer()
+        func(*args)
+        timings.append(default_timer() - start)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def calibrate(bigsize=100000, smallsize=500, repeat=5):
+    """Measure the coefficients of the cost model on this machine."""
+    from BTrees.IIBTree import IIBucket, IISet, IITreeSet
+    from BTrees.IIBTree import intersection as iiintersection
+    from experimental.btree.galloping import galloping_intersection
+    from experimental.btree.galloping import walking_difference
+    from experimental.btree.setpatches import HAS_COPTIMIZATIONS
+    from experimental.btree.setpatches import probe_intersection
+    from experimental.btree.window import restrict
+    from experimental.btree import vectorized
+
+    small = IISet(xrange(0, bigsize, bigsize // smallsize))
+    bigs = {
+        'set': IISet(xrange(bigsize)),
+        'tree': IITreeSet(xrange(bigsize)),
+    }
+    # The compiled loop doesn't run against sets, but does against buckets
+    cbigs = {
+        'set': IIBucket(zip(xrange(bigsize), xrange(bigsize))),
+        'tree': bigs['tree'],
+    }
+    ssize = len(small)
+    coefficients = {}
+    for k, big in bigs.items():
+        coefficients['merge_' + k] = _timing(
+            iiintersection, (big, big), repeat) / (2 * bigsize)
+        coefficients['probe_' + k] = _timing(
+            probe_intersection, (small, big, IISet), repeat) / (
+            ssize * log2(bigsize))
+        coefficients['gallop_' + k] = _timing(
+            galloping_intersection, (small, big, IISet), repeat) / (
+            ssize * log2(bigsize / ssize))
+        if HAS_COPTIMIZATIONS:
+            from experimental.btree.intersection import ciiintersection
+            coefficients['c_' + k] = _timing(
+                ciiintersection, (small, cbigs[k]), repeat) / (
+                ssize * log2(bigsize))
+        # Nothing to remove, all keys are copied
+        coefficients['walk_' + k] = _timing(
+            walking_difference, (big, IISet([bigsize]), IISet, IIBucket),
+            repeat) / bigsize
+        # Copy all keys but the first
+        coefficients['window_' + k] = _timing(
+            restrict, (big, 1, bigsize, IISet, IIBucket), repeat) / bigsize
+        if vectorized.HAS_NUMPY:
+            coefficients['vector_' + k] = _timing(
+                vectorized.intersection, (big, big, IISet), repeat) / (
+                2 * bigsize)
+    # A key of the small set in every bucket of big
+    for k, big in bigs.items():
+        coefficients['visit_' + k] = (_timing(
+            walking_difference, (small, big, IISet, IIBucket), repeat) -
+            coefficients['walk_set'] * ssize) / visits(ssize, bigsize)
+    COEFFICIENTS.update(coefficients)
+    logger.debug('Calibrated cost model: %r' % COEFFICIENTS)
+    return coefficients
+
+
+def load_profile(path):
+    import json
+    f = open(path)
+    try:
+        COEFFICIENTS.update(json.load(f))
+    finally:
+        f.close()
+    logger.debug('Loaded cost model from %s' % path)
+
+
+def save_profile(path):
+    import json
+    f = open(path, 'w')
+    try:
+        json.dump(COEFFICIENTS, f, indent=2, sort_keys=True)
+    finally:
+        f.close()
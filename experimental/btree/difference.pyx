@@ -10,7 +10,8 @@ cpdef object ciidifference(object o1, object o2):
         return iidifference(o1, o2)
 
     cdef int l1, l2, i
-    cdef object new, ins, has
+    cdef object new, has
+    cdef list keys
 
     # Both are real sets, of unknown size
     l1 = len(o1)
@@ -19,12 +20,78 @@ cpdef object ciidifference(object o1, object o2):
     if l1 < SMALLSETSIZE and isinstance(o1, IISet):
         l2 = len(o2)
         if l2/l1 > BIGSMALLRATIO:
-            new = IISet()
-            ins = new.insert
+            # Collect the keys in order and build the set in one step
+            keys = []
             has = o2.has_key
             for i in o1:
                 if not has(i):
-                    ins(i)
+                    keys.append(i)
+            new = IISet()
+            if keys:
+                new.__setstate__((tuple(keys), ))
             return new
 
     return iidifference(o1, o2)
+
+
+from BTrees._IOBTree import difference as iodifference
+from BTrees._IOBTree import IOSet
+from BTrees._LFBTree import difference as lfdifference
+from BTrees._LFBTree import LFSet
+from BTrees._LLBTree import difference as lldifference
+from BTrees._LLBTree import LLSet
+from BTrees._LOBTree import difference as lodifference
+from BTrees._LOBTree import LOSet
+from BTrees._OIBTree import difference as oidifference
+from BTrees._OIBTree import OISet
+from BTrees._OOBTree import difference as oodifference
+from BTrees._OOBTree import OOSet
+
+include "keys.pxi"
+
+
+cdef object _difference(object o1, object o2, object settype,
+                        object setdifference, bint merge):
+    if not o1 or not o2:
+        return setdifference(o1, o2)
+
+    cdef Py_ssize_t l1, l2
+    cdef object new
+    cdef list keys
+
+    l1 = len(o1)
+    # Difference returns bucket if o1 is btree
+    if l1 < SMALLSETSIZE and type(o1) is settype:
+        l2 = len(o2)
+        if l2/l1 > BIGSMALLRATIO:
+            keys = _probe_keys(o1, o2, False, merge)
+            new = settype()
+            if keys:
+                new.__setstate__((tuple(keys), ))
+            return new
+
+    return setdifference(o1, o2)
+
+
+cpdef object ciodifference(object o1, object o2):
+    return _difference(o1, o2, IOSet, iodifference, False)
+
+
+cpdef object coidifference(object o1, object o2):
+    return _difference(o1, o2, OISet, oidifference, True)
+
+
+cpdef object coodifference(object o1, object o2):
+    return _difference(o1, o2, OOSet, oodifference, True)
+
+
+cpdef object clldifference(object o1, object o2):
+    return _difference(o1, o2, LLSet, lldifference, False)
+
+
+cpdef object clodifference(object o1, object o2):
+    return _difference(o1, o2, LOSet, lodifference, False)
+
+
+cpdef object clfdifference(object o1, object o2):
+    return _difference(o1, o2, LFSet, lfdifference, False)
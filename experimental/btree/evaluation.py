@@ -0,0 +1,204 @@
+"""Evaluate the indexes of a catalog query concurrently.
+
+`Catalog.search` applies one index after the other, the storage loads of
+every index only start once the previous one is done. `evaluate` hands the
+`_apply_index` calls of all indexes to a thread pool instead. Once all
+results are in they are intersected in the calling thread with
+`multiintersection`, smallest first::
+
+  from experimental.btree import evaluation
+  indexes = [catalog.getIndex(name) for name in query]
+  result = evaluation.evaluate(indexes, query)
+
+As soon as an index returns an empty result the evaluations which didn't
+start yet are cancelled, and the result is returned without waiting for
+the ones which are still running.
+
+A ZODB connection must only be used by one thread. Every evaluation of a
+persistent index opens its own connection from the same database, which
+sees the last committed state, and loads the index from it. Results which
+belong to that connection are copied before it's closed. If the connection
+of the caller has uncommitted changes the indexes are evaluated one after
+the other in the calling thread, so those changes are seen.
+"""
+import sys
+from Queue import Queue
+from threading import Event
+from threading import Lock
+
+import transaction
+from BTrees import IIBTree
+
+from experimental.btree import probing
+from experimental.btree import querystats
+from experimental.btree.buckets import buildbucket
+from experimental.btree.buckets import buildset
+from experimental.btree.buckets import ismapping
+from experimental.btree.cache import modified
+from experimental.btree.multiintersection import multiintersection
+
+# The number of threads in the pool. Evaluating an index mostly waits for
+# the storage, so there can be more of them than CPUs.
+WORKERS = 4
+
+_pool = None
+_pool_lock = Lock()
+
+
+def pool():
+    global _pool
+    _pool_lock.acquire()
+    try:
+        if _pool is None:
+            from multiprocessing.pool import ThreadPool
+            _pool = ThreadPool(WORKERS)
+        return _pool
+    finally:
+        _pool_lock.release()
+
+
+def combine(rs, r):
+    # Like Catalog.search, the values of mappings are added up
+    if rs is None:
+        return r
+    if ismapping(rs) or ismapping(r):
+        return IIBTree.weightedIntersection(rs, r)[1]
+    return IIBTree.intersection(rs, r)
+
+
+def finish(results):
+    # Intersect the sets smallest first, then weigh in the mappings
+    rs = multiintersection(*[r for r in results if not ismapping(r)])
+    for r in results:
+        if ismapping(r):
+            rs = combine(rs, r)
+    return rs
+
+
+def detach(result):
+    """Return a copy of result if it's loaded from a ZODB connection."""
+    if getattr(result, '_p_jar', None) is None:
+        return result
+    if ismapping(result):
+        return buildbucket(IIBTree.IIBucket, result.keys(), result.values())
+    return buildset(IIBTree.IISet, result.keys())
+
+
+def apply_index(index, request, resultset=None):
+    # Return the result of index for request, or None if it doesn't apply.
+    # A small resultset is probed against the index.
+    if getattr(index, '_old_probing', None) is not None:
+        # Patched by setpatches, it probes and records itself
+        result = index._apply_index(request, resultset)
+    else:
+        result = probing.evaluate(index, request, resultset,
+                                  lambda: index._apply_index(request))
+    if result is None:
+        return None
+    return result[0]
+
+
+def _evaluate(index, request, db, cancelled):
+    if cancelled.isSet():
+        return None
+    if db is None:
+        return apply_index(index, request)
+    manager = transaction.TransactionManager()
+    conn = db.open(transaction_manager=manager)
+    try:
+        result = apply_index(conn.get(index._p_oid), request)
+        return detach(result)
+    finally:
+        manager.abort()
+        conn.close()
+
+
+def _task(queue, i, index, request, db, cancelled):
+    try:
+        queue.put((i, _evaluate(index, request, db, cancelled), None))
+    except:
+        queue.put((i, None, sys.exc_info()))
+
+
+def changed(indexes):
+    # Whether a connection of the indexes has uncommitted changes
+    for index in indexes:
+        if getattr(index, '_p_changed', None):
+            return True
+        jar = getattr(index, '_p_jar', None)
+        if jar is not None and modified(jar):
+            return True
+    return False
+
+
+def order(indexes, request):
+    # By the average size of their results, the ones without statistics
+    # come first, so they are measured
+    if not querystats.enabled:
+        return indexes
+    sizes = []
+    for i, index in enumerate(indexes):
+        name = index.getId()
+        found = querystats.estimate(querystats.shape(name, request.get(name)))
+        if found is None:
+            sizes.append((-1, i, index))
+        else:
+            sizes.append((found[0], i, index))
+    sizes.sort()
+    return [index for size, i, index in sizes]
+
+
+def sequential(indexes, request):
+    """Evaluate the indexes one after the other, like `Catalog.search`.
+
+    Once the running result is small the later indexes only probe its ids,
+    see `probing`. With `querystats` enabled the indexes which returned the
+    fewest ids so far go first.
+    """
+    rs = None
+    for index in order(indexes, request):
+        r = apply_index(index, request, rs)
+        if r is None:
+            continue
+        rs = combine(rs, r)
+        if not rs:
+            break
+    return rs
+
+
+def evaluate(indexes, request):
+    """Intersect the results of the indexes for request.
+
+    Returns None if none of the indexes applies to the request. An
+    exception of an index is raised again in the calling thread.
+    """
+    indexes = list(indexes)
+    if len(indexes) < 2 or changed(indexes):
+        return sequential(indexes, request)
+    queue = Queue()
+    cancelled = Event()
+    apply_async = pool().apply_async
+    for i, index in enumerate(indexes):
+        jar = getattr(index, '_p_jar', None)
+        db = None
+        if jar is not None and index._p_oid is not None:
+            db = jar.db()
+        apply_async(_task, (queue, i, index, request, db, cancelled))
+    results = []
+    try:
+        for n in xrange(len(indexes)):
+            i, r, error = queue.get()
+            if error is not None:
+                raise error[0], error[1], error[2]
+            if r is None:
+                continue
+            if not r:
+                # Nothing can be left
+                return r
+            results.append(r)
+    finally:
+        # Anything still queued has nothing left to do
+        cancelled.set()
+    if not results:
+        return None
+    return finish(results)
@@ -0,0 +1,150 @@
+from bisect import bisect_left
+from bisect import bisect_right
+
+from experimental.btree.buckets import BucketCursor
+from experimental.btree.buckets import buildbucket
+from experimental.btree.buckets import buildset
+from experimental.btree.buckets import ismapping
+from experimental.btree.buckets import iterbuckets
+
+
+def gallop(keys, key, lo=0):
+    # Find the position of the first item >= key in keys[lo:], probing
+    # lo, lo+1, lo+3, lo+7, ... before bisecting the last gap. The cost is
+    # logarithmic in the distance we move, not in the length of keys.
+    n = len(keys)
+    hi = lo
+    step = 1
+    while hi < n and keys[hi] < key:
+        lo = hi + 1
+        hi += step
+        step <<= 1
+    if hi > n:
+        hi = n
+    return bisect_left(keys, key, lo, hi)
+
+
+def galloping_intersection(small, big, settype):
+    """Intersect two sorted collections, driven by the keys of small.
+
+    The cursor into big only ever moves forward: it only goes back up the
+    tree when a key is past the current bucket and inside a bucket we
+    gallop from the last position.
+    """
+    result = []
+    append = result.append
+    cursor = BucketCursor(big)
+    keys = None
+    upper = None
+    for key in small:
+        if keys is None or (upper is not None and key >= upper):
+            keys = cursor.seek(key)
+            upper = cursor.upper
+            n = len(keys)
+            i = 0
+        i = gallop(keys, key, i)
+        if i < n:
+            if keys[i] == key:
+                append(key)
+                i += 1
+        elif upper is None:
+            # We are past the last key of big
+            break
+    return buildset(settype, result)
+
+
+def galloping_weightedIntersection(small, big, buckettype, wsmall, wbig):
+    """Like galloping_intersection, adding up the weighted values.
+
+    Returns a bucket like the stock weightedIntersection, the members of a
+    set count as a value of 1.
+    """
+    result = []
+    scores = []
+    cursor = BucketCursor(big)
+    mapping = cursor.mapping
+    if ismapping(small):
+        items = small.iteritems()
+    else:
+        items = ((key, 1) for key in small)
+    keys = None
+    upper = None
+    for key, value in items:
+        if keys is None or (upper is not None and key >= upper):
+            keys = cursor.seek(key)
+            values = cursor.values
+            upper = cursor.upper
+            n = len(keys)
+            i = 0
+        i = gallop(keys, key, i)
+        if i < n:
+            if keys[i] == key:
+                result.append(key)
+                if mapping:
+                    scores.append(wsmall * value + wbig * values[i])
+                else:
+                    scores.append(wsmall * value + wbig)
+                i += 1
+        elif upper is None:
+            break
+    return 1, buildbucket(buckettype, result, scores)
+
+
+def walking_difference(o1, o2, settype, buckettype):
+    """Compute the difference of o1 and o2, a bucket of o1 at a time.
+
+    For every bucket of o1 the cursor only visits the buckets of o2 which
+    overlap with its keys, and skips the others. Inside each overlap we
+    loop over the side with fewer keys. The keys of o1 are copied in slices
+    between the keys to remove. Returns a bucket if o1 is a mapping, like
+    the stock difference.
+    """
+    mapping = ismapping(o1)
+    keys = []
+    values = []
+    cursor = BucketCursor(o2)
+    for bkeys, bvalues in iterbuckets(o1):
+        n = len(bkeys)
+        if not n:
+            continue
+        hi = bkeys[-1]
+        start = 0
+        key = bkeys[0]
+        while True:
+            okeys = cursor.seek(key)
+            upper = cursor.upper
+            # The keys of o2 in okeys[i:j] and of o1 in bkeys[first:end]
+            # overlap
+            i = bisect_left(okeys, key)
+            j = bisect_right(okeys, hi)
+            if upper is None or upper > hi:
+                end = n
+            else:
+                end = bisect_left(bkeys, upper, start)
+            first = bisect_left(bkeys, key, start, end)
+            if j - i <= end - first:
+                for x in xrange(i, j):
+                    p = bisect_left(bkeys, okeys[x], first, end)
+                    if p < end and bkeys[p] == okeys[x]:
+                        keys.extend(bkeys[start:p])
+                        if mapping:
+                            values.extend(bvalues[start:p])
+                        start = first = p + 1
+            else:
+                for p in xrange(first, end):
+                    i = bisect_left(okeys, bkeys[p], i, j)
+                    if i < j and okeys[i] == bkeys[p]:
+                        keys.extend(bkeys[start:p])
+                        if mapping:
+                            values.extend(bvalues[start:p])
+                        start = p + 1
+            if end >= n:
+                break
+            # Skip the buckets of o2 before the next key of o1
+            key = bkeys[end]
+        keys.extend(bkeys[start:])
+        if mapping:
+            values.extend(bvalues[start:])
+    if mapping:
+        return buildbucket(buckettype, keys, values)
+    return buildset(settype, keys)
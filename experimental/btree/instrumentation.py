@@ -0,0 +1,108 @@
+"""Opt-in statistics about the calls of the patched set operations.
+
+With `setpatches.apply(instrument=True)` every patched function records,
+per operation and calling module, which strategy each call took, the sizes
+of the operands and how long it took. Sizes and latencies are counted in
+power of two histograms. Recording can be switched off and on at runtime,
+when it's off a call only costs an extra check of a flag.
+"""
+from threading import Lock
+from timeit import default_timer
+
+from experimental.btree.buckets import estimate_size
+
+enabled = False
+
+_lock = Lock()
+_stats = {}
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def bucket(n):
+    # The power of two histogram bucket n falls into
+    b = 1
+    while b < n:
+        b <<= 1
+    return b
+
+
+def _size(o):
+    if o is None:
+        return 0
+    return estimate_size(o)
+
+
+def record(operation, caller, path, o1, o2, elapsed):
+    n1 = bucket(_size(o1))
+    n2 = bucket(_size(o2))
+    # Latency in microseconds
+    latency = bucket(int(elapsed * 1000000))
+    _lock.acquire()
+    try:
+        stats = _stats.get((operation, caller))
+        if stats is None:
+            stats = _stats[operation, caller] = dict(
+                calls=0, time=0.0, paths={}, o1={}, o2={}, latency={})
+        stats['calls'] += 1
+        stats['time'] += elapsed
+        for name, key in (('paths', path), ('o1', n1), ('o2', n2),
+                          ('latency', latency)):
+            histogram = stats[name]
+            histogram[key] = histogram.get(key, 0) + 1
+    finally:
+        _lock.release()
+
+
+def instrumented(operation, caller, func):
+    """Wrap func, which takes a path list to append its strategy to."""
+    def wrapper(o1, o2, *args, **kw):
+        if not enabled:
+            return func(o1, o2, *args, **kw)
+        path = []
+        start = default_timer()
+        result = func(o1, o2, path=path, *args, **kw)
+        elapsed = default_timer() - start
+        record(operation, caller, path and path[0] or 'merge', o1, o2,
+               elapsed)
+        return result
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+
+def snapshot():
+    """Return a copy of the statistics.
+
+    They are returned as a dictionary of operation names to dictionaries of
+    calling modules to their statistics: the number of calls, their total
+    time, the number of calls per strategy and histograms of the sizes of
+    both operands and the latency in microseconds.
+    """
+    result = {}
+    _lock.acquire()
+    try:
+        for (operation, caller), stats in _stats.items():
+            copy = dict(calls=stats['calls'], time=stats['time'])
+            for name in ('paths', 'o1', 'o2', 'latency'):
+                copy[name] = stats[name].copy()
+            result.setdefault(operation, {})[caller] = copy
+    finally:
+        _lock.release()
+    return result
+
+
+def reset():
+    """Forget all statistics."""
+    _lock.acquire()
+    try:
+        _stats.clear()
+    finally:
+        _lock.release()
@@ -15,7 +15,8 @@ cpdef object ciiintersection(object o1, object o2):
         return iiintersection(o1, o2)
 
     cdef bool s1, s2
-    cdef object small, big, new, ins, has
+    cdef object small, big, new, has
+    cdef list keys
 
     s1 = type(o1) is IISet
     s2 = type(o2) is IISet
@@ -36,11 +37,140 @@ cpdef object ciiintersection(object o1, object o2):
         else:
             return iiintersection(o1, o2)
 
-        new = IISet()
-        ins = new.insert
+        # Collect the keys in order and build the set in one step
+        keys = []
         has = big.has_key
         for i in small:
             if has(i):
-                ins(i)
+                keys.append(i)
+        new = IISet()
+        if keys:
+            new.__setstate__((tuple(keys), ))
         return new
     return iiintersection(o1, o2)
+
+
+from BTrees._IOBTree import intersection as iointersection
+from BTrees._IOBTree import IOSet
+from BTrees._LFBTree import intersection as lfintersection
+from BTrees._LFBTree import LFSet
+from BTrees._LLBTree import intersection as llintersection
+from BTrees._LLBTree import LLSet
+from BTrees._LOBTree import intersection as lointersection
+from BTrees._LOBTree import LOSet
+from BTrees._OIBTree import intersection as oiintersection
+from BTrees._OIBTree import OISet
+from BTrees._OOBTree import intersection as oointersection
+from BTrees._OOBTree import OOSet
+
+include "keys.pxi"
+
+
+cdef object _intersection(object o1, object o2, object settype,
+                          object setintersection, bint merge):
+    if o1 is None:
+        return o2
+    if o2 is None:
+        return o1
+
+    if not o2 or not o1:
+        return setintersection(o1, o2)
+
+    cdef bool s1, s2
+    cdef object small, big, new
+    cdef list keys
+
+    s1 = type(o1) is settype
+    s2 = type(o2) is settype
+
+    if s1 and s2:
+        return setintersection(o1, o2)
+    elif s1 and len(o1) < SMALLSETSIZE:
+        small = o1
+        big = o2
+    elif s2 and len(o2) < SMALLSETSIZE:
+        small = o2
+        big = o1
+    else:
+        return setintersection(o1, o2)
+
+    keys = _probe_keys(small, big, True, merge)
+    new = settype()
+    if keys:
+        new.__setstate__((tuple(keys), ))
+    return new
+
+
+cpdef object ciointersection(object o1, object o2):
+    return _intersection(o1, o2, IOSet, iointersection, False)
+
+
+cpdef object coiintersection(object o1, object o2):
+    return _intersection(o1, o2, OISet, oiintersection, True)
+
+
+cpdef object coointersection(object o1, object o2):
+    return _intersection(o1, o2, OOSet, oointersection, True)
+
+
+cpdef object cllintersection(object o1, object o2):
+    return _intersection(o1, o2, LLSet, llintersection, False)
+
+
+cpdef object clointersection(object o1, object o2):
+    return _intersection(o1, o2, LOSet, lointersection, False)
+
+
+cpdef object clfintersection(object o1, object o2):
+    return _intersection(o1, o2, LFSet, lfintersection, False)
+
+
+cimport cython
+from cpython cimport array
+from cpython.tuple cimport PyTuple_GET_ITEM
+import array
+
+cdef array.array _iiarray = array.array('i')
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef ciiextend(array.array keys, tuple items, Py_ssize_t start,
+                Py_ssize_t stop):
+    """Append items[start:stop], a slice of a bucket state, to keys."""
+    cdef Py_ssize_t i, n = len(keys)
+    if stop <= start:
+        return
+    array.resize_smart(keys, n + stop - start)
+    cdef int *data = keys.data.as_ints + n
+    for i in range(start, stop):
+        data[i - start] = PyInt_AS_LONG(<object>PyTuple_GET_ITEM(items, i))
+
+
+cdef Py_ssize_t _merge(int *a, Py_ssize_t na, int *b, Py_ssize_t nb,
+                       int *out) nogil:
+    cdef Py_ssize_t i = 0, j = 0, n = 0
+    while i < na and j < nb:
+        if a[i] < b[j]:
+            i += 1
+        elif b[j] < a[i]:
+            j += 1
+        else:
+            out[n] = a[i]
+            n += 1
+            i += 1
+            j += 1
+    return n
+
+
+cpdef array.array ciimerge(array.array a, array.array b):
+    """Intersect two sorted arrays of keys, without holding the GIL."""
+    cdef Py_ssize_t n, na = len(a), nb = len(b)
+    cdef array.array result = array.clone(_iiarray, min(na, nb), False)
+    cdef int *pa = a.data.as_ints
+    cdef int *pb = b.data.as_ints
+    cdef int *pr = result.data.as_ints
+    with nogil:
+        n = _merge(pa, na, pb, nb, pr)
+    array.resize(result, n)
+    return result
@@ -0,0 +1,139 @@
+# Shared by the compiled intersection and difference of the IO, OI, OO and L
+# families. Their kernels look up the keys of the small operand, which are
+# sorted, in the big one. The keys outside the range of big are decided by
+# comparing them to its smallest and largest key with the typed comparison
+# below.
+#
+# BTrees compares object keys with the generic rich comparison, so for the
+# OI and OO families runs of close keys inside the range are merged with
+# the keys of big, with the same typed comparison. The integer keys of the
+# other families are compared in C by has_key already, and walking them
+# would box every one of them, so they are still probed.
+
+from cpython.int cimport PyInt_AS_LONG
+from cpython.object cimport Py_LT, Py_TYPE, PyObject_RichCompareBool
+from cpython.object cimport PyTypeObject, richcmpfunc
+from cpython.string cimport PyString_AS_STRING, PyString_GET_SIZE
+from libc.string cimport memcmp
+
+# How keys of the type of the first key are compared
+DEF KEY_STR = 1
+DEF KEY_INT = 2
+DEF KEY_SLOT = 3
+DEF KEY_ANY = 4
+
+# How far the keys of big are walked to the next key of small, and the
+# most keys of small probed before walking again
+DEF MERGESTEPS = 8
+DEF MAXSKIP = 128
+
+
+cdef struct keycompare:
+    int kind
+    PyTypeObject *type
+    richcmpfunc slot
+
+
+cdef inline void _lookup(keycompare *c, object key):
+    # Look up the comparison of the type of key once for all keys
+    c.type = Py_TYPE(key)
+    c.slot = c.type.tp_richcompare
+    if type(key) is str:
+        c.kind = KEY_STR
+    elif type(key) is int:
+        c.kind = KEY_INT
+    elif c.slot is not NULL:
+        c.kind = KEY_SLOT
+    else:
+        c.kind = KEY_ANY
+
+
+cdef inline int _lt(keycompare *c, object a, object b) except -1:
+    # a < b, with the same result as the builtin comparison
+    cdef Py_ssize_t la, lb
+    cdef int r
+    cdef object result
+    if Py_TYPE(a) is not c.type or Py_TYPE(b) is not c.type:
+        return PyObject_RichCompareBool(a, b, Py_LT)
+    if c.kind == KEY_STR:
+        la = PyString_GET_SIZE(a)
+        lb = PyString_GET_SIZE(b)
+        r = memcmp(PyString_AS_STRING(a), PyString_AS_STRING(b),
+                   la if la < lb else lb)
+        if r == 0:
+            return la < lb
+        return r < 0
+    if c.kind == KEY_INT:
+        return PyInt_AS_LONG(a) < PyInt_AS_LONG(b)
+    if c.kind == KEY_SLOT:
+        result = c.slot(a, b, Py_LT)
+        if result is not NotImplemented:
+            return bool(result)
+    return PyObject_RichCompareBool(a, b, Py_LT)
+
+
+cdef list _probe_keys(object small, object big, bint keep, bint merge):
+    # The keys of small which are in big if keep is true, or which aren't
+    # if keep is false. big must not be empty.
+    #
+    # If merge is true and big is a tree, the keys of big are walked from
+    # the first key of small on by an iterator of big.keys(), in step with
+    # the keys of small. If a key of small is more than MERGESTEPS keys of
+    # big away, the iterator is dropped, and the next keys are probed with
+    # has_key. The number of probed keys doubles with every further miss,
+    # up to MAXSKIP, so scattered keys cost little more than probing.
+    cdef keycompare c
+    cdef list result = []
+    cdef object key, lo, hi, has, it = None, current = None
+    cdef bint past = False
+    cdef int steps, skip = 0, backoff = 0
+    has = big.has_key
+    lo = big.minKey()
+    hi = big.maxKey()
+    _lookup(&c, lo)
+    if not hasattr(big, '_check'):
+        # The keys() of sets and buckets copy the keys
+        merge = False
+    for key in small:
+        if past or _lt(&c, key, lo):
+            found = False
+        elif _lt(&c, hi, key):
+            # This and all following keys are past the last key of big
+            if keep:
+                break
+            past = True
+            found = False
+        elif not merge:
+            found = has(key)
+        else:
+            if it is not None:
+                steps = 0
+                while _lt(&c, current, key):
+                    if steps == MERGESTEPS:
+                        it = None
+                        backoff = backoff * 2 or 1
+                        if backoff > MAXSKIP:
+                            backoff = MAXSKIP
+                        skip = backoff
+                        break
+                    # key <= hi, there is always a next key
+                    current = next(it)
+                    steps += 1
+                else:
+                    backoff = 0
+            if it is not None:
+                found = not _lt(&c, key, current)
+            elif skip:
+                skip -= 1
+                found = has(key)
+            else:
+                # Starts at the first key of big which isn't smaller
+                it = iter(big.keys(key))
+                current = next(it)
+                found = not _lt(&c, key, current)
+        if found:
+            if keep:
+                result.append(key)
+        elif not keep:
+            result.append(key)
+    return result
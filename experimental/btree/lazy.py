@@ -0,0 +1,165 @@
+"""Intersection and difference results which are computed on demand.
+
+A search with a sort limit or a batch only looks at the first few keys of
+a result. The lazy results step a cursor through the bigger operand while
+they are iterated and only compute as many keys as were asked for.
+"""
+from BTrees._IIBTree import difference as iidifference
+from BTrees._IIBTree import intersection as iiintersection
+from BTrees._IIBTree import IIBucket
+from BTrees._IIBTree import IISet
+
+from experimental.btree.buckets import BucketCursor
+from experimental.btree.buckets import buildbucket
+from experimental.btree.buckets import buildset
+from experimental.btree.buckets import estimate_size
+from experimental.btree.buckets import ismapping
+from experimental.btree.galloping import gallop
+
+
+def matches(keys, other, keep=True):
+    # Yield the keys which are in other if keep is true, or the keys which
+    # aren't if keep is false. keys must be sorted.
+    cursor = BucketCursor(other)
+    bkeys = None
+    upper = None
+    for key in keys:
+        if bkeys is None or (upper is not None and key >= upper):
+            bkeys = cursor.seek(key)
+            upper = cursor.upper
+            n = len(bkeys)
+            i = 0
+        i = gallop(bkeys, key, i)
+        if i < n and bkeys[i] == key:
+            if keep:
+                yield key
+        elif not keep:
+            yield key
+        elif upper is None and i >= n:
+            # We are past the last key of other
+            return
+
+
+class LazyResult(object):
+    """A sorted sequence of keys, computed as far as it's used."""
+
+    def __init__(self, keys, other, keep, size, settype):
+        self.settype = settype
+        self._matches = matches(self._count(keys), other, keep)
+        self._keys = []
+        self._done = False
+        # The number of candidate keys and how many of them we looked at
+        self._size = size
+        self._seen = 0
+
+    def _count(self, keys):
+        for key in keys:
+            self._seen += 1
+            yield key
+
+    def _fill(self, n=None):
+        # Compute the keys up to position n, or all of them
+        keys = self._keys
+        append = keys.append
+        for key in self._matches:
+            append(key)
+            if n is not None and len(keys) > n:
+                return
+        self._done = True
+
+    def __iter__(self):
+        keys = self._keys
+        i = 0
+        while True:
+            if i >= len(keys):
+                if self._done:
+                    return
+                self._fill(i)
+                continue
+            yield keys[i]
+            i += 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if (index.stop is None or index.stop < 0 or
+                (index.start is not None and index.start < 0)):
+                self._fill()
+            elif not self._done:
+                self._fill(index.stop)
+        elif index < 0:
+            self._fill()
+        elif not self._done:
+            self._fill(index)
+        return self._keys[index]
+
+    def __nonzero__(self):
+        if not self._keys and not self._done:
+            self._fill(0)
+        return bool(self._keys)
+
+    def __len__(self):
+        if not self._done:
+            self._fill()
+        return len(self._keys)
+
+    def estimate(self):
+        """Estimate the number of keys without computing all of them."""
+        if self._done:
+            return len(self._keys)
+        if not self._seen:
+            return self._size
+        # Extrapolate from the candidates we looked at so far
+        ratio = float(len(self._keys)) / self._seen
+        return max(len(self._keys), int(self._size * ratio))
+
+    def materialize(self):
+        """Compute all keys and return them as a real set."""
+        if not self._done:
+            self._fill()
+        return buildset(self.settype, self._keys)
+
+
+class LazyIntersection(LazyResult):
+
+    def __init__(self, o1, o2, settype=IISet):
+        n1 = estimate_size(o1)
+        n2 = estimate_size(o2)
+        # Step through the smaller one, gallop through the bigger one
+        if n1 <= n2:
+            LazyResult.__init__(self, o1, o2, True, n1, settype)
+        else:
+            LazyResult.__init__(self, o2, o1, True, n2, settype)
+
+
+class LazyDifference(LazyResult):
+
+    def __init__(self, o1, o2, settype=IISet, buckettype=IIBucket):
+        LazyResult.__init__(self, o1, o2, False, estimate_size(o1), settype)
+        self.buckettype = buckettype
+        self.o1 = o1
+
+    def materialize(self):
+        """Compute all keys and return them as a real set, or as a bucket
+        if the first operand is a mapping like the stock difference does.
+        """
+        if not ismapping(self.o1):
+            return LazyResult.materialize(self)
+        if not self._done:
+            self._fill()
+        get = self.o1.get
+        return buildbucket(self.buckettype, self._keys,
+                           [get(key) for key in self._keys])
+
+
+def lazyintersection(o1, o2):
+    """Intersect two IIBTree family objects on demand."""
+    if o1 is None or o2 is None:
+        return iiintersection(o1, o2)
+    return LazyIntersection(o1, o2)
+
+
+def lazydifference(o1, o2):
+    """Compute the difference of two IIBTree family objects on demand."""
+    if o1 is None or o2 is None:
+        return iidifference(o1, o2)
+    return LazyDifference(o1, o2)
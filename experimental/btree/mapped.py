@@ -0,0 +1,212 @@
+"""Binary files of sorted integer keys, read through mmap.
+
+`dump` writes the keys of a set, tree set, bucket or tree of the integer
+families as one contiguous little-endian array, after a small header::
+
+  from experimental.btree import mapped
+  mapped.dump(catalog._catalog.indexes['path']._unindex, '/tmp/path.keys')
+
+`load` maps such a file read-only and returns a `MappedSet`. It's a sorted
+sequence view on the file: keys are only unpacked as they are read, and
+with NumPy `asarray` returns them as an array on the mapped memory without
+copying anything. The patched `intersection` and `difference` accept a
+`MappedSet` for either operand. `toset` builds a set or a complete tree set
+from it, tree sets are bulk loaded with `buckets.buildtree`.
+"""
+import mmap
+import struct
+from bisect import bisect_left
+
+from experimental.btree import vectorized as vector
+from experimental.btree.buckets import buildbucket
+from experimental.btree.buckets import buildset
+from experimental.btree.buckets import estimate_size
+from experimental.btree.buckets import ismapping
+from experimental.btree.buckets import iterbuckets
+
+MAGIC = 'EXBTKEYS'
+VERSION = 1
+# Magic, version, family, padding to align the keys and the number of keys
+HEADER = struct.Struct('<8sH2s12xQ')
+
+# The struct format and NumPy type of the keys, by the key type
+FORMATS = {'I': 'i', 'L': 'q'}
+DTYPES = {'I': '<i4', 'L': '<i8'}
+
+# How many keys are unpacked at once while iterating
+CHUNKSIZE = 4096
+
+
+def dump(o, path):
+    """Write the keys of o to a file, path can be a file name or object.
+
+    Only the keys of a mapping are written, not its values.
+    """
+    family = type(o).__name__[:2]
+    if family[0] not in FORMATS:
+        raise ValueError('%s has no integer keys' % type(o).__name__)
+    code = '<%%d%s' % FORMATS[family[0]]
+    if isinstance(path, basestring):
+        f = open(path, 'wb')
+    else:
+        f = path
+    try:
+        # The number of keys is only known at the end
+        start = f.tell()
+        f.write(HEADER.pack(MAGIC, VERSION, family, 0))
+        count = 0
+        for keys, values in iterbuckets(o):
+            f.write(struct.pack(code % len(keys), *keys))
+            count += len(keys)
+        end = f.tell()
+        f.seek(start)
+        f.write(HEADER.pack(MAGIC, VERSION, family, count))
+        f.seek(end)
+    finally:
+        if f is not path:
+            f.close()
+    return count
+
+
+def load(path):
+    """Map a file written by dump, see `MappedSet`."""
+    return MappedSet(path)
+
+
+class MappedSet(object):
+    """A read-only, sorted set of the keys in a file written by dump."""
+
+    def __init__(self, path):
+        f = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            # The map keeps its own reference to the file
+            f.close()
+        magic, version, family, count = HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != VERSION:
+            self._map.close()
+            raise ValueError('%s is not a key file' % path)
+        self.family = family
+        self._count = count
+        self._code = FORMATS[family[0]]
+        self._width = struct.calcsize(self._code)
+        if len(self._map) < HEADER.size + count * self._width:
+            self._map.close()
+            raise ValueError('%s is truncated' % path)
+
+    def close(self):
+        self._map.close()
+
+    def __len__(self):
+        return self._count
+
+    def __nonzero__(self):
+        return self._count > 0
+
+    def _unpack(self, start, stop):
+        return struct.unpack_from('<%d%s' % (stop - start, self._code),
+                                  self._map, HEADER.size + start * self._width)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self._count)
+            keys = self._unpack(start, max(start, stop))
+            if step != 1:
+                keys = keys[::step]
+            return keys
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError(i)
+        return self._unpack(i, i + 1)[0]
+
+    def __iter__(self):
+        for start in xrange(0, self._count, CHUNKSIZE):
+            for key in self._unpack(start, min(start + CHUNKSIZE,
+                                               self._count)):
+                yield key
+
+    def keys(self):
+        return self
+
+    def __contains__(self, key):
+        i = bisect_left(self, key)
+        return i < self._count and self[i] == key
+
+    has_key = __contains__
+
+    def minKey(self):
+        if not self._count:
+            raise ValueError('empty set')
+        return self[0]
+
+    def maxKey(self):
+        if not self._count:
+            raise ValueError('empty set')
+        return self[-1]
+
+    def __repr__(self):
+        return '<%s of %d %s keys>' % (self.__class__.__name__, self._count,
+                                       self.family)
+
+    def asarray(self):
+        """Return the keys as a NumPy array on the mapped memory."""
+        import numpy
+        return numpy.frombuffer(self._map, DTYPES[self.family[0]],
+                                self._count, HEADER.size)
+
+    def toset(self, settype):
+        """Return the keys as a set or tree set of settype."""
+        return buildset(settype, self[:])
+
+
+def _keyarray(o):
+    if isinstance(o, MappedSet):
+        return o.asarray()
+    return vector.keyarray(o)
+
+
+def intersection(o1, o2, settype):
+    """Intersect a MappedSet and a MappedSet or an object of the same
+    family. The result is a set of settype.
+    """
+    if o1 is None:
+        return o2
+    if o2 is None:
+        return o1
+    small, big = o1, o2
+    if estimate_size(small) > estimate_size(big):
+        small, big = big, small
+    if vector.HAS_NUMPY and isinstance(big, MappedSet):
+        # Only the keys of small are copied
+        keys = _keyarray(small)
+        pos, found = vector.positions(keys, big.asarray())
+        return buildset(settype, keys[found].tolist())
+    has = big.has_key
+    return buildset(settype, [k for k in small.keys() if has(k)])
+
+
+def difference(o1, o2, settype, buckettype):
+    """Subtract a MappedSet from an object of the same family or the other
+    way around. The result is a set of settype, or a bucket of buckettype
+    with the values of a mapping o1.
+    """
+    if o1 is None or o2 is None:
+        return o1
+    if vector.HAS_NUMPY:
+        keys = _keyarray(o1)
+        pos, found = vector.positions(keys, _keyarray(o2))
+        missing = ~found
+        if not isinstance(o1, MappedSet):
+            values = vector.valuearray(o1)
+            if values is not None:
+                return buildbucket(buckettype, keys[missing].tolist(),
+                                   values[missing].tolist())
+        return buildset(settype, keys[missing].tolist())
+    has = o2.has_key
+    if ismapping(o1):
+        items = [(k, v) for k, v in o1.iteritems() if not has(k)]
+        return buildbucket(buckettype, [k for k, v in items],
+                           [v for k, v in items])
+    return buildset(settype, [k for k in o1.keys() if not has(k)])
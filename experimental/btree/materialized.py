@@ -0,0 +1,217 @@
+"""Persistent, precomputed results of catalog index queries.
+
+Some index queries are expensive and asked for all the time, like a large
+path subtree or a workflow state. They can be registered by name, for an
+index id and a query::
+
+  from experimental.btree import materialized
+  materialized.register('published', 'review_state', 'published')
+
+and then built once for an index, for example in an upgrade step::
+
+  materialized.materialize(catalog.getIndex('review_state'), 'published')
+
+The result is stored as an `IITreeSet` on the index itself. With
+`setpatches.apply(materialized=True)` the indexes return it for a matching
+query instead of computing it, so it's fed straight into the intersection
+with the other results. Indexing and unindexing a document updates all sets
+stored on the index, according to the `belongs` function of their
+registration. The default one compares the values field and keyword
+indexes store to the query, registrations for path and date indexes have
+to pass their own. Clearing an index removes its sets, materialize them
+again after a reindex.
+
+Sets of queries whose result changes by the passage of time alone, like the
+currently effective documents of a `DateRangeIndex`, can't be kept up to
+date by indexing. Rebuild them with `materialize` from time to time.
+"""
+from logging import getLogger
+
+from BTrees.IIBTree import IITreeSet
+from BTrees.OOBTree import OOBTree
+
+from experimental.btree.buckets import buildtree
+
+logger = getLogger('experimental.btree')
+
+# The registrations by index id and name
+_registry = {}
+
+# How full the buckets of a new set are
+FILL = 0.7
+
+# Indexes whose stored values can't be compared to a query, a path is in
+# the result of its parents and dates are converted. Their registrations
+# need a belongs function.
+UNSUPPORTED = ('DateIndex', 'DateRangeIndex', 'PathIndex',
+               'ExtendedPathIndex')
+
+
+def normalize(value):
+    # Make a query value comparable, {'query': x} and [x] ask for x
+    if hasattr(value, 'keys'):
+        keys = list(value.keys())
+        if keys == ['query']:
+            return normalize(value['query'])
+        return tuple(sorted((k, normalize(value[k])) for k in keys))
+    if isinstance(value, (list, tuple)):
+        if len(value) == 1:
+            return normalize(value[0])
+        return tuple(normalize(v) for v in value)
+    return value
+
+
+def default_belongs(index, documentId, query):
+    """Whether the document is in the result, by the values the index stores
+    for it. Works for field and keyword indexes.
+    """
+    value = index._unindex.get(documentId)
+    if value is None:
+        return False
+    query = normalize(query)
+    if isinstance(value, (list, tuple)):
+        if isinstance(query, tuple):
+            return bool(set(value).intersection(query))
+        return query in value
+    if isinstance(query, tuple):
+        return value in query
+    return value == query
+
+
+class Registration(object):
+
+    def __init__(self, name, index, query, belongs=None, matches=None):
+        self.name = name
+        self.index = index
+        self.query = query
+        self.belongs = belongs or default_belongs
+        self.key = normalize(query)
+        self._matches = matches
+
+    def matches(self, value):
+        if self._matches is not None:
+            return self._matches(value)
+        return normalize(value) == self.key
+
+
+def check(index, belongs):
+    # Refuse the default belongs for the indexes it gets wrong
+    meta_type = getattr(index, 'meta_type', None)
+    if belongs in (None, default_belongs) and meta_type in UNSUPPORTED:
+        raise ValueError('A set on a %s needs a belongs function' % meta_type)
+
+
+def register(name, index, query, belongs=None, matches=None):
+    """Register a materialized set.
+
+    name identifies the set, index is the index it's stored on or its id and
+    query the value of that index in a catalog query which computes it.
+    belongs(index, documentId, query) tells whether a document is in the
+    set after it was indexed, it defaults to comparing the values a field or
+    keyword index stores. It has to be given for the indexes in
+    UNSUPPORTED, this is checked here if index is passed, otherwise by
+    `materialize`. matches(value) tells whether a query value asks for the
+    set, it defaults to comparing it to query.
+    """
+    if not isinstance(index, basestring):
+        check(index, belongs)
+        index = index.getId()
+    _registry.setdefault(index, {})[name] = Registration(
+        name, index, query, belongs, matches)
+
+
+def unregister(name):
+    for registrations in _registry.values():
+        registrations.pop(name, None)
+
+
+def registrations(index):
+    return _registry.get(index.getId(), {})
+
+
+def stored(index):
+    # The materialized sets stored on the index, without acquiring them
+    return getattr(getattr(index, 'aq_base', index), '_materialized', None)
+
+
+def used(index):
+    # The attributes the index reports to have used, a DateRangeIndex
+    # reads two
+    since = getattr(index, '_since_field', None)
+    if since is not None:
+        return since, index._until_field
+    return (index.getId(), )
+
+
+def materialize(index, name):
+    """Compute the set of a registration and store it on index."""
+    registration = registrations(index)[name]
+    check(index, registration.belongs)
+    # Compute it, even if it's stored already
+    apply_index = getattr(index, '_old__apply_index', index._apply_index)
+    result = apply_index({index.getId(): registration.query})
+    if result is None or result[0] is None:
+        keys = IITreeSet()
+    else:
+        # Leave room in the buckets for the updates
+        keys = buildtree(IITreeSet, result[0].keys(), fill=FILL)
+    sets = stored(index)
+    if sets is None:
+        sets = index._materialized = OOBTree()
+    sets[name] = keys
+    logger.debug('Materialized %s on %s' % (name, index.getId()))
+    return keys
+
+
+def discard(index, name=None):
+    """Remove a set, or all sets, from index."""
+    sets = stored(index)
+    if sets is None:
+        return
+    if name is None:
+        sets.clear()
+    elif name in sets:
+        del sets[name]
+
+
+def lookup(index, request):
+    """Return the stored set which answers the request, or None."""
+    sets = stored(index)
+    if not sets:
+        return None
+    value = request.get(index.getId())
+    if value is None:
+        return None
+    for name, registration in registrations(index).items():
+        if registration.matches(value):
+            result = sets.get(name)
+            if result is not None:
+                return result
+    return None
+
+
+def update(index, documentId):
+    """Update the stored sets after the document was indexed."""
+    sets = stored(index)
+    if not sets:
+        return
+    found = registrations(index)
+    for name, keys in sets.items():
+        registration = found.get(name)
+        if registration is None:
+            continue
+        if registration.belongs(index, documentId, registration.query):
+            if not keys.has_key(documentId):
+                keys.insert(documentId)
+        elif keys.has_key(documentId):
+            keys.remove(documentId)
+
+
+def remove(index, documentId):
+    """Remove the document from the stored sets after it was unindexed."""
+    sets = stored(index)
+    if not sets:
+        return
+    for keys in sets.values():
+        if keys.has_key(documentId):
+            keys.remove(documentId)
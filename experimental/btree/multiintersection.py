@@ -0,0 +1,51 @@
+from BTrees._IIBTree import intersection as iiintersection
+from BTrees._IIBTree import IISet
+
+from experimental.btree.buckets import buildset
+from experimental.btree.buckets import estimate_size
+from experimental.btree.setpatches import SMALLSETSIZE
+
+
+def order(sets):
+    # Estimating the size of a tree only reads its upper levels, the
+    # position keeps the sort stable and away from the sets themselves
+    sizes = [(estimate_size(o), i, o) for i, o in enumerate(sets)]
+    sizes.sort()
+    return [o for size, i, o in sizes], sizes[0][0]
+
+
+def _multiintersection(sets, settype, setintersection):
+    sets = [o for o in sets if o is not None]
+    if not sets:
+        return None
+    if len(sets) == 1:
+        return sets[0]
+
+    for o in sets:
+        if not o:
+            return settype()
+
+    sets, smallest = order(sets)
+    if smallest < SMALLSETSIZE:
+        # Probe the keys of the smallest set against all the others, in
+        # order of increasing size, without building intermediate sets.
+        keys = list(sets[0])
+        for o in sets[1:]:
+            has = o.has_key
+            keys = [i for i in keys if has(i)]
+            if not keys:
+                break
+        return buildset(settype, keys)
+
+    # All sets are large, let the C merge do the work, but still start with
+    # the smallest ones and stop as soon as nothing is left.
+    result = sets[0]
+    for o in sets[1:]:
+        result = setintersection(result, o)
+        if not result:
+            break
+    return result
+
+
+def multiintersection(*sets):
+    return _multiintersection(sets, IISet, iiintersection)
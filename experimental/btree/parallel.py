@@ -0,0 +1,110 @@
+"""Intersection of very large IIBTree family operands in a thread pool.
+
+Both operands are split into the same key ranges, at the bucket boundaries
+given by the root of the bigger one. The calling thread copies the keys of
+every range into arrays, as it's the only one which may load buckets from
+its ZODB connection, and hands them to the pool right away. The workers
+intersect them in a compiled loop which releases the GIL, so copying the
+next range overlaps with merging the previous ones. The partial results are
+sorted and disjoint, they are concatenated in order.
+"""
+from array import array
+from bisect import bisect_left
+from itertools import izip
+from threading import Lock
+
+from experimental.btree.buckets import buildset
+from experimental.btree.buckets import istree
+from experimental.btree.buckets import iterbuckets
+
+# The number of threads in the pool, None for one per CPU
+WORKERS = None
+# How many ranges we aim for per worker
+RANGES = 4
+
+_pool = None
+_pool_lock = Lock()
+
+
+def workers():
+    if WORKERS is not None:
+        return WORKERS
+    try:
+        from multiprocessing import cpu_count
+        return cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+def pool():
+    global _pool
+    _pool_lock.acquire()
+    try:
+        if _pool is None:
+            from multiprocessing.pool import ThreadPool
+            _pool = ThreadPool(workers())
+        return _pool
+    finally:
+        _pool_lock.release()
+
+
+def boundaries(o, n):
+    """Return at most n - 1 keys which split o into ranges.
+
+    Every boundary is the first key of a bucket. Only the root of o is read.
+    """
+    if not istree(o):
+        return []
+    state = o.__getstate__()
+    if state is None or len(state) == 1:
+        return []
+    separators = state[0][1::2]
+    step = max(len(separators) // n, 1)
+    return list(separators[step - 1::step][:n - 1])
+
+
+def split(o, bounds):
+    """Yield the keys of o as arrays, one per range between the bounds.
+
+    The first range holds the keys below bounds[0], the last one the keys
+    from bounds[-1] on. The keys are copied out of the bucket states.
+    """
+    from experimental.btree.intersection import ciiextend
+    i = 0
+    keys = array('i')
+    for items, values in iterbuckets(o):
+        start = 0
+        n = len(items)
+        while i < len(bounds) and n and items[-1] >= bounds[i]:
+            stop = bisect_left(items, bounds[i], start)
+            ciiextend(keys, items, start, stop)
+            yield keys
+            keys = array('i')
+            start = stop
+            i += 1
+        ciiextend(keys, items, start, n)
+    yield keys
+    # Empty ranges past the last key of o
+    for i in xrange(i, len(bounds)):
+        yield array('i')
+
+
+def parallel_intersection(o1, o2, settype, big=None):
+    """Intersect o1 and o2 in the pool.
+
+    The ranges are taken from big, the bigger operand, o2 if it's None.
+    """
+    from experimental.btree.intersection import ciimerge
+    if big is None:
+        big = o2
+    bounds = boundaries(big, workers() * RANGES)
+    apply_async = pool().apply_async
+    parts = []
+    # izip, as zip would copy all ranges before the first one is merged
+    for a, b in izip(split(o1, bounds), split(o2, bounds)):
+        if len(a) and len(b):
+            parts.append(apply_async(ciimerge, (a, b)))
+    keys = array('i')
+    for part in parts:
+        keys.extend(part.get())
+    return buildset(settype, keys)
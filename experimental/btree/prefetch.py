@@ -0,0 +1,90 @@
+"""Load the buckets a probing set operation needs before it probes.
+
+Probing the keys of a small operand into a big tree set loads the buckets
+of the big one as the probes reach them, one round trip to the storage
+after the other. With `setpatches.apply(prefetch=True)` the probing
+strategies first route all keys of the small operand through the interior
+nodes of the big one, a level at a time, and collect the buckets the
+probes will end up in. The ghosts among the nodes of each level and then
+among these buckets are handed to the connection's `prefetch` together, so
+a storage which supports it, like ZEO, loads them in one batch. Storages
+without it load them one by one as before.
+
+Connections before ZODB 5, like the ones of ZODB3 3.10, have no `prefetch`.
+There the ghosts are activated right away, in the order of their keys.
+That takes as many loads, but they're all done before the probes start
+and the interior nodes are still only read once per level.
+"""
+from bisect import bisect_left
+from bisect import bisect_right
+
+from experimental.btree.buckets import isghost
+from experimental.btree.buckets import istree
+
+
+def load(jar, objects):
+    """Ask jar to prefetch the ghosts among objects, returns them.
+
+    Without a `prefetch` of the jar the ghosts are loaded here.
+    """
+    ghosts = [o for o in objects if isghost(o)]
+    if ghosts:
+        prefetch = getattr(jar, 'prefetch', None)
+        if prefetch is not None:
+            prefetch(ghosts)
+        else:
+            for ghost in ghosts:
+                ghost._p_activate()
+    return ghosts
+
+
+def leaves(o, keys, jar=None):
+    """Return the buckets of the tree o which can contain the sorted keys.
+
+    Only the interior nodes are loaded, the ghosts of every level are
+    prefetched together from jar before they are read.
+    """
+    result = []
+    if not istree(o) or not len(keys):
+        return result
+    treetype = type(o)
+    state = o.__getstate__()
+    if state is None or len(state) == 1:
+        # Empty, or a single bucket stored inline
+        return result
+    # The nodes of a level, with the range of keys routed to them
+    level = [(state, 0, len(keys))]
+    while level:
+        below = []
+        for state, start, stop in level:
+            data = state[0]
+            children = data[::2]
+            separators = data[1::2]
+            i = start
+            while i < stop:
+                child = bisect_right(separators, keys[i])
+                if child < len(separators):
+                    j = bisect_left(keys, separators[child], i, stop)
+                else:
+                    j = stop
+                node = children[child]
+                if type(node) is treetype:
+                    below.append((node, i, j))
+                else:
+                    result.append(node)
+                i = j
+        if jar is not None:
+            load(jar, [node for node, i, j in below])
+        level = [(node.__getstate__(), i, j) for node, i, j in below]
+    return result
+
+
+def prefetch(o, keys):
+    """Prefetch the buckets of o the sorted keys can be in.
+
+    Returns the number of buckets which were ghosts.
+    """
+    jar = getattr(o, '_p_jar', None)
+    if jar is None:
+        return 0
+    return len(load(jar, leaves(o, keys, jar)))
@@ -0,0 +1,257 @@
+"""Answer index queries by probing the ids which are still in the result.
+
+`Catalog.search` passes the intersection of the indexes applied so far to
+the `_apply_index` of the next index, if it takes a `resultset`. The stock
+indexes still compute their whole result and leave it to the intersection
+to throw most of it away. With `setpatches.apply(probing=True)` they look
+up the values of the ids in the running result in their reverse index
+instead, once it holds fewer than `THRESHOLD` ids, or more if `querystats`
+measured that probing them takes less time than computing the result::
+
+  catalog(review_state='published', Subject=['a', 'b'],
+          effectiveRange=DateTime())
+
+A selective index in front then saves the others from loading their
+forward indexes. `evaluation.sequential` passes the running result as well.
+
+The probers are registered by index class, subclasses use the prober of
+their closest registered base class unless it was registered for the exact
+class only. A prober is called as
+prober(index, request, resultset) and returns the result of the index for
+the ids in resultset, with the ids of the indexes used, like
+`_apply_index`. It returns None for queries it doesn't handle, those are
+computed by the index as usual. The built-in ones handle plain values,
+lists of values and the `range` and `operator` options, queries with other
+options, like `not`, are left to the index.
+"""
+from timeit import default_timer
+
+from BTrees.IIBTree import IISet
+
+from experimental.btree import querystats
+from experimental.btree.buckets import buildset
+from experimental.btree.buckets import estimate_size
+
+# The largest running result which is probed
+THRESHOLD = 100
+
+# The probers by index class, and the ones not used for subclasses
+_probers = {}
+_exact = {}
+
+
+def register(indextype, prober, subclasses=True):
+    """Register prober for indextype.
+
+    With subclasses false it isn't used for subclasses, which may store
+    other values in their reverse index.
+    """
+    unregister(indextype)
+    if subclasses:
+        _probers[indextype] = prober
+    else:
+        _exact[indextype] = prober
+
+
+def unregister(indextype):
+    _probers.pop(indextype, None)
+    _exact.pop(indextype, None)
+
+
+def prober(index):
+    """Return the prober for index, or None."""
+    indextype = type(getattr(index, 'aq_base', index))
+    found = _exact.get(indextype)
+    if found is not None:
+        return found
+    for base in getattr(indextype, '__mro__', (indextype, )):
+        found = _probers.get(base)
+        if found is not None:
+            return found
+    return None
+
+
+def cheaper(index, request, n):
+    # Whether querystats expects probing n ids to take less time than
+    # computing the whole result of index
+    if not querystats.enabled:
+        return False
+    key = querystats.shape(index.getId(), request.get(index.getId()))
+    full = querystats.estimate(key)
+    probed = querystats.estimate(key + ('probe', ))
+    if full is None or probed is None or not probed[0]:
+        return False
+    return n * probed[1] / probed[0] < full[1]
+
+
+def probe(index, request, resultset):
+    """Return the result of index for request by probing the ids of
+    resultset, or None if it has to be computed by the index.
+    """
+    if resultset is None:
+        return None
+    found = prober(index)
+    if found is None:
+        return None
+    n = len(resultset)
+    if n >= THRESHOLD and not cheaper(index, request, n):
+        return None
+    if not querystats.enabled:
+        return found(index, request, resultset)
+    start = default_timer()
+    result = found(index, request, resultset)
+    if result is not None:
+        key = querystats.shape(index.getId(), request.get(index.getId()))
+        querystats.record(key + ('probe', ), n, default_timer() - start)
+    return result
+
+
+def evaluate(index, request, resultset, apply):
+    """Return the result of index for request, by probing or from apply(),
+    which computes the whole result.
+    """
+    result = probe(index, request, resultset)
+    if result is not None:
+        return result
+    if not querystats.enabled:
+        return apply()
+    start = default_timer()
+    result = apply()
+    if result is not None and result[0] is not None:
+        querystats.record(
+            querystats.shape(index.getId(), request.get(index.getId())),
+            estimate_size(result[0]), default_timer() - start)
+    return result
+
+
+def parse(index, request):
+    """Return the values, range and operator of the query for index.
+
+    Returns None if the request doesn't query index or uses options the
+    probers don't handle.
+    """
+    name = index.getId()
+    query = request.get(name)
+    if query is None:
+        return None
+    for option in ('usage', 'operator', 'range'):
+        # Options passed next to a plain value, left to parseIndexRequest
+        if request.get('%s_%s' % (name, option)) is not None:
+            return None
+    range = operator = None
+    if hasattr(query, 'keys'):
+        if [k for k in query.keys() if k not in ('query', 'range',
+                                                  'operator')]:
+            return None
+        range = query.get('range')
+        operator = query.get('operator')
+        query = query.get('query')
+        if query is None:
+            return None
+    if isinstance(query, (list, tuple)):
+        values = list(query)
+    else:
+        values = [query]
+    if not values:
+        return None
+    convert = getattr(index, '_convert', None)
+    if convert is not None:
+        values = [convert(v) for v in values]
+    return values, range, operator
+
+
+def matcher(values, range):
+    # A function telling whether a single value is asked for
+    if not range:
+        values = set(values)
+        return values.__contains__
+    lo = hi = None
+    if 'min' in range:
+        lo = min(values)
+    if 'max' in range:
+        hi = max(values)
+
+    def match(value):
+        if lo is not None and value < lo:
+            return False
+        if hi is not None and value > hi:
+            return False
+        return True
+    return match
+
+
+def select(resultset, get, match):
+    # The ids of resultset with a stored value which matches
+    keys = []
+    for documentId in resultset.keys():
+        value = get(documentId)
+        if value is not None and match(value):
+            keys.append(documentId)
+    return buildset(IISet, keys)
+
+
+def probe_field(index, request, resultset):
+    """Probe a `FieldIndex` or `DateIndex`, which store one value per id."""
+    parsed = parse(index, request)
+    if parsed is None:
+        return None
+    values, range, operator = parsed
+    if operator not in (None, 'or', 'and'):
+        return None
+    if operator == 'and' and (range or len(values) > 1):
+        # Nothing but a single value can match all of them, that's for
+        # the index to say
+        return None
+    match = matcher(values, range)
+    return select(resultset, index._unindex.get, match), (index.getId(), )
+
+
+def probe_keyword(index, request, resultset):
+    """Probe a `KeywordIndex`, which stores a sequence of values per id."""
+    parsed = parse(index, request)
+    if parsed is None:
+        return None
+    values, range, operator = parsed
+    if operator is None:
+        operator = getattr(index, 'useOperator', 'or')
+    if operator == 'and':
+        if range:
+            return None
+        values = set(values)
+
+        def match(keywords):
+            return not values.difference(keywords)
+    elif operator == 'or':
+        single = matcher(values, range)
+
+        def match(keywords):
+            for keyword in keywords:
+                if single(keyword):
+                    return True
+            return False
+    else:
+        return None
+    return select(resultset, index._unindex.get, match), (index.getId(), )
+
+
+def probe_daterange(index, request, resultset):
+    """Probe a `DateRangeIndex` for the ids effective at one date."""
+    query = request.get(index.getId())
+    if query is None or hasattr(query, 'keys'):
+        return None
+    if isinstance(query, (list, tuple)):
+        if len(query) != 1:
+            return None
+        query = query[0]
+    term = index._convertDateTime(query)
+
+    def match(value):
+        # None stands for an open end
+        since, until = value
+        if since is not None and since > term:
+            return False
+        if until is not None and until < term:
+            return False
+        return True
+    used = (index._since_field, index._until_field)
+    return select(resultset, index._unindex.get, match), used
@@ -0,0 +1,212 @@
+"""Statistics about index queries and set operations, learned as they run.
+
+With `setpatches.apply(statistics=True)` every index that computes its
+result records its size and how long it took, keyed by the shape of its
+query: the index id and the options and form of the query, not its values.
+Probing an index records the time per probed id. Every patched
+intersection and difference records what the cost model estimated for the
+strategy it picked and how long it actually took.
+
+The statistics are used before the sizes they describe are known:
+
+- `evaluation.sequential` starts with the indexes which returned the
+  smallest results so far.
+- `probing` probes a running result of any size if that took less time
+  than computing the whole result of the index.
+- The cost model corrects its estimate for every strategy by the ratio of
+  the measured to the estimated time.
+
+Older measurements count less and less, their weight halves every
+`HALFLIFE` seconds. The statistics can be dumped to and loaded from a JSON
+file, to keep them over restarts::
+
+  from experimental.btree import querystats
+  querystats.dump('/var/tmp/querystats.json')
+"""
+from threading import Lock
+from time import time
+
+enabled = False
+
+# Seconds until a measurement only counts half
+HALFLIFE = 3600.0
+# The total weight of the measurements below which we don't trust them,
+# every new measurement weighs 1
+MINWEIGHT = 2.0
+# The number of keys kept, the ones with the least weight are dropped first
+MAXKEYS = 10000
+
+_lock = Lock()
+# Lists of the weight and the weighted sums of sizes and times, and when
+# they were decayed last, by key
+_stats = {}
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def shape(name, query):
+    """Return the key of a query for the index called name."""
+    parts = [name]
+    if hasattr(query, 'keys'):
+        for option in sorted(query.keys()):
+            if option == 'query':
+                continue
+            if option in ('range', 'operator'):
+                parts.append('%s:%s' % (option, query[option]))
+            else:
+                parts.append(option)
+        query = query.get('query')
+    if isinstance(query, (list, tuple)) and len(query) != 1:
+        parts.append('list')
+    return tuple(parts)
+
+
+def _decay(entry, now):
+    factor = 0.5 ** (max(now - entry[3], 0.0) / HALFLIFE)
+    entry[0] *= factor
+    entry[1] *= factor
+    entry[2] *= factor
+    entry[3] = now
+
+
+def _prune():
+    # Drop the keys with the least weight, down to 90% of MAXKEYS
+    weights = sorted((entry[0], key) for key, entry in _stats.items())
+    for weight, key in weights[:len(weights) - MAXKEYS * 9 // 10]:
+        del _stats[key]
+
+
+def record(key, size, elapsed, now=None):
+    """Record a measurement of a size, or amount of work, and the seconds it
+    took for key.
+    """
+    if now is None:
+        now = time()
+    _lock.acquire()
+    try:
+        entry = _stats.get(key)
+        if entry is None:
+            if len(_stats) >= MAXKEYS:
+                _prune()
+            entry = _stats[key] = [0.0, 0.0, 0.0, now]
+        else:
+            _decay(entry, now)
+        entry[0] += 1
+        entry[1] += size
+        entry[2] += elapsed
+    finally:
+        _lock.release()
+
+
+def estimate(key, now=None):
+    """Return the average size and seconds recorded for key, or None if
+    there aren't enough recent measurements.
+    """
+    if now is None:
+        now = time()
+    _lock.acquire()
+    try:
+        entry = _stats.get(key)
+        if entry is None:
+            return None
+        _decay(entry, now)
+        weight, size, elapsed = entry[:3]
+    finally:
+        _lock.release()
+    if weight < MINWEIGHT:
+        return None
+    return size / weight, elapsed / weight
+
+
+def factor(key):
+    """Return the seconds per unit of size recorded for key, 1.0 if unknown.
+
+    For set operations the size is the estimate of the cost model, which
+    makes this the correction for its estimates.
+    """
+    found = estimate(key)
+    if found is None or not found[0]:
+        return 1.0
+    return found[1] / found[0]
+
+
+def snapshot():
+    """Return the statistics as a dictionary of keys to their weight and
+    average size and seconds.
+    """
+    now = time()
+    result = {}
+    _lock.acquire()
+    try:
+        for key, entry in _stats.items():
+            _decay(entry, now)
+            weight, size, elapsed = entry[:3]
+            if weight:
+                result[key] = dict(weight=weight, size=size / weight,
+                                   time=elapsed / weight)
+    finally:
+        _lock.release()
+    return result
+
+
+def reset():
+    """Forget all statistics."""
+    _lock.acquire()
+    try:
+        _stats.clear()
+    finally:
+        _lock.release()
+
+
+def dump(path):
+    """Write the statistics to a JSON file."""
+    import json
+    _lock.acquire()
+    try:
+        entries = [[list(key)] + entry for key, entry in _stats.items()]
+    finally:
+        _lock.release()
+    f = open(path, 'w')
+    try:
+        json.dump(entries, f)
+    finally:
+        f.close()
+
+
+def load(path):
+    """Read the statistics from a JSON file written by dump, they replace
+    the ones recorded for the same keys.
+    """
+    import json
+    f = open(path)
+    try:
+        entries = json.load(f)
+    finally:
+        f.close()
+    _lock.acquire()
+    try:
+        for entry in entries:
+            key = tuple(_str(part) for part in entry[0])
+            _stats[key] = [float(value) for value in entry[1:]]
+        if len(_stats) > MAXKEYS:
+            _prune()
+    finally:
+        _lock.release()
+
+
+def _str(part):
+    # JSON returns unicode, the keys we record are str
+    if isinstance(part, unicode):
+        try:
+            return str(part)
+        except UnicodeEncodeError:
+            pass
+    return part
@@ -1,113 +1,498 @@
 from logging import getLogger
+from timeit import default_timer
+import os
+
+from experimental.btree import bitmap
+from experimental.btree import cache as resultcache
+from experimental.btree import costmodel
+from experimental.btree import instrumentation
+from experimental.btree import mapped
+from experimental.btree import materialized as materializedsets
+from experimental.btree import prefetch as prefetching
+from experimental.btree import probing as probes
+from experimental.btree import querystats
+from experimental.btree import vectorized as vector
+from experimental.btree import window
+from experimental.btree.bitmap import Bitmap
+from experimental.btree.buckets import buildbucket
+from experimental.btree.buckets import buildset
+from experimental.btree.buckets import ismapping
+from experimental.btree.buckets import istree
+from experimental.btree.galloping import galloping_intersection
+from experimental.btree.galloping import galloping_weightedIntersection
+from experimental.btree.galloping import walking_difference
+from experimental.btree.mapped import MappedSet
+from experimental.btree.parallel import parallel_intersection
 
 logger = getLogger('experimental.btree')
 
+# The intersection and difference strategies are chosen by the cost model,
+# these are still used by multiintersection
 SMALLSETSIZE = 200
 BIGSMALLRATIO = 20
 
 HAS_COPTIMIZATIONS = True
 try:
     from experimental.btree.difference import ciidifference
+    from experimental.btree.difference import ciodifference
+    from experimental.btree.difference import clfdifference
+    from experimental.btree.difference import clldifference
+    from experimental.btree.difference import clodifference
+    from experimental.btree.difference import coidifference
+    from experimental.btree.difference import coodifference
     from experimental.btree.intersection import ciiintersection
+    from experimental.btree.intersection import ciointersection
+    from experimental.btree.intersection import clfintersection
+    from experimental.btree.intersection import cllintersection
+    from experimental.btree.intersection import clointersection
+    from experimental.btree.intersection import coiintersection
+    from experimental.btree.intersection import coointersection
 except ImportError:
     HAS_COPTIMIZATIONS = False
+if costmodel.PYTHON_BTREES:
+    # The compiled functions only take the C types of BTrees
+    HAS_COPTIMIZATIONS = False
 
 
-def patch_intersection(treetype, settype, module=None):
+def probe_intersection(small, big, settype):
+    has = big.has_key
+    return buildset(settype, [i for i in small if has(i)])
+
+
+def prefetch_probes(small, big):
+    # Batch load the buckets of a persistent big the keys of small will be
+    # looked up in
+    if getattr(big, '_p_jar', None) is None:
+        return
+    keys = small
+    if ismapping(small) or istree(small):
+        keys = small.keys()
+    prefetching.prefetch(big, keys)
+
+
+def probe_weightedIntersection(small, big, buckettype, wsmall, wbig):
+    # At least one of them is a mapping, the members of a set count as 1
+    keys = []
+    scores = []
+    if ismapping(big):
+        get = big.get
+        if ismapping(small):
+            for key, value in small.iteritems():
+                bvalue = get(key)
+                if bvalue is not None:
+                    keys.append(key)
+                    scores.append(wsmall * value + wbig * bvalue)
+        else:
+            for key in small:
+                bvalue = get(key)
+                if bvalue is not None:
+                    keys.append(key)
+                    scores.append(wsmall + wbig * bvalue)
+    else:
+        has = big.has_key
+        for key, value in small.iteritems():
+            if has(key):
+                keys.append(key)
+                scores.append(wsmall * value + wbig)
+    return 1, buildbucket(buckettype, keys, scores)
+
+
+def probe_difference(o1, o2, settype, buckettype=None):
+    has = o2.has_key
+    if ismapping(o1):
+        # Keep the values, like the stock difference
+        items = [(k, v) for k, v in o1.iteritems() if not has(k)]
+        return buildbucket(buckettype, [k for k, v in items],
+                           [v for k, v in items])
+    return buildset(settype, [i for i in o1 if not has(i)])
 
-    setintersection = treetype.intersection
 
-    def intersection(o1, o2):
+def treetypes(treetype, settype):
+    # The tree set and tree of the module treetype
+    prefix = settype.__name__[:2]
+    return (getattr(treetype, prefix + 'TreeSet'),
+            getattr(treetype, prefix + 'BTree'))
+
+
+def make_intersection(treetype, settype, galloping=False, cintersection=None,
+                      vectorized=False, parallel=False, prefetch=False):
+    setintersection = treetype.intersection
+    buckettype = getattr(treetype, settype.__name__[:2] + 'Bucket')
+    # In galloping mode we never probe from the root for every key
+    if galloping:
+        strategies = ('merge', 'gallop', 'window')
+    else:
+        strategies = ('merge', 'probe', 'gallop', 'window')
+    if cintersection is not None:
+        strategies += ('c', )
+    if vectorized and vector.supports(settype):
+        strategies += ('vector', )
+    if parallel:
+        strategies += ('parallel', )
+    trees = treetypes(treetype, settype)
+    # What the cost model picks for a small set against a tree
+    quick = None
+    if cintersection is not None:
+        quick = 'c'
+    elif 'probe' in strategies:
+        quick = 'probe'
+
+    def intersection(o1, o2, path=None, min=None, max=None):
+        if min is not None or max is not None:
+            # Only keys from min to max are asked for, see window.py
+            if path is not None:
+                path.append('window')
+            return window.intersection(o1, o2, settype, buckettype,
+                                       setintersection, min, max)
+        # A small set against a tree is decided by type and len() alone,
+        # before anything else is looked at
+        if quick is not None and not querystats.enabled:
+            small = None
+            if type(o1) is settype and type(o2) in trees:
+                small, big = o1, o2
+            elif type(o2) is settype and type(o1) in trees:
+                small, big = o2, o1
+            if small is not None and 0 < len(small) < costmodel.SMALLSIZE:
+                if path is not None:
+                    path.append(quick)
+                return run(quick, o1, o2, small, big)
+        if isinstance(o1, Bitmap) or isinstance(o2, Bitmap):
+            if path is not None:
+                path.append('bitmap')
+            return bitmap.intersection(o1, o2)
+        if isinstance(o1, MappedSet) or isinstance(o2, MappedSet):
+            if path is not None:
+                path.append('mapped')
+            return mapped.intersection(o1, o2, settype)
         if not o2 or not o1:
             # Avoid len of unsized or zero division
             return setintersection(o1, o2)
 
-        s1 = type(o1) is settype
-        s2 = type(o2) is settype
-
-        if s1 and s2:
-            return setintersection(o1, o2)
-        elif s1 or s2:
-            # Only do this if one of them is a set, we are slower at treesets.
-            # We don't check the size of the treeset, so we sometimes loop over
-            # a very small one, but there's no way to tell, without loading it.
-            if s1 and len(o1) < SMALLSETSIZE:
-                small = o1
-                big = o2
-            elif s2 and len(o2) < SMALLSETSIZE:
-                small = o2
-                big = o1
-            else:
-                return setintersection(o1, o2)
-
-            new = settype()
-            ins = new.insert
-            has = big.has_key
-            for i in small:
-                if has(i):
-                    ins(i)
-            return new
+        estimates = None
+        if querystats.enabled:
+            estimates = {}
+        strategy, small, big = costmodel.intersection(
+            o1, o2, settype, strategies, estimates)
+        if path is not None:
+            path.append(strategy)
+        if not estimates or strategy not in estimates:
+            return run(strategy, o1, o2, small, big)
+        start = default_timer()
+        result = run(strategy, o1, o2, small, big)
+        querystats.record(
+            ('intersection', strategy, costmodel.kind(small),
+             costmodel.kind(big)),
+            estimates[strategy], default_timer() - start)
+        return result
+
+    def run(strategy, o1, o2, small, big):
+        if prefetch and strategy in ('probe', 'gallop', 'c'):
+            prefetch_probes(small, big)
+        if strategy == 'probe':
+            return probe_intersection(small, big, settype)
+        elif strategy == 'gallop':
+            # The cursor only moves forward through the buckets of big,
+            # instead of walking down from the root for every key.
+            return galloping_intersection(small, big, settype)
+        elif strategy == 'c':
+            return cintersection(o1, o2)
+        elif strategy == 'vector':
+            return vector.intersection(small, big, settype)
+        elif strategy == 'parallel':
+            return parallel_intersection(o1, o2, settype, big)
+        elif strategy == 'window':
+            return window.intersection(o1, o2, settype, buckettype,
+                                       setintersection)
         return setintersection(o1, o2)
 
+    return intersection
+
+
+def modulename(module):
+    return module.__name__.split('.')[-1]
+
+
+def wrap(name, module, func, cache=False, instrument=False):
+    # Add the optional layers around func, as installed on module
+    if instrument:
+        func = instrumentation.instrumented(name, modulename(module), func)
+    if cache:
+        func = resultcache.cached(name, func)
+    return func
+
+
+class Unbound(object):
+    # Calls func without becoming a method when it's stored on a class,
+    # like the builtin functions it replaces. Tests import union in a
+    # class body and call self.union(o1, o2).
+
+    def __init__(self, func):
+        self.func = func
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __call__(self, *args, **kw):
+        return self.func(*args, **kw)
+
+    def __repr__(self):
+        return '<patched %s>' % self.__name__
+
+
+def patch_intersection(treetype, settype, module=None, galloping=False,
+                       cintersection=None, cache=False, vectorized=False,
+                       instrument=False, parallel=False, prefetch=False):
+    intersection = make_intersection(treetype, settype, galloping,
+                                     cintersection, vectorized, parallel,
+                                     prefetch)
+
     if not hasattr(treetype, '_old_intersection'):
         treetype._old_intersection = treetype.intersection
-        treetype.intersection = intersection
+        treetype.intersection = wrap('intersection', treetype, intersection,
+                                     cache, instrument)
         logger.debug('Patched %s' % str(treetype.intersection))
     if module is not None and not hasattr(module, '_old_intersection'):
         module._old_intersection = module.intersection
-        module.intersection = intersection
+        module.intersection = wrap('intersection', module, intersection,
+                                   cache, instrument)
         logger.debug('Patched %s' % str(module.intersection))
 
 
-def patch_weightedIntersection(treetype, settypes):
+def make_weightedIntersection(treetype, settypes, galloping=False,
+                              vectorized=False):
     setintersection = treetype.intersection
     weightedsetintersection = treetype.weightedIntersection
+    settype = settypes[0]
+    buckettype = getattr(treetype, settype.__name__[:2] + 'Bucket')
+    if galloping:
+        strategies = ('merge', 'gallop')
+    else:
+        strategies = ('merge', 'probe', 'gallop')
+    if vectorized and vector.supports(settype):
+        strategies += ('vector', )
 
-    def weightedIntersection(o1, o2, w1=1, w2=1):
+    def weightedIntersection(o1, o2, w1=1, w2=1, path=None):
         if isinstance(o1, settypes) and isinstance(o2, settypes):
+            if path is not None:
+                path.append('sets')
             return (w1+w2), setintersection(o1, o2)
+        if not o1 or not o2:
+            return weightedsetintersection(o1, o2, w1, w2)
+        strategy, small, big = costmodel.weightedIntersection(
+            o1, o2, strategies)
+        if path is not None:
+            path.append(strategy)
+        if small is o1:
+            wsmall, wbig = w1, w2
+        else:
+            wsmall, wbig = w2, w1
+        if strategy == 'probe':
+            return probe_weightedIntersection(small, big, buckettype,
+                                              wsmall, wbig)
+        elif strategy == 'gallop':
+            return galloping_weightedIntersection(small, big, buckettype,
+                                                  wsmall, wbig)
+        elif strategy == 'vector':
+            return vector.weightedIntersection(o1, o2, settype, buckettype,
+                                               w1, w2)
         return weightedsetintersection(o1, o2, w1, w2)
 
+    return weightedIntersection
+
+
+def patch_weightedIntersection(treetype, settypes, galloping=False,
+                               vectorized=False, instrument=False):
+    weightedIntersection = make_weightedIntersection(
+        treetype, settypes, galloping, vectorized)
     if not hasattr(treetype, '_old_weightedIntersection'):
         treetype._old_weightedIntersection = treetype.weightedIntersection
-        treetype.weightedIntersection = weightedIntersection
+        treetype.weightedIntersection = wrap(
+            'weightedIntersection', treetype, weightedIntersection,
+            instrument=instrument)
         logger.debug('Patched %s' % str(treetype.weightedIntersection))
 
 
-def patch_difference(treetype, settype, module=None):
-
+def make_difference(treetype, settype, cdifference=None, vectorized=False,
+                    prefetch=False):
     setdifference = treetype.difference
-
-    def difference(o1, o2):
+    buckettype = getattr(treetype, settype.__name__[:2] + 'Bucket')
+    strategies = ('merge', 'probe', 'walk', 'window')
+    if cdifference is not None:
+        strategies += ('c', )
+    if vectorized and vector.supports(settype):
+        strategies += ('vector', )
+    trees = treetypes(treetype, settype)
+
+    def difference(o1, o2, path=None, min=None, max=None):
+        if min is not None or max is not None:
+            if path is not None:
+                path.append('window')
+            return window.difference(o1, o2, settype, buckettype,
+                                     setdifference, min, max)
+        # Like for intersection, see costmodel.difference
+        if (type(o1) is settype and type(o2) in trees and
+            not querystats.enabled and 0 < len(o1) < costmodel.SMALLSIZE):
+            if path is not None:
+                path.append('probe')
+            return run('probe', o1, o2)
+        if isinstance(o1, Bitmap) or isinstance(o2, Bitmap):
+            if path is not None:
+                path.append('bitmap')
+            return bitmap.difference(o1, o2, settype, buckettype)
+        if isinstance(o1, MappedSet) or isinstance(o2, MappedSet):
+            if path is not None:
+                path.append('mapped')
+            return mapped.difference(o1, o2, settype, buckettype)
         # Bail out as soon as possible if one or both are None
         if not o1 or not o2:
             return setdifference(o1, o2)
-        # Both are real sets, of unknown size
-        l1 = len(o1)
-        # Difference returns bucket if o1 is btree
-        if l1 < SMALLSETSIZE and isinstance(o1, settype):
-            l2 = len(o2)
-            if l2/l1 > BIGSMALLRATIO:
-                new = settype()
-                ins = new.insert
-                has = o2.has_key
-                for i in o1:
-                    if not has(i):
-                        ins(i)
-                return new
 
+        estimates = None
+        if querystats.enabled:
+            estimates = {}
+        strategy = costmodel.difference(o1, o2, settype, strategies,
+                                        estimates)
+        if path is not None:
+            path.append(strategy)
+        if not estimates or strategy not in estimates:
+            return run(strategy, o1, o2)
+        start = default_timer()
+        result = run(strategy, o1, o2)
+        querystats.record(
+            ('difference', strategy, costmodel.kind(o1), costmodel.kind(o2)),
+            estimates[strategy], default_timer() - start)
+        return result
+
+    def run(strategy, o1, o2):
+        if prefetch and strategy in ('probe', 'walk'):
+            prefetch_probes(o1, o2)
+        if strategy == 'probe':
+            return probe_difference(o1, o2, settype, buckettype)
+        elif strategy == 'walk':
+            return walking_difference(o1, o2, settype, buckettype)
+        elif strategy == 'c':
+            return cdifference(o1, o2)
+        elif strategy == 'vector':
+            return vector.difference(o1, o2, settype, buckettype)
+        elif strategy == 'window':
+            return window.difference(o1, o2, settype, buckettype,
+                                     setdifference)
         return setdifference(o1, o2)
 
+    return difference
+
+
+def patch_difference(treetype, settype, module=None, cdifference=None,
+                     cache=False, vectorized=False, instrument=False,
+                     prefetch=False):
+    difference = make_difference(treetype, settype, cdifference, vectorized,
+                                 prefetch)
+
     if not hasattr(treetype, '_old_difference'):
         treetype._old_difference = treetype.difference
-        treetype.difference = difference
+        treetype.difference = wrap('difference', treetype, difference,
+                                   cache, instrument)
         logger.debug('Patched %s' % str(treetype.difference))
     if module is not None and not hasattr(module, '_old_difference'):
         module._old_difference = module.difference
-        module.difference = difference
+        module.difference = wrap('difference', module, difference,
+                                 cache, instrument)
         logger.debug('Patched %s' % str(module.difference))
 
 
+def make_union(treetype, settype, vectorized=False):
+    setunion = getattr(treetype, '_old_union', treetype.union)
+    strategies = ('merge', )
+    if vectorized and vector.supports(settype):
+        strategies += ('vector', )
+
+    def union(o1, o2, path=None):
+        if isinstance(o1, Bitmap) or isinstance(o2, Bitmap):
+            if path is not None:
+                path.append('bitmap')
+            return bitmap.union(o1, o2)
+        if isinstance(o1, MappedSet) or isinstance(o2, MappedSet):
+            if path is not None:
+                path.append('mapped')
+            # Unpacking the keys into a set is as fast as it gets, the
+            # result has to be built from all of them anyway
+            if isinstance(o1, MappedSet):
+                o1 = o1.toset(settype)
+            if isinstance(o2, MappedSet):
+                o2 = o2.toset(settype)
+            return setunion(o1, o2)
+        if not o1 or not o2:
+            return setunion(o1, o2)
+        strategy = costmodel.union(o1, o2, strategies)
+        if path is not None:
+            path.append(strategy)
+        if strategy == 'vector':
+            return vector.union(o1, o2, settype)
+        return setunion(o1, o2)
+
+    return union
+
+
+def patch_union(treetype, settype, module=None, cache=False,
+                vectorized=False, instrument=False):
+    union = make_union(treetype, settype, vectorized)
+
+    if not hasattr(treetype, '_old_union'):
+        treetype._old_union = treetype.union
+        treetype.union = Unbound(
+            wrap('union', treetype, union, cache, instrument))
+        logger.debug('Patched %s' % str(treetype.union))
+    # Not every catalog module uses union
+    if (module is not None and hasattr(module, 'union') and
+        not hasattr(module, '_old_union')):
+        module._old_union = module.union
+        module.union = Unbound(
+            wrap('union', module, union, cache, instrument))
+        logger.debug('Patched %s' % str(module.union))
+
+
+def make_multiunion(treetype, settype):
+    setmultiunion = getattr(treetype, '_old_multiunion', treetype.multiunion)
+
+    def multiunion(seq):
+        seq = list(seq)
+        for o in seq:
+            if isinstance(o, Bitmap):
+                # The stock function can't iterate over bitmaps, and the
+                # others are cheap to OR into them
+                return bitmap.multiunion(seq)
+        # The stock function radix sorts the keys of all operands in C,
+        # only mapped sets have to be unpacked for it first
+        for i, o in enumerate(seq):
+            if isinstance(o, MappedSet):
+                seq[i] = o.toset(settype)
+        return setmultiunion(seq)
+
+    return multiunion
+
+
+def patch_multiunion(treetype, settype, module=None):
+    multiunion = make_multiunion(treetype, settype)
+
+    if not hasattr(treetype, '_old_multiunion'):
+        treetype._old_multiunion = treetype.multiunion
+        treetype.multiunion = Unbound(multiunion)
+        logger.debug('Patched %s' % str(treetype.multiunion))
+    if (module is not None and hasattr(module, 'multiunion') and
+        not hasattr(module, '_old_multiunion')):
+        module._old_multiunion = module.multiunion
+        module.multiunion = Unbound(multiunion)
+        logger.debug('Patched %s' % str(module.multiunion))
+
+
+def unpatch_union(module):
+    for name in ('union', 'multiunion'):
+        old = '_old_' + name
+        if hasattr(module, old):
+            setattr(module, name, getattr(module, old))
+            delattr(module, old)
+            logger.debug('Removing patch from %s of %s' % (name, module))
+
+
 def patch_cintersection(module, method):
     if not hasattr(module, '_old_intersection'):
         module._old_intersection = module.intersection
@@ -122,14 +507,123 @@ def patch_cdifference(module, method):
         logger.debug('Patched %s' % str(module.difference))
 
 
-def apply(no_coptimizations=False):
+def patch_multiintersection(module, method):
+    if not hasattr(module, '_old_multiintersection'):
+        module._old_multiintersection = getattr(module, 'multiintersection',
+                                                None)
+        module.multiintersection = method
+        logger.debug('Patched %s' % str(module.multiintersection))
+
+
+def make_materialized(name, original):
+    # Wrap an index method to answer queries from or maintain the
+    # materialized sets stored on the index
+    if name == '_apply_index':
+        def method(self, request, *args, **kw):
+            result = materializedsets.lookup(self, request)
+            if result is not None:
+                return result, materializedsets.used(self)
+            return original(self, request, *args, **kw)
+    elif name == 'index_object':
+        def method(self, documentId, *args, **kw):
+            result = original(self, documentId, *args, **kw)
+            materializedsets.update(self, documentId)
+            return result
+    elif name == 'unindex_object':
+        def method(self, documentId, *args, **kw):
+            result = original(self, documentId, *args, **kw)
+            materializedsets.remove(self, documentId)
+            return result
+    else:
+        def method(self, *args, **kw):
+            result = original(self, *args, **kw)
+            materializedsets.discard(self)
+            return result
+    method.__name__ = name
+    return method
+
+
+MATERIALIZED = ('_apply_index', 'index_object', 'unindex_object', 'clear')
+
+
+def patch_materialized(indextype):
+    # Only the methods the class defines itself, the inherited ones are
+    # patched on the base class
+    for name in MATERIALIZED:
+        old = '_old_' + name
+        if name in indextype.__dict__ and old not in indextype.__dict__:
+            original = indextype.__dict__[name]
+            setattr(indextype, old, original)
+            setattr(indextype, name, make_materialized(name, original))
+            logger.debug('Patched %s' % str(getattr(indextype, name)))
+
+
+def unpatch_materialized(indextype):
+    for name in MATERIALIZED:
+        old = '_old_' + name
+        if old in indextype.__dict__:
+            setattr(indextype, name, indextype.__dict__[old])
+            delattr(indextype, old)
+            logger.debug('Removing patch from %s' %
+                         str(getattr(indextype, name)))
+
+
+def make_probing(original):
+    # Probe the ids of a small running result instead of computing the
+    # whole result of the index
+    def _apply_index(self, request, resultset=None):
+        return probes.evaluate(self, request, resultset,
+                               lambda: original(self, request, resultset))
+    return _apply_index
+
+
+def patch_probing(indextype, prober=None):
+    # The catalog only passes the running result to indexes which take it
+    original = indextype.__dict__.get('_apply_index')
+    if original is None or '_old_probing' in indextype.__dict__:
+        return
+    if 'resultset' not in original.func_code.co_varnames:
+        return
+    indextype._old_probing = original
+    indextype._apply_index = make_probing(original)
+    if prober is not None:
+        probes.register(indextype, prober)
+    logger.debug('Patched %s' % str(indextype._apply_index))
+
+
+def unpatch_probing(indextype):
+    if '_old_probing' in indextype.__dict__:
+        indextype._apply_index = indextype.__dict__['_old_probing']
+        del indextype._old_probing
+        logger.debug('Removing patch from %s' % str(indextype._apply_index))
+    probes.unregister(indextype)
+
+
+def apply(no_coptimizations=False, galloping=False, calibrate=False,
+          profile=None, cache=False, vectorized=False, instrument=False,
+          parallel=False, materialized=False, prefetch=False,
+          probing=False, statistics=False):
     global HAS_COPTIMIZATIONS
     if no_coptimizations:
         HAS_COPTIMIZATIONS = False
 
+    if profile is not None and os.path.exists(profile):
+        costmodel.load_profile(profile)
+    elif calibrate:
+        costmodel.calibrate()
+        if profile is not None:
+            costmodel.save_profile(profile)
+
+    if instrument:
+        instrumentation.enable()
+    if statistics:
+        querystats.enable()
+
     from BTrees.IIBTree import IISet, IITreeSet
     from BTrees import IIBTree
-    patch_weightedIntersection(IIBTree, (IISet, IITreeSet))
+    patch_weightedIntersection(IIBTree, (IISet, IITreeSet),
+                               galloping=galloping, vectorized=vectorized,
+                               instrument=instrument)
 
     from Products.ExtendedPathIndex import ExtendedPathIndex
     from Products.PluginIndexes.common import UnIndex
@@ -139,43 +633,161 @@ def apply(no_coptimizations=False):
     from Products.PluginIndexes.PathIndex import PathIndex
     from Products.ZCatalog import Catalog
 
+    if probing:
+        from Products.PluginIndexes.FieldIndex import FieldIndex
+        # Before the materialized sets, which are looked up first
+        patch_probing(UnIndex.UnIndex)
+        patch_probing(DateIndex.DateIndex)
+        patch_probing(DateRangeIndex.DateRangeIndex, probes.probe_daterange)
+        # Other subclasses of UnIndex may store values probe_field can't
+        # compare, they compute their results as before
+        probes.register(FieldIndex.FieldIndex, probes.probe_field,
+                        subclasses=False)
+        probes.register(DateIndex.DateIndex, probes.probe_field,
+                        subclasses=False)
+        probes.register(KeywordIndex.KeywordIndex, probes.probe_keyword)
+
+    if materialized:
+        for indextype in (UnIndex.UnIndex, DateIndex.DateIndex,
+                          DateRangeIndex.DateRangeIndex,
+                          KeywordIndex.KeywordIndex, PathIndex.PathIndex,
+                          ExtendedPathIndex.ExtendedPathIndex):
+            patch_materialized(indextype)
+
+    from experimental.btree.multiintersection import multiintersection
+    patch_multiintersection(IIBTree, multiintersection)
+
+    # The compiled functions probe, in galloping mode we never do
+    coptimizations = HAS_COPTIMIZATIONS and not galloping
+
+    cintersection = cdifference = None
+    if coptimizations:
+        cintersection = ciiintersection
+        cdifference = ciidifference
+    # The thread pool merges with the compiled loop
+    parallel = parallel and HAS_COPTIMIZATIONS
+
     # We leave out the BooleanIndex on purpose - our code is much slower on it
-    if HAS_COPTIMIZATIONS:
-        patch_cdifference(IIBTree, ciidifference)
-        patch_cdifference(DateRangeIndex, ciidifference)
-        patch_cintersection(IIBTree, ciiintersection)
-        patch_cintersection(Catalog, ciiintersection)
-        patch_cintersection(DateIndex, ciiintersection)
-        patch_cintersection(DateRangeIndex, ciiintersection)
-        patch_cintersection(ExtendedPathIndex, ciiintersection)
-        patch_cintersection(PathIndex, ciiintersection)
-        patch_cintersection(UnIndex, ciiintersection)
-    else:
-        patch_difference(IIBTree, IISet)
-        patch_difference(IIBTree, IISet, DateRangeIndex)
-        patch_intersection(IIBTree, IISet, Catalog)
-        patch_intersection(IIBTree, IISet, DateIndex)
-        patch_intersection(IIBTree, IISet, DateRangeIndex)
-        patch_intersection(IIBTree, IISet, ExtendedPathIndex)
-        patch_intersection(IIBTree, IISet, PathIndex)
-        patch_intersection(IIBTree, IISet, UnIndex)
+    patch_difference(IIBTree, IISet, cdifference=cdifference, cache=cache,
+                     vectorized=vectorized, instrument=instrument,
+                     prefetch=prefetch)
+    patch_difference(IIBTree, IISet, DateRangeIndex, cdifference=cdifference,
+                     cache=cache, vectorized=vectorized,
+                     instrument=instrument, prefetch=prefetch)
+    patch_intersection(IIBTree, IISet, Catalog, galloping=galloping,
+                       cintersection=cintersection, cache=cache,
+                       vectorized=vectorized, instrument=instrument,
+                       parallel=parallel, prefetch=prefetch)
+    patch_intersection(IIBTree, IISet, DateIndex, galloping=galloping,
+                       cintersection=cintersection, cache=cache,
+                       vectorized=vectorized, instrument=instrument,
+                       parallel=parallel, prefetch=prefetch)
+    patch_intersection(IIBTree, IISet, DateRangeIndex, galloping=galloping,
+                       cintersection=cintersection, cache=cache,
+                       vectorized=vectorized, instrument=instrument,
+                       parallel=parallel, prefetch=prefetch)
+    patch_intersection(IIBTree, IISet, ExtendedPathIndex, galloping=galloping,
+                       cintersection=cintersection, cache=cache,
+                       vectorized=vectorized, instrument=instrument,
+                       parallel=parallel, prefetch=prefetch)
+    patch_intersection(IIBTree, IISet, PathIndex, galloping=galloping,
+                       cintersection=cintersection, cache=cache,
+                       vectorized=vectorized, instrument=instrument,
+                       parallel=parallel, prefetch=prefetch)
+    patch_intersection(IIBTree, IISet, UnIndex, galloping=galloping,
+                       cintersection=cintersection, cache=cache,
+                       vectorized=vectorized, instrument=instrument,
+                       parallel=parallel, prefetch=prefetch)
+    for module in (None, DateIndex, DateRangeIndex, ExtendedPathIndex,
+                   PathIndex, UnIndex):
+        patch_union(IIBTree, IISet, module, cache=cache,
+                    vectorized=vectorized, instrument=instrument)
+        patch_multiunion(IIBTree, IISet, module)
 
     from BTrees.IOBTree import IOSet
     from BTrees import IOBTree
-    patch_intersection(IOBTree, IOSet)
-    patch_difference(IOBTree, IOSet)
+    cintersection = cdifference = None
+    if coptimizations:
+        cintersection = ciointersection
+        cdifference = ciodifference
+    patch_intersection(IOBTree, IOSet, galloping=galloping,
+                       cintersection=cintersection, cache=cache,
+                       vectorized=vectorized, instrument=instrument)
+    patch_difference(IOBTree, IOSet, cdifference=cdifference, cache=cache,
+                     vectorized=vectorized, instrument=instrument)
 
     from BTrees.OIBTree import OISet, OITreeSet
     from BTrees import OIBTree
-    patch_intersection(OIBTree, OISet)
-    patch_weightedIntersection(OIBTree, (OISet, OITreeSet))
-    patch_difference(OIBTree, OISet)
+    cintersection = cdifference = None
+    if coptimizations:
+        cintersection = coiintersection
+        cdifference = coidifference
+    patch_intersection(OIBTree, OISet, galloping=galloping,
+                       cintersection=cintersection, cache=cache,
+                       instrument=instrument)
+    patch_weightedIntersection(OIBTree, (OISet, OITreeSet),
+                               galloping=galloping, instrument=instrument)
+    patch_difference(OIBTree, OISet, cdifference=cdifference, cache=cache,
+                     instrument=instrument)
 
     from BTrees.OOBTree import OOSet
     from BTrees import OOBTree
-    patch_intersection(OOBTree, OOSet)
-    patch_difference(OOBTree, OOSet)
-    patch_difference(OOBTree, OOSet, KeywordIndex)
+    cintersection = cdifference = None
+    if coptimizations:
+        cintersection = coointersection
+        cdifference = coodifference
+    patch_intersection(OOBTree, OOSet, galloping=galloping,
+                       cintersection=cintersection, cache=cache,
+                       instrument=instrument)
+    patch_difference(OOBTree, OOSet, cdifference=cdifference, cache=cache,
+                     instrument=instrument)
+    patch_difference(OOBTree, OOSet, KeywordIndex, cdifference=cdifference,
+                     cache=cache, instrument=instrument)
+
+    from BTrees.LLBTree import LLSet, LLTreeSet
+    from BTrees import LLBTree
+    cintersection = cdifference = None
+    if coptimizations:
+        cintersection = cllintersection
+        cdifference = clldifference
+    patch_intersection(LLBTree, LLSet, galloping=galloping,
+                       cintersection=cintersection, cache=cache,
+                       vectorized=vectorized, instrument=instrument)
+    patch_weightedIntersection(LLBTree, (LLSet, LLTreeSet),
+                               galloping=galloping, vectorized=vectorized,
+                               instrument=instrument)
+    patch_difference(LLBTree, LLSet, cdifference=cdifference, cache=cache,
+                     vectorized=vectorized, instrument=instrument)
+    patch_union(LLBTree, LLSet, cache=cache, vectorized=vectorized,
+                instrument=instrument)
+    patch_multiunion(LLBTree, LLSet)
+
+    from BTrees.LOBTree import LOSet
+    from BTrees import LOBTree
+    cintersection = cdifference = None
+    if coptimizations:
+        cintersection = clointersection
+        cdifference = clodifference
+    patch_intersection(LOBTree, LOSet, galloping=galloping,
+                       cintersection=cintersection, cache=cache,
+                       vectorized=vectorized, instrument=instrument)
+    patch_difference(LOBTree, LOSet, cdifference=cdifference, cache=cache,
+                     vectorized=vectorized, instrument=instrument)
+
+    from BTrees.LFBTree import LFSet, LFTreeSet
+    from BTrees import LFBTree
+    cintersection = cdifference = None
+    if coptimizations:
+        cintersection = clfintersection
+        cdifference = clfdifference
+    patch_intersection(LFBTree, LFSet, galloping=galloping,
+                       cintersection=cintersection, cache=cache,
+                       vectorized=vectorized, instrument=instrument)
+    patch_weightedIntersection(LFBTree, (LFSet, LFTreeSet),
+                               galloping=galloping, vectorized=vectorized,
+                               instrument=instrument)
+    patch_difference(LFBTree, LFSet, cdifference=cdifference, cache=cache,
+                     vectorized=vectorized, instrument=instrument)
 
 
 def unpatch(treetype):
@@ -192,10 +804,19 @@ def unpatch(treetype):
         treetype.weightedIntersection = treetype._old_weightedIntersection
         del treetype._old_weightedIntersection
         logger.debug('Removing patch from %s' % str(treetype.weightedIntersection))
+    if hasattr(treetype, '_old_multiintersection'):
+        old = treetype._old_multiintersection
+        if old is None:
+            del treetype.multiintersection
+        else:
+            treetype.multiintersection = old
+        del treetype._old_multiintersection
+        logger.debug('Removing patch from multiintersection of %s' % str(treetype))
 
 def unapply():
     from BTrees import IIBTree
     unpatch(IIBTree)
+    unpatch_union(IIBTree)
 
     from BTrees import IOBTree
     unpatch(IOBTree)
@@ -205,3 +826,30 @@ def unapply():
 
     from BTrees import OOBTree
     unpatch(OOBTree)
+
+    from BTrees import LLBTree
+    unpatch(LLBTree)
+    unpatch_union(LLBTree)
+
+    from BTrees import LOBTree
+    unpatch(LOBTree)
+
+    from BTrees import LFBTree
+    unpatch(LFBTree)
+
+    from Products.ExtendedPathIndex import ExtendedPathIndex
+    from Products.PluginIndexes.common import UnIndex
+    from Products.PluginIndexes.DateIndex import DateIndex
+    from Products.PluginIndexes.DateRangeIndex import DateRangeIndex
+    from Products.PluginIndexes.KeywordIndex import KeywordIndex
+    from Products.PluginIndexes.PathIndex import PathIndex
+    for indextype in (UnIndex.UnIndex, DateIndex.DateIndex,
+                      DateRangeIndex.DateRangeIndex, KeywordIndex.KeywordIndex,
+                      PathIndex.PathIndex, ExtendedPathIndex.ExtendedPathIndex):
+        unpatch_materialized(indextype)
+        unpatch_probing(indextype)
+    from Products.PluginIndexes.FieldIndex import FieldIndex
+    probes.unregister(FieldIndex.FieldIndex)
+    for module in (DateIndex, DateRangeIndex, ExtendedPathIndex, PathIndex,
+                   UnIndex):
+        unpatch_union(module)
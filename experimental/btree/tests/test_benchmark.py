@@ -0,0 +1,79 @@
+import unittest
+
+from experimental.btree import benchmark
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def testKeys(self):
+        for distribution in benchmark.DISTRIBUTIONS:
+            keys = benchmark.keys(distribution, 100, 1000)
+            self.assertEqual(len(keys), 100)
+            self.assertEqual(keys, sorted(set(keys)))
+            self.failUnless(0 <= keys[0] and keys[-1] < 1000)
+            # Reproducible
+            self.assertEqual(keys, benchmark.keys(distribution, 100, 1000))
+
+    def testRun(self):
+        results = benchmark.run(repeat=3, warmup=1, mintime=0,
+                                distributions=('even', ), smallsizes=(10, ),
+                                bigsizes=(1000, ))
+        backends = set(stats['backend'] for stats in results)
+        self.failUnless('stock' in backends)
+        self.failUnless('python' in backends)
+        operations = set(stats['name'].split()[0] for stats in results)
+        self.assertEqual(operations, set(benchmark.OPERATIONS))
+        families = set(stats['name'].split()[1] for stats in results)
+        self.assertEqual(families, set(benchmark.FAMILIES))
+        for stats in results:
+            self.failUnless(stats['min'] <= stats['median'] <= stats['max'])
+
+    def testDispatch(self):
+        results = benchmark.dispatch(repeat=3, warmup=1, mintime=0,
+                                     sizes=(10, 1000))
+        names = set(stats['name'] for stats in results)
+        self.assertEqual(len(names), 4)
+        backends = set(stats['backend'] for stats in results)
+        self.assertEqual(backends, set(['python', 'probe']))
+
+    def testBuild(self):
+        keys = [1, 5, 7]
+        tree = benchmark.build('tree', keys, 'LL')
+        self.assertEqual(type(tree).__name__, 'LLBTree')
+        self.assertEqual(list(tree.keys()), [k + 2 ** 32 for k in keys])
+        self.assertEqual(list(benchmark.build('set', keys)), keys)
+
+    def testMeasure(self):
+        stats = benchmark.measure(sorted, ([3, 2, 1], ), repeat=5,
+                                  mintime=0.001)
+        self.assertEqual(stats['repeat'], 5)
+        self.failUnless(stats['loops'] >= 1)
+        self.failUnless(stats['p10'] <= stats['median'] <= stats['p90'])
+
+    def testAllocations(self):
+        self.assertEqual(benchmark.allocations(range, (10, )), 1)
+        self.assertEqual(benchmark.allocations(
+            lambda: [[] for i in xrange(10)], ()), 11)
+
+    def testCompare(self):
+        baseline = [
+            dict(name='a', backend='stock', median=1.0),
+            dict(name='b', backend='stock', median=1.0),
+        ]
+        results = [
+            dict(name='a', backend='stock', median=1.05),
+            dict(name='b', backend='stock', median=1.5),
+            dict(name='c', backend='stock', median=9.0),
+        ]
+        self.assertEqual(benchmark.compare(results, baseline),
+                         [('b', 'stock', 1.0, 1.5)])
+        self.assertEqual(benchmark.compare(results, baseline, 0.01),
+                         [('a', 'stock', 1.0, 1.05),
+                          ('b', 'stock', 1.0, 1.5)])
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestBenchmark))
+    return suite
@@ -0,0 +1,139 @@
+import unittest
+
+import transaction
+from BTrees.IIBTree import IISet, IITreeSet
+from BTrees.IIBTree import intersection as iiintersection
+from ZODB import DB
+from ZODB.MappingStorage import MappingStorage
+
+from experimental.btree import cache
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        def intersection(o1, o2):
+            self.calls.append((o1, o2))
+            return iiintersection(o1, o2)
+        self.intersection = cache.cached('intersection', intersection)
+        cache.reset()
+
+        self.db = DB(MappingStorage())
+        self.conn = self.db.open()
+        root = self.conn.root()
+        root['a'] = IITreeSet(xrange(0, 1000, 2))
+        root['b'] = IITreeSet(xrange(0, 1000, 3))
+        transaction.commit()
+
+    def tearDown(self):
+        transaction.abort()
+        self.conn.close()
+        self.db.close()
+        cache.reset()
+
+    def testHit(self):
+        root = self.conn.root()
+        a, b = root['a'], root['b']
+        r1 = self.intersection(a, b)
+        r2 = self.intersection(a, b)
+        self.assert_(r1 is r2)
+        self.assertEqual(list(r1), range(0, 1000, 6))
+        self.assertEqual(len(self.calls), 1)
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['entries'], 1)
+
+        # The arguments are part of the key
+        self.intersection(b, a)
+        self.assertEqual(len(self.calls), 2)
+
+    def testNotPersistent(self):
+        a = IISet(xrange(10))
+        self.intersection(a, self.conn.root()['b'])
+        self.intersection(a, self.conn.root()['b'])
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(cache.stats()['misses'], 0)
+
+    def testModified(self):
+        root = self.conn.root()
+        a, b = root['a'], root['b']
+        self.intersection(a, b)
+        # This only changes a bucket, not the serial of the tree set
+        a.insert(3)
+        self.assertEqual(list(self.intersection(a, b)),
+                         [0, 3] + range(6, 1000, 6))
+        transaction.commit()
+        self.assertEqual(cache.stats()['entries'], 0)
+        self.assertEqual(list(self.intersection(a, b)),
+                         [0, 3] + range(6, 1000, 6))
+        self.assertEqual(len(self.calls), 3)
+        self.assertEqual(cache.stats()['entries'], 1)
+
+    def testUnknownConnection(self):
+        # Without a way to tell whether it has changes, nothing is cached
+        class Jar(object):
+            pass
+        self.failIf(cache.modified(self.conn))
+        self.failUnless(cache.modified(Jar()))
+        a = IITreeSet(xrange(10))
+        a._p_jar = Jar()
+        a._p_oid = '\0' * 8
+        self.assertEqual(cache.identity(a), None)
+
+    def testTransactionBoundary(self):
+        root = self.conn.root()
+        a, b = root['a'], root['b']
+        # The first boundary clears the cache, we don't know what happened
+        # before the results were cached
+        self.intersection(a, b)
+        transaction.begin()
+        self.assertEqual(cache.stats()['entries'], 0)
+        # Without commits in between, the results are kept
+        self.intersection(a, b)
+        transaction.begin()
+        self.intersection(a, b)
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def testInvalidated(self):
+        root = self.conn.root()
+        self.intersection(root['a'], root['b'])
+        transaction.begin()
+        self.intersection(root['a'], root['b'])
+
+        tm = transaction.TransactionManager()
+        conn2 = self.db.open(tm)
+        conn2.root()['a'].insert(3)
+        tm.commit()
+        conn2.close()
+
+        transaction.begin()
+        self.assertEqual(cache.stats()['entries'], 0)
+        self.assertEqual(list(self.intersection(root['a'], root['b'])),
+                         [0, 3] + range(6, 1000, 6))
+
+    def testBudget(self):
+        root = self.conn.root()
+        a, b = root['a'], root['b']
+        c = cache.getcache()
+        budget = c.budget
+        c.budget = cache.resultsize(self.intersection(a, b)) + 1
+        try:
+            self.intersection(b, a)
+            stats = cache.stats()
+            self.assertEqual(stats['entries'], 1)
+            self.assertEqual(stats['evictions'], 1)
+            # The least recently used one is gone
+            self.intersection(a, b)
+            self.assertEqual(len(self.calls), 3)
+        finally:
+            c.budget = budget
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestResultCache))
+    return suite
@@ -0,0 +1,182 @@
+import threading
+import time
+import unittest
+
+import transaction
+from BTrees.IIBTree import IIBucket
+from BTrees.IIBTree import IISet
+from BTrees.IIBTree import IITreeSet
+from BTrees.OOBTree import OOBTree
+from persistent import Persistent
+from ZODB import DB
+from ZODB.MappingStorage import MappingStorage
+
+from experimental.btree import evaluation
+
+
+class FieldIndex(Persistent):
+    # Returns the stored sets themselves, like UnIndex does for one value
+
+    def __init__(self, id):
+        self.id = id
+        self._index = OOBTree()
+
+    def index_object(self, documentId, obj):
+        value = getattr(obj, self.id)
+        self._index.setdefault(value, IITreeSet()).insert(documentId)
+
+    def _apply_index(self, request, resultset=None):
+        value = request.get(self.id)
+        if value is None:
+            return None
+        return self._index.get(value, IISet()), (self.id, )
+
+
+class Document(object):
+
+    def __init__(self, **kw):
+        self.__dict__.update(kw)
+
+
+class Index(object):
+    # A transient index which runs a function
+
+    def __init__(self, func):
+        self.func = func
+
+    def _apply_index(self, request, resultset=None):
+        result = self.func()
+        if result is None:
+            return None
+        return result, ('index', )
+
+
+class TestEvaluate(unittest.TestCase):
+
+    def setUp(self):
+        self.db = DB(MappingStorage())
+        self.conn = self.db.open()
+        root = self.conn.root()
+        for name in ('color', 'size', 'shape'):
+            root[name] = FieldIndex(name)
+        for i in xrange(1000):
+            doc = Document(color=i % 3, size=i % 5, shape=i % 7)
+            for name in ('color', 'size', 'shape'):
+                root[name].index_object(i, doc)
+        transaction.commit()
+        self.indexes = [root[name] for name in ('color', 'size', 'shape')]
+
+    def tearDown(self):
+        transaction.abort()
+        self.conn.close()
+        self.db.close()
+
+    def testEvaluate(self):
+        request = {'color': 1, 'size': 2, 'shape': 3}
+        result = evaluation.evaluate(self.indexes, request)
+        expected = [i for i in xrange(1000)
+                    if i % 3 == 1 and i % 5 == 2 and i % 7 == 3]
+        self.assertEqual(list(result), expected)
+        self.assertEqual(list(evaluation.sequential(self.indexes, request)),
+                         expected)
+        # The stored sets were copied out of the connections of the workers
+        self.assertEqual(result._p_jar, None)
+
+    def testNotApplied(self):
+        self.assertEqual(evaluation.evaluate(self.indexes, {}), None)
+        result = evaluation.evaluate(self.indexes, {'size': 0})
+        self.assertEqual(list(result), range(0, 1000, 5))
+
+    def testEmpty(self):
+        request = {'color': 1, 'size': 2, 'shape': 8}
+        self.assertEqual(list(evaluation.evaluate(self.indexes, request)), [])
+
+    def testUncommitted(self):
+        doc = Document(color=1, size=0, shape=0)
+        for index in self.indexes:
+            index.index_object(1000, doc)
+        self.failUnless(evaluation.changed(self.indexes))
+        result = evaluation.evaluate(self.indexes, {'color': 1, 'size': 0})
+        self.failUnless(1000 in result)
+
+    def testMultiIntersection(self):
+        calls = []
+        multiintersection = evaluation.multiintersection
+
+        def recorded(*sets):
+            calls.append(len(sets))
+            return multiintersection(*sets)
+        evaluation.multiintersection = recorded
+        try:
+            request = {'color': 1, 'size': 2, 'shape': 3}
+            result = evaluation.evaluate(self.indexes, request)
+        finally:
+            evaluation.multiintersection = multiintersection
+        # All results are intersected at once
+        self.assertEqual(calls, [3])
+        self.assertEqual(list(result), [i for i in xrange(1000)
+                                        if (i % 3, i % 5, i % 7) == (1, 2, 3)])
+
+    def testMappings(self):
+        scores = Index(lambda: IIBucket({1: 2, 2: 3, 4: 5}))
+        keys = Index(lambda: IISet([1, 4, 5]))
+        result = evaluation.evaluate([scores, keys], {})
+        self.assertEqual(list(result.items()), [(1, 3), (4, 6)])
+
+
+class TestConcurrency(unittest.TestCase):
+
+    def testConcurrent(self):
+        first = threading.Event()
+        second = threading.Event()
+
+        def one():
+            first.set()
+            second.wait(5)
+            return IISet([1, 2])
+
+        def two():
+            second.set()
+            first.wait(5)
+            return IISet([2, 3])
+
+        start = time.time()
+        result = evaluation.evaluate([Index(one), Index(two)], {})
+        self.assertEqual(list(result), [2])
+        # Neither waited for the other
+        self.failUnless(time.time() - start < 5)
+
+    def testCancel(self):
+        release = threading.Event()
+        started = []
+
+        def slow():
+            started.append(1)
+            release.wait(5)
+            return IISet([1])
+
+        try:
+            start = time.time()
+            indexes = [Index(lambda: IISet())]
+            indexes += [Index(slow) for i in range(20)]
+            result = evaluation.evaluate(indexes, {})
+            self.assertEqual(list(result), [])
+            self.failUnless(time.time() - start < 5)
+        finally:
+            release.set()
+        # Only the ones that started before the result was empty ran
+        self.failUnless(len(started) < 20)
+
+    def testError(self):
+        def fail():
+            raise KeyError('broken')
+        indexes = [Index(lambda: IISet([1])), Index(fail)]
+        self.assertRaises(KeyError, evaluation.evaluate, indexes, {})
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestEvaluate))
+    suite.addTest(makeSuite(TestConcurrency))
+    return suite
@@ -0,0 +1,75 @@
+import unittest
+
+from BTrees import _IIBTree
+from BTrees.IIBTree import IIBTree, IISet, IITreeSet
+
+from experimental.btree import instrumentation
+from experimental.btree import setpatches
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        instrumentation.reset()
+        instrumentation.enable()
+        self.intersection = instrumentation.instrumented(
+            'intersection', 'Catalog',
+            setpatches.make_intersection(_IIBTree, IISet))
+        self.weightedIntersection = instrumentation.instrumented(
+            'weightedIntersection', 'IIBTree',
+            setpatches.make_weightedIntersection(_IIBTree,
+                                                 (IISet, IITreeSet)))
+
+    def tearDown(self):
+        instrumentation.disable()
+        instrumentation.reset()
+
+    def testBucket(self):
+        self.assertEqual([instrumentation.bucket(n) for n in (0, 1, 3, 64)],
+                         [1, 1, 4, 64])
+
+    def testRecord(self):
+        small = IISet(xrange(10))
+        big = IITreeSet(xrange(100000))
+        result = self.intersection(small, big)
+        self.assertEqual(list(result), range(10))
+        self.intersection(big, small)
+
+        stats = instrumentation.snapshot()['intersection']['Catalog']
+        self.assertEqual(stats['calls'], 2)
+        self.failUnless(stats['time'] > 0)
+        self.assertEqual(sum(stats['paths'].values()), 2)
+        self.assertEqual(stats['o1'], {16: 1, 131072: 1})
+        self.assertEqual(stats['o2'], {16: 1, 131072: 1})
+        self.assertEqual(sum(stats['latency'].values()), 2)
+
+    def testPaths(self):
+        big = IIBTree([(k, 1) for k in xrange(100000)])
+        w, result = self.weightedIntersection(IISet(xrange(10)), big, 2, 3)
+        self.assertEqual(list(result.items()), [(k, 5) for k in xrange(10)])
+        self.weightedIntersection(IISet(xrange(10)), IISet(xrange(5)))
+
+        stats = instrumentation.snapshot()['weightedIntersection']['IIBTree']
+        self.assertEqual(stats['calls'], 2)
+        self.assertEqual(stats['paths'], {'probe': 1, 'sets': 1})
+
+    def testDisabled(self):
+        instrumentation.disable()
+        result = self.intersection(IISet([1, 2]), IISet([2, 3]))
+        self.assertEqual(list(result), [2])
+        self.assertEqual(instrumentation.snapshot(), {})
+
+    def testReset(self):
+        self.intersection(IISet([1, 2]), IISet([2, 3]))
+        snapshot = instrumentation.snapshot()
+        instrumentation.reset()
+        self.assertEqual(instrumentation.snapshot(), {})
+        # Snapshots are copies
+        self.assertEqual(snapshot['intersection']['Catalog']['calls'], 1)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestInstrumentation))
+    return suite
@@ -0,0 +1,218 @@
+import unittest
+
+import transaction
+from BTrees.IIBTree import IITreeSet
+from BTrees.IOBTree import IOBTree
+from BTrees.OOBTree import OOBTree
+from persistent import Persistent
+from ZODB import DB
+from ZODB.MappingStorage import MappingStorage
+
+from experimental.btree import materialized
+from experimental.btree import setpatches
+
+
+class FieldIndex(Persistent):
+    # Just enough of a field index
+
+    def __init__(self, id):
+        self.id = id
+        self.clear()
+
+    def getId(self):
+        return self.id
+
+    def clear(self):
+        self._index = OOBTree()
+        self._unindex = IOBTree()
+
+    def index_object(self, documentId, obj, threshold=None):
+        value = getattr(obj, self.id, None)
+        old = self._unindex.get(documentId)
+        if value == old:
+            return 0
+        if old is not None:
+            self.unindex_object(documentId)
+        if value is not None:
+            self._index.setdefault(value, IITreeSet()).insert(documentId)
+            self._unindex[documentId] = value
+        return 1
+
+    def unindex_object(self, documentId):
+        value = self._unindex.get(documentId)
+        if value is not None:
+            self._index[value].remove(documentId)
+            del self._unindex[documentId]
+
+    def _apply_index(self, request, resultset=None):
+        value = materialized.normalize(request.get(self.id))
+        if value is None:
+            return None
+        self._v_calls = getattr(self, '_v_calls', 0) + 1
+        return IITreeSet(self._index.get(value, ())), (self.id, )
+
+
+class PathIndex(FieldIndex):
+    meta_type = 'PathIndex'
+
+
+class DateRangeIndex(FieldIndex):
+    meta_type = 'DateRangeIndex'
+    _since_field = 'effective'
+    _until_field = 'expires'
+
+
+class Document(object):
+
+    def __init__(self, review_state):
+        self.review_state = review_state
+
+
+class TestMaterialized(unittest.TestCase):
+
+    def setUp(self):
+        setpatches.patch_materialized(FieldIndex)
+        materialized.register('published', 'review_state', 'published')
+
+        self.db = DB(MappingStorage())
+        self.conn = self.db.open()
+        root = self.conn.root()
+        index = root['index'] = FieldIndex('review_state')
+        for i in xrange(100):
+            state = i % 3 and 'private' or 'published'
+            index.index_object(i, Document(state))
+        transaction.commit()
+
+    def tearDown(self):
+        transaction.abort()
+        self.conn.close()
+        self.db.close()
+        materialized.unregister('published')
+        setpatches.unpatch_materialized(FieldIndex)
+
+    def testNormalize(self):
+        self.assertEqual(materialized.normalize({'query': ['a']}), 'a')
+        self.assertEqual(materialized.normalize({'query': 'a', 'depth': 1}),
+                         (('depth', 1), ('query', 'a')))
+        self.assertEqual(materialized.normalize(['a', 'b']), ('a', 'b'))
+
+    def testNotMaterialized(self):
+        index = self.conn.root()['index']
+        result, used = index._apply_index({'review_state': 'published'})
+        self.assertEqual(list(result), range(0, 100, 3))
+        self.assertEqual(index._v_calls, 1)
+
+    def testMaterialize(self):
+        index = self.conn.root()['index']
+        keys = materialized.materialize(index, 'published')
+        self.assertEqual(list(keys), range(0, 100, 3))
+        self.assertEqual(index._v_calls, 1)
+        for query in ('published', ['published'], {'query': 'published'}):
+            result, used = index._apply_index({'review_state': query})
+            self.assert_(result is keys)
+            self.assertEqual(used, ('review_state', ))
+        self.assertEqual(index._v_calls, 1)
+        # Other queries are computed
+        result, used = index._apply_index({'review_state': 'private'})
+        self.assertEqual(len(result), 66)
+        self.assertEqual(index._v_calls, 2)
+
+    def testPersistent(self):
+        index = self.conn.root()['index']
+        materialized.materialize(index, 'published')
+        transaction.commit()
+        conn = self.db.open()
+        try:
+            index = conn.root()['index']
+            result, used = index._apply_index({'review_state': 'published'})
+            self.assertEqual(list(result), range(0, 100, 3))
+            self.assertEqual(getattr(index, '_v_calls', 0), 0)
+        finally:
+            conn.close()
+
+    def testMaintained(self):
+        index = self.conn.root()['index']
+        keys = materialized.materialize(index, 'published')
+        index.index_object(1, Document('published'))
+        index.index_object(3, Document('private'))
+        index.index_object(200, Document('published'))
+        index.unindex_object(6)
+        expected = sorted(set(range(0, 100, 3)) - set([3, 6]) | set([1, 200]))
+        self.assertEqual(list(keys), expected)
+        # The stored set is the same as a fresh result
+        self.assertEqual(list(materialized.materialize(index, 'published')),
+                         expected)
+
+    def testUnregistered(self):
+        index = self.conn.root()['index']
+        keys = materialized.materialize(index, 'published')
+        materialized.unregister('published')
+        result, used = index._apply_index({'review_state': 'published'})
+        self.failIf(result is keys)
+        # Not maintained anymore
+        index.index_object(1, Document('published'))
+        self.failIf(keys.has_key(1))
+
+    def testClear(self):
+        index = self.conn.root()['index']
+        materialized.materialize(index, 'published')
+        index.clear()
+        self.failIf(materialized.stored(index))
+        result, used = index._apply_index({'review_state': 'published'})
+        self.assertEqual(list(result), [])
+
+    def testBelongs(self):
+        def belongs(index, documentId, query):
+            return documentId % 2 == 0
+        materialized.register('even', 'review_state', 'even',
+                              belongs=belongs,
+                              matches=lambda value: value == 'even')
+        try:
+            index = self.conn.root()['index']
+            index._index['even'] = IITreeSet(xrange(0, 100, 2))
+            keys = materialized.materialize(index, 'even')
+            index.index_object(102, Document('private'))
+            index.index_object(103, Document('private'))
+            self.failUnless(keys.has_key(102))
+            self.failIf(keys.has_key(103))
+        finally:
+            materialized.unregister('even')
+
+    def testUnsupported(self):
+        def belongs(index, documentId, query):
+            return False
+        index = PathIndex('path')
+        self.assertRaises(ValueError, materialized.register, 'site', index,
+                          '/plone')
+        self.failIf(materialized.registrations(index))
+        # Registered by id, it's caught once the set is built
+        materialized.register('site', 'path', '/plone')
+        try:
+            self.assertRaises(ValueError, materialized.materialize, index,
+                              'site')
+            materialized.register('site', index, '/plone', belongs=belongs)
+            materialized.materialize(index, 'site')
+        finally:
+            materialized.unregister('site')
+
+    def testUsed(self):
+        def belongs(index, documentId, query):
+            return True
+        index = self.conn.root()['dates'] = DateRangeIndex('current')
+        index.index_object(1, Document('private'))
+        materialized.register('now', index, 'now', belongs=belongs)
+        try:
+            index._index['now'] = IITreeSet([1])
+            materialized.materialize(index, 'now')
+            result, used = index._apply_index({'current': 'now'})
+            self.assertEqual(list(result), [1])
+            self.assertEqual(used, ('effective', 'expires'))
+        finally:
+            materialized.unregister('now')
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestMaterialized))
+    return suite
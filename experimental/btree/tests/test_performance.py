@@ -1,356 +1,216 @@
-from time import time
+import sys
 import unittest
 
-from experimental.btree import setpatches
-setpatches.apply(no_coptimizations=True)
-from BTrees.IIBTree import intersection as intersection2
-from BTrees.IIBTree import difference as difference2
-
-setpatches.unapply()
-
 from BTrees.IIBTree import intersection
-from BTrees.IIBTree import difference
-
 from BTrees.IIBTree import IISet, IITreeSet
 
-try:
-    from experimental.btree.difference import ciidifference
-    from experimental.btree.intersection import ciiintersection
-except ImportError:
-    ciidifference = None
-    ciiintersection = None
+from experimental.btree import benchmark
+from experimental.btree.buckets import buildset
+from experimental.btree.buckets import buildtree
+from experimental.btree.multiintersection import multiintersection
+from experimental.btree.parallel import parallel_intersection
 
 SMALLSETSIZE = 30
 BIGSETSIZE = 1000000
-LOOP = 100
 
-class TestIntersection(unittest.TestCase):
+
+class TestBenchmark(unittest.TestCase):
 
     level = 2
 
-    def timing(self, small, large, text=''):
-        new = 0.0
-        old = 0.0
-        c = 0.0
-        loop = LOOP
-        for i in xrange(loop):
-            start = time()
-            intersection2(small, large)
-            new+=(time()-start)
-
-            start = time()
-            intersection(small, large)
-            old+=(time()-start)
-
-            start = time()
-            ciiintersection(small, large)
-            c+=(time()-start)
-
-        new_ratio = old / new
-        c_ratio = old / c
-
-        new_report = False
-        if new_ratio <= 0.4 or new_ratio > 2:
-            new_report = True
-        c_report = False
-        if c_ratio <= 0.8 or c_ratio > 1.2:
-            c_report = True
-
-        if c_report or new_report:
-            print
-            print text
-            print 'Old x%s: %.6f' % (loop, old)
-            print 'New x%s: %.6f - factor: %.2f' % (loop, new, new_ratio)
-            print 'Cyt x%s: %.6f - factor: %.2f' % (loop, c, c_ratio)
-
-    def test_None(self):
-        bigsize = BIGSETSIZE
-        large = IITreeSet(xrange(bigsize))
-        self.timing(large, None, 'Intersection large, None')
-        self.timing(None, large, 'Intersection None, large')
+    def timing(self, operation):
+        print
+        results = benchmark.run(operations=(operation, ), out=sys.stdout)
+        self.failUnless(results)
 
-    def test_empty(self):
-        bigsize = BIGSETSIZE
-        smallsize = 0
-        small = IISet(xrange(smallsize))
-        large = IITreeSet(xrange(bigsize))
+    def test_intersection(self):
+        self.timing('intersection')
 
-        self.timing(small, large, 'Intersection empty set + large treeset')
-        self.timing(large, small, 'Intersection large treeset + empty set')
+    def test_difference(self):
+        self.timing('difference')
 
-        small = IITreeSet(xrange(smallsize))
-        large = IISet(xrange(bigsize))
-        self.timing(small, large, 'Intersection empty tree set + large set')
-        self.timing(large, small, 'Intersection large set + empty tree set')
+    def test_weightedIntersection(self):
+        self.timing('weightedIntersection')
+
+    def test_dispatch(self):
+        # Picking the strategy for a small set against a big tree set costs
+        # little next to probing its keys
+        print
+        results = benchmark.dispatch(out=sys.stdout)
+        medians = {}
+        for stats in results:
+            medians[stats['name'], stats['backend']] = stats['median']
+        for name, backend in medians:
+            if backend == 'python':
+                self.failUnless(medians[name, 'python'] <
+                                1.5 * medians[name, 'probe'], name)
 
-    def test_heavy_start(self):
-        bigsize = BIGSETSIZE
-        smallsize = SMALLSETSIZE
 
-        small = IISet(xrange(smallsize))
-        large = IITreeSet(xrange(smallsize))
-        self.timing(small, large,
-            'Intersection small set low values + small treeset')
-        self.timing(large, small,
-            'Intersection small treeset + small set low values')
-
-        small = IISet(xrange(smallsize))
-        large = IITreeSet(xrange(bigsize))
-        self.timing(small, large,
-            'Intersection small set low values + large treeset')
-        self.timing(large, small,
-            'Intersection large treeset + small set low values')
-
-        small = IISet(xrange(smallsize))
-        large = IISet(xrange(bigsize))
-        self.timing(small, large,
-            'Intersection small set low values + large set')
-        self.timing(large, small,
-            'Intersection large set + small set low values')
-
-        small = IITreeSet(xrange(smallsize))
-        large = IISet(xrange(bigsize))
-        self.timing(small, large,
-            'Intersection small treeset + large set')
-        self.timing(large, small,
-            'Intersection large set + small treeset')
-
-    def test_heavy_end(self):
+class TestMultiIntersection(unittest.TestCase):
+
+    level = 2
+
+    def chained(self, *sets):
+        result = None
+        for o in sets:
+            result = intersection(result, o)
+            if not result:
+                break
+        return result
+
+    def timing(self, sets, text=''):
+        chained = benchmark.measure(self.chained, sets)
+        multi = benchmark.measure(multiintersection, sets)
+        print
+        print text
+        print 'Chained: %.2f us' % (chained['median'] * 1e6)
+        print 'Multi:   %.2f us - factor: %.2f' % (
+            multi['median'] * 1e6, chained['median'] / multi['median'])
+
+    def test_selective_first(self):
         bigsize = BIGSETSIZE
         smallsize = SMALLSETSIZE
+        sets = [IISet(xrange(0, bigsize, bigsize/smallsize))]
+        sets.extend(buildtree(IITreeSet, xrange(0, bigsize, step))
+                    for step in (2, 3, 5))
+        sets.append(IISet(xrange(bigsize)))
+        self.timing(sets, 'Multi intersection selective set first')
 
-        small = IISet(xrange(bigsize-smallsize,bigsize))
-        large = IITreeSet(xrange(smallsize))
-        self.timing(small, large,
-            'Intersection small set high values + small treeset')
-        self.timing(large, small,
-            'Intersection small treeset + small set high values')
-
-        small = IISet(xrange(bigsize-smallsize,bigsize))
-        large = IITreeSet(xrange(bigsize))
-        self.timing(small, large,
-            'Intersection small set high values + large treeset')
-        self.timing(large, small,
-            'Intersection large treeset + small set high values')
-
-        small = IISet(xrange(bigsize-smallsize,bigsize))
-        large = IISet(xrange(bigsize))
-        self.timing(small, large,
-            'Intersection small set high values + large set')
-        self.timing(large, small,
-            '\nIntersection large set + small set high values')
-
-    def test_even_dist(self):
+    def test_selective_last(self):
         bigsize = BIGSETSIZE
         smallsize = SMALLSETSIZE
+        sets = [IISet(xrange(bigsize))]
+        sets.extend(buildtree(IITreeSet, xrange(0, bigsize, step))
+                    for step in (2, 3, 5))
+        sets.append(IISet(xrange(0, bigsize, bigsize/smallsize)))
+        self.timing(sets, 'Multi intersection selective set last')
 
-        small = IISet(xrange(0, bigsize, bigsize/smallsize))
-        large = IITreeSet(xrange(smallsize))
-        self.timing(small, large,
-            'Intersection small set even distribution + small treeset')
-        self.timing(large, small,
-            'Intersection small treeset + small set even distribution')
+    def test_empty_early(self):
+        bigsize = BIGSETSIZE
+        sets = [buildtree(IITreeSet, xrange(0, bigsize, step))
+                for step in (2, 3, 5)]
+        sets.append(IISet(xrange(bigsize, bigsize + 10)))
+        self.timing(sets, 'Multi intersection disjoint set last')
 
-        small = IISet(xrange(0, bigsize, bigsize/smallsize))
-        large = IITreeSet(xrange(bigsize))
-        self.timing(small, large,
-            'Intersection small set even distribution + large treeset')
-        self.timing(large, small,
-            'Intersection large treeset + small set even distribution')
+    def test_large(self):
+        bigsize = BIGSETSIZE / 10
+        sets = [buildtree(IITreeSet, xrange(0, bigsize, step))
+                for step in (2, 3, 5, 7)]
+        self.timing(sets, 'Multi intersection large tree sets')
 
-        small = IISet(xrange(0, bigsize, bigsize/smallsize))
-        large = IISet(xrange(bigsize))
 
-        self.timing(small, large,
-            'Intersection small set even distribution + large set')
-        self.timing(large, small,
-            'Intersection large set, small set even distribution')
+class TestParallel(unittest.TestCase):
 
-    def test_small(self):
-        smallsize = SMALLSETSIZE
-        small = IITreeSet(xrange(smallsize))
-        large = IITreeSet(xrange(smallsize))
-        self.timing(small, large, 'Intersection small tree sets')
+    level = 2
 
-        small = IISet(xrange(smallsize))
-        large = IISet(xrange(smallsize))
-        self.timing(small, large, 'Intersection small sets')
+    def timing(self, o1, o2, text=''):
+        stock = benchmark.measure(intersection, (o1, o2))
+        pool = benchmark.measure(parallel_intersection, (o1, o2, IISet))
+        print
+        print text
+        print 'Stock:    %.2f us' % (stock['median'] * 1e6)
+        print 'Parallel: %.2f us - factor: %.2f' % (
+            pool['median'] * 1e6, stock['median'] / pool['median'])
 
     def test_large(self):
-        bigsize = BIGSETSIZE / 10
-        small = IITreeSet(xrange(bigsize))
-        large = IITreeSet(xrange(bigsize))
-        self.timing(small, large, 'Intersection Large tree sets')
+        bigsize = BIGSETSIZE * 4
+        o1 = buildtree(IITreeSet, xrange(0, bigsize, 2))
+        o2 = buildtree(IITreeSet, xrange(0, bigsize, 3))
+        self.timing(o1, o2, 'Parallel intersection large tree sets')
+
+
+class TestWindow(unittest.TestCase):
+
+    level = 2
 
-        small = IISet(xrange(bigsize))
-        large = IISet(xrange(bigsize))
-        self.timing(small, large, 'Intersection Large sets')
+    def timing(self, o1, o2, text=''):
+        from BTrees import _IIBTree
+        from experimental.btree.setpatches import make_intersection
+        stock = benchmark.measure(_IIBTree.intersection, (o1, o2))
+        windowed = benchmark.measure(make_intersection(_IIBTree, IISet),
+                                     (o1, o2))
+        print
+        print text
+        print 'Stock:  %.2f us' % (stock['median'] * 1e6)
+        print 'Window: %.2f us - factor: %.2f' % (
+            windowed['median'] * 1e6, stock['median'] / windowed['median'])
 
+    def test_clustered(self):
+        big = buildtree(IITreeSet, xrange(0, 2 * BIGSETSIZE, 2))
+        start = BIGSETSIZE - 10000
+        clustered = buildtree(IITreeSet, xrange(start, start + 20000))
+        self.timing(clustered, big, 'Intersection with clustered ids')
 
-class TestDifference(unittest.TestCase):
+
+class TestBuild(unittest.TestCase):
 
     level = 2
 
-    def timing(self, small, large):
-        new = 0.0
-        old = 0.0
-        c = 0.0
-        loop = LOOP
-        for i in xrange(10):
-            start = time()
-            difference(small, large)
-            old+=(time()-start)
-
-            start = time()
-            difference2(small, large)
-            new+=(time()-start)
-
-            if ciidifference is not None:
-                start = time()
-                ciidifference(small, large)
-                c+=(time()-start)
-
-        print 'Old x%s: %.6f' % (loop, old)
-        print 'New x%s: %.6f' % (loop, new)
-        if ciidifference is not None:
-            print 'Cyt x%s: %.6f - factor: %.2f' % (loop, c, old / c)
-
-    def test_heavy_start(self):
-        bigsize = BIGSETSIZE
-        smallsize = SMALLSETSIZE
-        small = IISet(xrange(smallsize))
-        large = IITreeSet(xrange(bigsize))
-        print '\nDifference Small set low values + large treeset'
-        self.timing(small, large)
+    def insert(self, keys):
+        new = IISet()
+        ins = new.insert
+        for k in keys:
+            ins(k)
+        return new
+
+    def timing(self, keys, text=''):
+        inserted = benchmark.measure(self.insert, (keys, ))
+        constructed = benchmark.measure(IISet, (keys, ))
+        built = benchmark.measure(buildset, (IISet, keys))
+        # The objects left behind, the set itself included
+        counts = [benchmark.allocations(func, args) for func, args in (
+            (self.insert, (keys, )), (IISet, (keys, )),
+            (buildset, (IISet, keys)))]
+        print
+        print text
+        print 'Insert: %.2f us - objects: %d' % (
+            inserted['median'] * 1e6, counts[0])
+        print 'IISet:  %.2f us - factor: %.2f - objects: %d' % (
+            constructed['median'] * 1e6,
+            inserted['median'] / constructed['median'], counts[1])
+        print 'Build:  %.2f us - factor: %.2f - objects: %d' % (
+            built['median'] * 1e6, inserted['median'] / built['median'],
+            counts[2])
+
+    def test_small(self):
+        self.timing(range(SMALLSETSIZE), 'Build small set')
 
-        small = IISet(xrange(smallsize))
-        large = IISet(xrange(bigsize))
-        print '\nDifference Small set low values + large set'
-        self.timing(small, large)
+    def test_medium(self):
+        self.timing(range(0, BIGSETSIZE, 100), 'Build medium set')
 
-    def test_heavy_end(self):
-        bigsize = BIGSETSIZE
-        smallsize = SMALLSETSIZE
-        small = IISet(xrange(bigsize-smallsize,bigsize))
-        large = IITreeSet(xrange(bigsize))
-        print '\nDifference Small set high values + large treeset'
-        self.timing(small, large)
+    def test_large(self):
+        self.timing(range(BIGSETSIZE / 10), 'Build large set')
 
-        small = IISet(xrange(bigsize-smallsize,bigsize))
-        large = IISet(xrange(bigsize))
-        print '\nDifference Small set high values + large set'
-        self.timing(small, large)
 
-    def test_even_dist(self):
-        bigsize = BIGSETSIZE
-        smallsize = SMALLSETSIZE
-        small = IISet(xrange(0, bigsize, bigsize/smallsize))
-        large = IITreeSet(xrange(bigsize))
-        print '\nDifference Small set even distribution + large treeset'
-        self.timing(small, large)
+class TestBuildTree(unittest.TestCase):
+
+    level = 2
 
-        small = IISet(xrange(0, bigsize, bigsize/smallsize))
-        large = IISet(xrange(bigsize))
-        print '\nDifference Small set even distribution + large set'
-        self.timing(small, large)
+    def timing(self, keys, text=''):
+        constructed = benchmark.measure(IITreeSet, (keys, ))
+        built = benchmark.measure(buildtree, (IITreeSet, keys))
+        # The buckets and interior nodes of the tree set
+        counts = [benchmark.allocations(func, args) for func, args in (
+            (IITreeSet, (keys, )), (buildtree, (IITreeSet, keys)))]
+        print
+        print text
+        print 'IITreeSet: %.2f us - objects: %d' % (
+            constructed['median'] * 1e6, counts[0])
+        print 'Build:     %.2f us - factor: %.2f - objects: %d' % (
+            built['median'] * 1e6, constructed['median'] / built['median'],
+            counts[1])
 
     def test_large(self):
-        bigsize = BIGSETSIZE
-        small = IITreeSet(xrange(bigsize))
-        large = IITreeSet(xrange(bigsize))
-        print '\nDifference Large sets'
-        self.timing(small, large)
-
-    def test_lookup(self):
-        bigsize = 1000000
-        smallsize = 1000
-        large = IISet(xrange(bigsize))
-        small = IISet(xrange(0, bigsize, bigsize/smallsize))
-
-        start = time()
-        for i in small:
-            large[i]
-        print "\ngetitem distributed %.6f" % (time()-start)
-
-        start = time()
-        for i in small:
-            large[bigsize-1]
-        print "getitem end %.6f" % (time()-start)
-
-        start = time()
-        for i in small:
-            large[0]
-        print "getitem start %.6f" % (time()-start)
-
-        start = time()
-        for i in small:
-            large.has_key(i)
-        print "\nhas_key distributed %.6f" % (time()-start)
-
-        start = time()
-        for i in small:
-            large.has_key(bigsize-1)
-        print "has_key end %.6f" % (time()-start)
-
-        start = time()
-        for i in small:
-            large.has_key(0)
-        print "has_key start %.6f" % (time()-start)
-
-
-    def test_findlargesmallset(self):
-        # Test different approaches to finding the large and small set
-        bigsize = 10
-        smallsize = 2
-        o1 = IISet(xrange(bigsize))
-        l1 = len(o1)
-        o2 = IISet(xrange(0, bigsize, bigsize/smallsize))
-        l2 = len(o2)
-
-        # 3 approaches: if/else, sorted and max/min
-        def alternative1():
-            if l1 < l2:
-                ls = l1
-                small = o1
-                lb = l2
-                big = o2
-            else:
-                ls = l2
-                small = o2
-                lb = l1
-                big = o1
-            return (ls, small), (lb, big)
-
-        def alternative2():
-            return sorted(((l2,o2), (l1,o1)))
-
-        def alternative3():
-            small = min((l2,o2),(l1,o1))
-            big = max((l2,o2),(l1,o1))
-            return small,big
-
-        self.failUnlessEqual(list(alternative1()), list(alternative2()))
-        self.failUnlessEqual(list(alternative1()), list(alternative3()))
-
-        start = time()
-        for i in xrange(1000):
-            alternative1()
-        print '\nif/else took %.6f' % (time()-start)
-
-        start = time()
-        for i in xrange(1000):
-            alternative2()
-        print 'sorted took  %.6f' % (time()-start)
-
-        start = time()
-        for i in xrange(1000):
-            alternative3()
-        print 'minmax took  %.6f' % (time()-start)
+        self.timing(range(BIGSETSIZE), 'Build large tree set')
 
 
 def test_suite():
     from unittest import TestSuite, makeSuite
     suite = TestSuite()
-    suite.addTest(makeSuite(TestIntersection))
-    suite.addTest(makeSuite(TestDifference))
+    suite.addTest(makeSuite(TestBenchmark))
+    suite.addTest(makeSuite(TestMultiIntersection))
+    suite.addTest(makeSuite(TestParallel))
+    suite.addTest(makeSuite(TestWindow))
+    suite.addTest(makeSuite(TestBuild))
+    suite.addTest(makeSuite(TestBuildTree))
     return suite
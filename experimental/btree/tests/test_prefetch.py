@@ -0,0 +1,169 @@
+import unittest
+
+import transaction
+from BTrees.IIBTree import IISet
+from BTrees.IIBTree import IITreeSet
+from ZODB import DB
+from ZODB.Connection import Connection
+from ZODB.MappingStorage import MappingStorage
+
+from experimental.btree import prefetch
+from experimental.btree import setpatches
+from experimental.btree.buckets import buildtree
+from experimental.btree.buckets import isghost
+
+
+# Connections before ZODB 5 can't prefetch, prefetch.load loads the ghosts
+# itself then
+PREFETCH = hasattr(Connection, 'prefetch')
+
+
+class NoPrefetch(object):
+    # A jar without prefetch
+    pass
+
+
+class PrefetchingStorage(MappingStorage):
+    # Records what it's asked to prefetch, without loading anything
+
+    def __init__(self, name='Prefetching'):
+        MappingStorage.__init__(self, name)
+        self.prefetched = []
+
+    def prefetch(self, oids, tid):
+        self.prefetched.append(list(oids))
+
+
+class TestPrefetch(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = PrefetchingStorage()
+        self.db = DB(self.storage)
+        conn = self.db.open()
+        # Several levels of interior nodes
+        conn.root()['tree'] = buildtree(IITreeSet, xrange(0, 300000, 3),
+                                        fill=0.1)
+        transaction.commit()
+        conn.close()
+        self.db.cacheMinimize()
+        self.conn = self.db.open()
+        self.tree = self.conn.root()['tree']
+
+    def tearDown(self):
+        transaction.abort()
+        self.conn.close()
+        self.db.close()
+
+    def buckets(self, keys):
+        # The buckets the keys can be found in, by walking the bucket chain
+        result = []
+        bucket = self.tree._firstbucket
+        for key in keys:
+            while bucket._next is not None and bucket._next.minKey() <= key:
+                bucket = bucket._next
+            if not result or result[-1] is not bucket:
+                result.append(bucket)
+        return result
+
+    def testLeaves(self):
+        keys = IISet([0, 1, 2, 3, 4, 50000, 50001, 299997, 400000])
+        leaves = prefetch.leaves(self.tree, keys)
+        self.assertEqual([b._p_oid for b in leaves],
+                         [b._p_oid for b in self.buckets(keys)])
+
+    def testPrefetch(self):
+        keys = IISet(xrange(0, 300000, 1000))
+        self.assertEqual(prefetch.prefetch(self.tree, keys), 300)
+        if not PREFETCH:
+            return
+        # The buckets themselves weren't loaded
+        leaves = prefetch.leaves(self.tree, keys)
+        self.assertEqual([b for b in leaves if not isghost(b)], [])
+        # The ghosts of every level are prefetched together, the buckets
+        # last
+        self.assertEqual(len(self.storage.prefetched), 3)
+        self.assertEqual(self.storage.prefetched[-1],
+                         [b._p_oid for b in self.buckets(keys)])
+
+    def testFallback(self):
+        keys = IISet(xrange(0, 300000, 1000))
+        leaves = prefetch.leaves(self.tree, keys)
+        self.assertEqual(len(prefetch.load(NoPrefetch(), leaves)), 300)
+        self.assertEqual([b for b in leaves if isghost(b)], [])
+        # Loaded one by one, the storage wasn't asked to prefetch
+        self.assertEqual(self.storage.prefetched, [])
+
+    def testLoaded(self):
+        keys = IISet([5, 6])
+        self.tree.has_key(5)
+        # Nothing left to prefetch
+        self.storage.prefetched = []
+        self.assertEqual(prefetch.prefetch(self.tree, keys), 0)
+        self.assertEqual(self.storage.prefetched, [])
+
+    def testNotPersistent(self):
+        tree = IITreeSet(xrange(1000))
+        self.assertEqual(prefetch.prefetch(tree, IISet([1, 2])), 0)
+        self.assertEqual(len(prefetch.leaves(tree, IISet([1, 2]))), 1)
+
+    def testEmpty(self):
+        self.assertEqual(prefetch.leaves(self.tree, IISet()), [])
+        self.assertEqual(prefetch.leaves(IITreeSet(), IISet([1])), [])
+
+
+class TestPatched(unittest.TestCase):
+
+    def setUp(self):
+        from BTrees import IIBTree
+        self.intersection = setpatches.make_intersection(
+            IIBTree, IISet, prefetch=True)
+        self.difference = setpatches.make_difference(
+            IIBTree, IISet, prefetch=True)
+        self.storage = PrefetchingStorage()
+        self.db = DB(self.storage)
+        conn = self.db.open()
+        conn.root()['tree'] = IITreeSet(xrange(0, 100000, 2))
+        transaction.commit()
+        conn.close()
+        self.db.cacheMinimize()
+        self.conn = self.db.open()
+        self.tree = self.conn.root()['tree']
+
+    def tearDown(self):
+        transaction.abort()
+        self.conn.close()
+        self.db.close()
+
+    def testIntersection(self):
+        from BTrees.IIBTree import intersection
+        small = IISet(xrange(0, 100000, 999))
+        path = []
+        result = self.intersection(small, self.tree, path)
+        self.assertEqual(list(result),
+                         list(intersection(small, self.tree)))
+        self.assert_(path[0] in ('probe', 'gallop', 'c'), path)
+        if PREFETCH:
+            self.assertEqual(len(self.storage.prefetched), 1)
+
+    def testDifference(self):
+        from BTrees.IIBTree import difference
+        small = IISet(xrange(0, 100000, 999))
+        path = []
+        result = self.difference(small, self.tree, path)
+        self.assertEqual(list(result), list(difference(small, self.tree)))
+        if PREFETCH and path[0] in ('probe', 'walk'):
+            self.assertEqual(len(self.storage.prefetched), 1)
+
+    def testTransient(self):
+        small = IISet(xrange(0, 100000, 999))
+        tree = IITreeSet(xrange(0, 100000, 2))
+        self.assertEqual(list(self.intersection(small, tree)),
+                         range(0, 100000, 1998))
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestPrefetch))
+    suite.addTest(makeSuite(TestPatched))
+    return suite
@@ -0,0 +1,246 @@
+import unittest
+
+from BTrees.IIBTree import IISet
+from BTrees.IIBTree import IITreeSet
+from BTrees.IIBTree import multiunion
+from BTrees.IOBTree import IOBTree
+from BTrees.OOBTree import OOBTree
+
+from experimental.btree import evaluation
+from experimental.btree import probing
+from experimental.btree import setpatches
+from experimental.btree.multiintersection import multiintersection
+
+
+class FieldIndex(object):
+    # Just enough of a field index, it computes the whole result
+
+    def __init__(self, id):
+        self.id = id
+        self._index = OOBTree()
+        self._unindex = IOBTree()
+        self.calls = 0
+
+    def getId(self):
+        return self.id
+
+    def index_object(self, documentId, obj):
+        value = getattr(obj, self.id)
+        self._index.setdefault(value, IITreeSet()).insert(documentId)
+        self._unindex[documentId] = value
+
+    def _apply_index(self, request, resultset=None):
+        parsed = probing.parse(self, request)
+        if parsed is None:
+            return None
+        self.calls += 1
+        values, range, operator = parsed
+        if range:
+            lo = hi = None
+            if 'min' in range:
+                lo = min(values)
+            if 'max' in range:
+                hi = max(values)
+            sets = self._index.values(lo, hi)
+        else:
+            sets = [self._index.get(v, IISet()) for v in values]
+        if operator == 'and':
+            return multiintersection(*sets), (self.id, )
+        return multiunion(sets), (self.id, )
+
+
+class KeywordIndex(FieldIndex):
+
+    useOperator = 'or'
+
+    def index_object(self, documentId, obj):
+        keywords = getattr(obj, self.id)
+        for keyword in keywords:
+            self._index.setdefault(keyword, IITreeSet()).insert(documentId)
+        self._unindex[documentId] = list(keywords)
+
+
+class OldIndex(FieldIndex):
+
+    def _apply_index(self, request, cid=''):
+        return FieldIndex._apply_index(self, request)
+
+
+class DateRangeIndex(object):
+
+    _since_field = 'start'
+    _until_field = 'end'
+
+    def __init__(self, id):
+        self.id = id
+        self._unindex = IOBTree()
+
+    def getId(self):
+        return self.id
+
+    def _convertDateTime(self, value):
+        return value
+
+    def _apply_index(self, request, resultset=None):
+        term = request.get(self.id)
+        if term is None:
+            return None
+        result = []
+        for documentId, (since, until) in self._unindex.items():
+            if ((since is None or since <= term) and
+                (until is None or until >= term)):
+                result.append(documentId)
+        return IISet(result), (self._since_field, self._until_field)
+
+
+class Document(object):
+
+    def __init__(self, **kw):
+        self.__dict__.update(kw)
+
+
+class TestProbing(unittest.TestCase):
+
+    def setUp(self):
+        setpatches.patch_probing(FieldIndex, probing.probe_field)
+        probing.register(KeywordIndex, probing.probe_keyword)
+        self.color = FieldIndex('color')
+        self.size = FieldIndex('size')
+        self.tags = KeywordIndex('tags')
+        for i in xrange(1000):
+            doc = Document(color=i % 3, size=i % 50,
+                           tags=['t%d' % (i % 4), 't%d' % (i % 6)])
+            for index in (self.color, self.size, self.tags):
+                index.index_object(i, doc)
+
+    def tearDown(self):
+        setpatches.unpatch_probing(FieldIndex)
+        probing.unregister(KeywordIndex)
+
+    def check(self, index, query, resultset):
+        request = {index.getId(): query}
+        full = index._old_probing(request)[0]
+        expected = [i for i in resultset if full.has_key(i)]
+        calls = index.calls
+        result, used = index._apply_index(request, resultset)
+        self.assertEqual(list(result), expected)
+        self.assertEqual(used, (index.getId(), ))
+        # Nothing was computed
+        self.assertEqual(index.calls, calls)
+
+    def testField(self):
+        resultset = IISet(xrange(0, 1000, 50))
+        self.check(self.color, 1, resultset)
+        self.check(self.color, [0, 2], resultset)
+        self.check(self.color, {'query': 1}, resultset)
+        self.check(self.size, {'query': [10, 20], 'range': 'min:max'},
+                   IISet(xrange(0, 1000, 17)))
+        self.check(self.size, {'query': 40, 'range': 'min'},
+                   IISet(xrange(0, 1000, 17)))
+
+    def testKeyword(self):
+        resultset = IISet(xrange(0, 1000, 11))
+        self.check(self.tags, 't1', resultset)
+        self.check(self.tags, ['t1', 't5'], resultset)
+        self.check(self.tags, {'query': ['t1', 't3'], 'operator': 'and'},
+                   resultset)
+        request = {'tags': {'query': ['t1', 't3'], 'operator': 'and'}}
+        result, used = self.tags._apply_index(request, resultset)
+        self.assertEqual(list(result),
+                         [i for i in resultset
+                          if set([i % 4, i % 6]) == set([1, 3])])
+
+    def testLargeResultset(self):
+        resultset = IISet(xrange(probing.THRESHOLD))
+        result, used = self.color._apply_index({'color': 1}, resultset)
+        self.assertEqual(self.color.calls, 1)
+        self.assertEqual(len(result), 333)
+
+    def testNoResultset(self):
+        self.color._apply_index({'color': 1})
+        self.assertEqual(self.color.calls, 1)
+
+    def testNotHandled(self):
+        request = {'color': {'query': 1, 'not': 2}}
+        self.assertEqual(probing.probe(self.color, request, IISet([1])),
+                         None)
+        self.assertEqual(probing.probe(self.color, {}, IISet([1])), None)
+
+    def testFieldOperator(self):
+        resultset = IISet(xrange(0, 1000, 50))
+        self.check(self.color, {'query': [1], 'operator': 'and'}, resultset)
+        self.check(self.color, {'query': [0, 2], 'operator': 'or'},
+                   resultset)
+        # An id has only one color, the index computes the empty result
+        for query in ({'query': [0, 2], 'operator': 'and'},
+                      {'query': 0, 'range': 'min', 'operator': 'and'},
+                      {'query': [0, 2], 'operator': 'xor'}):
+            self.assertEqual(
+                probing.probe(self.color, {'color': query}, resultset), None)
+        calls = self.color.calls
+        result, used = self.color._apply_index(
+            {'color': {'query': [0, 2], 'operator': 'and'}}, resultset)
+        self.assertEqual(list(result), [])
+        self.assertEqual(self.color.calls, calls + 1)
+
+    def testExact(self):
+        class ListIndex(FieldIndex):
+            # Stores lists, which probe_field can't look up
+            def index_object(self, documentId, obj):
+                FieldIndex.index_object(self, documentId, obj)
+                self._unindex[documentId] = [getattr(obj, self.id)]
+        probing.register(FieldIndex, probing.probe_field, subclasses=False)
+        index = ListIndex('color')
+        for i in xrange(10):
+            index.index_object(i, Document(color=i % 3))
+        result, used = index._apply_index({'color': 1}, IISet(xrange(5)))
+        self.assertEqual(list(result), [1, 4, 7])
+        self.assertEqual(index.calls, 1)
+        self.assertEqual(probing.prober(self.color), probing.probe_field)
+
+    def testRequestOptions(self):
+        resultset = IISet(xrange(0, 1000, 50))
+        for option, value in (('usage', 'range:min'), ('range', 'min'),
+                              ('operator', 'and')):
+            request = {'size': 40, 'size_' + option: value}
+            self.assertEqual(probing.probe(self.size, request, resultset),
+                             None)
+
+    def testNotPatched(self):
+        setpatches.patch_probing(OldIndex, probing.probe_field)
+        try:
+            self.failIf('_old_probing' in OldIndex.__dict__)
+        finally:
+            setpatches.unpatch_probing(OldIndex)
+
+    def testDateRange(self):
+        index = DateRangeIndex('effective')
+        for i in xrange(100):
+            since = i % 3 and i or None
+            until = i % 5 and i + 10 or None
+            index._unindex[i] = (since, until)
+        resultset = IISet(xrange(0, 100, 7))
+        result, used = probing.probe_daterange(index, {'effective': 50},
+                                               resultset)
+        full = index._apply_index({'effective': 50})[0]
+        self.assertEqual(list(result), [i for i in resultset if i in full])
+        self.assertEqual(used, ('start', 'end'))
+
+    def testSequential(self):
+        # Only the first index computes its result
+        request = {'size': 7, 'color': 1, 'tags': 't3'}
+        result = evaluation.sequential([self.size, self.color, self.tags],
+                                       request)
+        self.assertEqual(list(result),
+                         [i for i in xrange(1000)
+                          if i % 50 == 7 and i % 3 == 1 and i % 4 == 3])
+        self.assertEqual(self.size.calls, 1)
+        self.assertEqual(self.color.calls, 0)
+        self.assertEqual(self.tags.calls, 0)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestProbing))
+    return suite
@@ -0,0 +1,206 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from BTrees.IIBTree import IISet
+from BTrees.IIBTree import IITreeSet
+
+from experimental.btree import costmodel
+from experimental.btree import evaluation
+from experimental.btree import probing
+from experimental.btree import querystats
+from experimental.btree import setpatches
+from experimental.btree.tests.test_probing import Document
+from experimental.btree.tests.test_probing import FieldIndex
+
+
+class TestStore(unittest.TestCase):
+
+    def setUp(self):
+        querystats.reset()
+
+    def tearDown(self):
+        querystats.reset()
+
+    def testShape(self):
+        self.assertEqual(querystats.shape('review_state', 'published'),
+                         ('review_state', ))
+        self.assertEqual(querystats.shape('review_state', ['a']),
+                         ('review_state', ))
+        self.assertEqual(querystats.shape('Subject', ['a', 'b']),
+                         ('Subject', 'list'))
+        self.assertEqual(
+            querystats.shape('Subject', {'query': ['a', 'b'],
+                                         'operator': 'and'}),
+            ('Subject', 'operator:and', 'list'))
+        self.assertEqual(
+            querystats.shape('effective', {'query': 1, 'range': 'max'}),
+            ('effective', 'range:max'))
+
+    def testEstimate(self):
+        key = ('index', )
+        self.assertEqual(querystats.estimate(key), None)
+        for size in (10, 20, 30):
+            querystats.record(key, size, size / 1000.0)
+            if size == 10:
+                # Not enough measurements yet
+                self.assertEqual(querystats.estimate(key), None)
+        size, elapsed = querystats.estimate(key)
+        self.assertAlmostEqual(size, 20)
+        self.assertAlmostEqual(elapsed, 0.02)
+        self.assertAlmostEqual(querystats.factor(key), 0.001)
+        self.assertEqual(querystats.factor(('unknown', )), 1.0)
+
+    def testDecay(self):
+        key = ('index', )
+        for i in range(4):
+            querystats.record(key, 100, 1.0, now=0)
+        # New measurements count more than old ones
+        querystats.record(key, 600, 1.0, now=querystats.HALFLIFE)
+        size, elapsed = querystats.estimate(key, now=querystats.HALFLIFE)
+        # Four old ones weigh as much as two new ones
+        self.assertAlmostEqual(size, (2 * 100 + 600) / 3.0)
+        # Not enough weight left
+        self.assertEqual(
+            querystats.estimate(key, now=querystats.HALFLIFE * 3), None)
+
+    def testPrune(self):
+        old = querystats.MAXKEYS
+        querystats.MAXKEYS = 10
+        try:
+            for i in range(20):
+                querystats.record(('index', str(i)), 1, 1.0)
+            self.failUnless(len(querystats.snapshot()) <= 10)
+            self.failUnless(('index', '19') in querystats.snapshot())
+        finally:
+            querystats.MAXKEYS = old
+
+    def testDumpLoad(self):
+        for i in range(3):
+            querystats.record(('index', 'list'), 10, 0.5)
+            querystats.record(('intersection', 'probe', 'set', 'tree'),
+                              1e-05, 2e-05)
+        expected = querystats.snapshot()
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            querystats.dump(path)
+            querystats.reset()
+            querystats.load(path)
+        finally:
+            os.remove(path)
+        loaded = querystats.snapshot()
+        self.assertEqual(sorted(loaded.keys()), sorted(expected.keys()))
+        for key, stats in expected.items():
+            self.assertAlmostEqual(loaded[key]['size'], stats['size'])
+            self.assertAlmostEqual(loaded[key]['time'], stats['time'])
+        self.assertAlmostEqual(
+            querystats.factor(('intersection', 'probe', 'set', 'tree')), 2.0)
+
+    def testThreads(self):
+        def work():
+            for i in range(1000):
+                querystats.record(('index', ), 1, 0.0)
+        threads = [threading.Thread(target=work) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        snapshot = querystats.snapshot()
+        self.assertAlmostEqual(snapshot[('index', )]['weight'], 4000, 1)
+
+
+class TestUsed(unittest.TestCase):
+
+    def setUp(self):
+        querystats.reset()
+        querystats.enable()
+
+    def tearDown(self):
+        querystats.disable()
+        querystats.reset()
+        probing.unregister(FieldIndex)
+
+    def testCostModel(self):
+        small = IISet(range(10))
+        big = IITreeSet(xrange(100000))
+        strategies = ('merge', 'probe')
+        estimates = {}
+        strategy, s, b = costmodel.intersection(small, big, IISet,
+                                                strategies, estimates)
+        self.assertEqual(strategy, 'probe')
+        self.assertEqual(sorted(estimates.keys()), ['merge', 'probe'])
+        # Probing turned out to be a lot slower than estimated
+        for i in range(3):
+            querystats.record(('intersection', 'probe', 'set', 'tree'),
+                              estimates['probe'], 1.0)
+        strategy, s, b = costmodel.intersection(small, big, IISet,
+                                                strategies, {})
+        self.assertEqual(strategy, 'merge')
+        # Without estimates nothing is corrected
+        strategy, s, b = costmodel.intersection(small, big, IISet,
+                                                strategies)
+        self.assertEqual(strategy, 'probe')
+
+    def testRecorded(self):
+        from BTrees import IIBTree
+        intersection = setpatches.make_intersection(IIBTree, IISet)
+        difference = setpatches.make_difference(IIBTree, IISet)
+        small = IISet(range(10))
+        big = IITreeSet(xrange(100000))
+        self.assertEqual(list(intersection(small, big)), range(10))
+        self.assertEqual(list(difference(small, big)), [])
+        keys = [key[0] for key in querystats.snapshot()]
+        self.assertEqual(sorted(keys), ['difference', 'intersection'])
+
+    def indexes(self):
+        color = FieldIndex('color')
+        size = FieldIndex('size')
+        for i in xrange(1000):
+            doc = Document(color=i % 2, size=i % 100)
+            color.index_object(i, doc)
+            size.index_object(i, doc)
+        return color, size
+
+    def testOrder(self):
+        probing.register(FieldIndex, probing.probe_field)
+        color, size = self.indexes()
+        request = {'color': 1, 'size': 3}
+        # Without measurements they're evaluated as given
+        self.assertEqual(evaluation.order([color, size], request),
+                         [color, size])
+        for i in range(3):
+            evaluation.sequential([color], request)
+            evaluation.sequential([size], request)
+        self.assertEqual(evaluation.order([color, size], request),
+                         [size, color])
+        color.calls = 0
+        result = evaluation.sequential([color, size], request)
+        self.assertEqual(list(result), range(3, 1000, 100))
+        # The running result was small enough to probe color
+        self.assertEqual(color.calls, 0)
+
+    def testProbeCheaper(self):
+        probing.register(FieldIndex, probing.probe_field)
+        color, size = self.indexes()
+        request = {'color': 1}
+        resultset = IISet(xrange(0, 1000, 2))
+        self.failUnless(len(resultset) >= probing.THRESHOLD)
+        self.failIf(probing.cheaper(color, request, len(resultset)))
+        self.assertEqual(probing.probe(color, request, resultset), None)
+        # Computing the result was slow, probing fast
+        for i in range(3):
+            querystats.record(('color', ), 500, 1.0)
+            querystats.record(('color', 'probe'), 50, 0.0001)
+        self.failUnless(probing.cheaper(color, request, len(resultset)))
+        result, used = probing.probe(color, request, resultset)
+        self.assertEqual(list(result), [])
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestStore))
+    suite.addTest(makeSuite(TestUsed))
+    return suite
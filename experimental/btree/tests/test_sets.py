@@ -1,3 +1,5 @@
+import unittest
+
 from experimental.btree import setpatches
 setpatches.apply()
 
@@ -19,8 +21,42 @@ from BTrees.OOBTree import intersection as oointersection
 from BTrees.OOBTree import difference as oodifference
 from BTrees.OOBTree import OOSet, OOTreeSet, OOBTree, OOBucket
 
+from BTrees.LLBTree import intersection as llintersection
+from BTrees.LLBTree import weightedIntersection as llweightedIntersection
+from BTrees.LLBTree import difference as lldifference
+from BTrees.LLBTree import LLSet, LLTreeSet, LLBTree, LLBucket
+
+from BTrees.LOBTree import intersection as lointersection
+from BTrees.LOBTree import difference as lodifference
+from BTrees.LOBTree import LOSet, LOTreeSet, LOBTree, LOBucket
+
+from BTrees.LFBTree import intersection as lfintersection
+from BTrees.LFBTree import weightedIntersection as lfweightedIntersection
+from BTrees.LFBTree import difference as lfdifference
+from BTrees.LFBTree import LFSet, LFTreeSet, LFBTree, LFBucket
+
 from BTrees.tests import testSetOps
 
+from experimental.btree import bitmap
+from experimental.btree import costmodel
+from experimental.btree.buckets import buildbucket
+from experimental.btree.buckets import buildset
+from experimental.btree.buckets import buildtree
+from experimental.btree.buckets import estimate_range
+from experimental.btree.buckets import estimate_size
+from experimental.btree.buckets import ismapping
+from experimental.btree.buckets import iterbuckets
+from experimental.btree.galloping import galloping_intersection
+from experimental.btree.galloping import galloping_weightedIntersection
+from experimental.btree.galloping import walking_difference
+from experimental.btree.lazy import lazydifference
+from experimental.btree.lazy import lazyintersection
+from experimental.btree.multiintersection import multiintersection
+from experimental.btree import mapped
+from experimental.btree import parallel
+from experimental.btree import vectorized
+from experimental.btree import window
+
 
 class SetResult(testSetOps.SetResult):
 
@@ -72,6 +108,30 @@ class TestPureOI(SetResult):
         return oidifference(o1, o2)
     builders = OISet, OITreeSet, testSetOps.makeBuilder(OIBTree), testSetOps.makeBuilder(OIBucket)
 
+class TestPureLL(SetResult):
+    from BTrees.LLBTree import union
+    def intersection(self, o1, o2):
+        return llintersection(o1, o2)
+    def difference(self, o1, o2):
+        return lldifference(o1, o2)
+    builders = LLSet, LLTreeSet, testSetOps.makeBuilder(LLBTree), testSetOps.makeBuilder(LLBucket)
+
+class TestPureLO(SetResult):
+    from BTrees.LOBTree import union
+    def intersection(self, o1, o2):
+        return lointersection(o1, o2)
+    def difference(self, o1, o2):
+        return lodifference(o1, o2)
+    builders = LOSet, LOTreeSet, testSetOps.makeBuilder(LOBTree), testSetOps.makeBuilder(LOBucket)
+
+class TestPureLF(SetResult):
+    from BTrees.LFBTree import union
+    def intersection(self, o1, o2):
+        return lfintersection(o1, o2)
+    def difference(self, o1, o2):
+        return lfdifference(o1, o2)
+    builders = LFSet, LFTreeSet, testSetOps.makeBuilder(LFBTree), testSetOps.makeBuilder(LFBucket)
+
 
 class TestWeightedII(testSetOps.Weighted):
     def intersection(self, o1, o2):
@@ -94,6 +154,1172 @@ class TestWeightedOI(testSetOps.Weighted):
     builders = OIBucket, OIBTree, testSetOps.itemsToSet(OISet), testSetOps.itemsToSet(OITreeSet)
 
 
+class TestWeightedLL(testSetOps.Weighted):
+    def intersection(self, o1, o2):
+        return llintersection(o1, o2)
+    def weightedIntersection(self, o1, o2, w1=1, w2=1):
+        return llweightedIntersection(o1, o2, w1, w2)
+    from BTrees.LLBTree import weightedUnion, union
+    from BTrees.LLBTree import LLBucket as mkbucket
+    builders = LLBucket, LLBTree, testSetOps.itemsToSet(LLSet), testSetOps.itemsToSet(LLTreeSet)
+
+
+class TestWeightedLF(testSetOps.Weighted):
+    def intersection(self, o1, o2):
+        return lfintersection(o1, o2)
+    def weightedIntersection(self, o1, o2, w1=1, w2=1):
+        return lfweightedIntersection(o1, o2, w1, w2)
+    from BTrees.LFBTree import weightedUnion, union
+    from BTrees.LFBTree import LFBucket as mkbucket
+    builders = LFBucket, LFBTree, testSetOps.itemsToSet(LFSet), testSetOps.itemsToSet(LFTreeSet)
+
+
+class TestGalloping(unittest.TestCase):
+
+    bigsize = 10000
+    smallsize = 30
+    builders = (IISet, IITreeSet, testSetOps.makeBuilder(IIBTree),
+                testSetOps.makeBuilder(IIBucket))
+
+    def _check(self, smallkeys, bigkeys):
+        for b1 in self.builders:
+            for b2 in self.builders:
+                small = b1(smallkeys)
+                big = b2(bigkeys)
+                expected = list(iiintersection(small, big))
+                self.assertEqual(
+                    list(galloping_intersection(small, big, IISet)), expected)
+                self.assertEqual(
+                    list(galloping_intersection(big, small, IISet)), expected)
+
+    def testEmpty(self):
+        self._check([], range(self.bigsize))
+        self._check(range(self.smallsize), [])
+
+    def test_heavy_start(self):
+        bigsize = self.bigsize
+        smallsize = self.smallsize
+        self._check(range(smallsize), range(smallsize))
+        self._check(range(smallsize), range(bigsize))
+
+    def test_heavy_end(self):
+        bigsize = self.bigsize
+        smallsize = self.smallsize
+        self._check(range(bigsize-smallsize, bigsize), range(smallsize))
+        self._check(range(bigsize-smallsize, bigsize), range(bigsize))
+
+    def test_even_dist(self):
+        bigsize = self.bigsize
+        smallsize = self.smallsize
+        self._check(range(0, bigsize, bigsize/smallsize), range(smallsize))
+        self._check(range(0, bigsize, bigsize/smallsize), range(bigsize))
+
+    def test_removed_keys(self):
+        # Removing keys leaves the separators in the tree unchanged, keys
+        # between the last key of a bucket and the next separator must not
+        # confuse the cursor.
+        big = IITreeSet(xrange(0, self.bigsize, 2))
+        for i in xrange(0, self.bigsize, 6):
+            big.remove(i)
+        small = IISet(xrange(0, self.bigsize, 5))
+        self.assertEqual(list(galloping_intersection(small, big, IISet)),
+                         list(iiintersection(small, big)))
+
+
+class TestWeightedStrategies(unittest.TestCase):
+
+    def setUp(self):
+        from BTrees import IIBTree, OIBTree
+        self.stock = {
+            IIBucket: IIBTree._old_weightedIntersection,
+            OIBucket: OIBTree._old_weightedIntersection,
+        }
+
+    def families(self):
+        # A few hundred keys of the small operand against many buckets
+        small = range(0, 3000, 7)
+        big = range(0, 3000, 3)
+        yield IIBucket, small, big, (IISet, IITreeSet), (IIBucket, IIBTree)
+        small = ['%05d' % k for k in small]
+        big = ['%05d' % k for k in big]
+        yield OIBucket, small, big, (OISet, OITreeSet), (OIBucket, OIBTree)
+
+    def check(self, func):
+        for buckettype, small, big, sets, mappings in self.families():
+            operands = []
+            for keys in small, big:
+                ops = [settype(keys) for settype in sets]
+                items = [(k, len(str(k))) for k in keys]
+                ops.extend(mapping(items) for mapping in mappings)
+                operands.append(ops)
+            for s in operands[0]:
+                for b in operands[1]:
+                    if not (ismapping(s) or ismapping(b)):
+                        continue
+                    weight, result = func(s, b, buckettype, 2, 3)
+                    expected = self.stock[buckettype](s, b, 2, 3)
+                    self.assertEqual(weight, expected[0])
+                    self.assertEqual(type(result), type(expected[1]))
+                    self.assertEqual(result.items(), expected[1].items())
+
+    def testProbe(self):
+        self.check(setpatches.probe_weightedIntersection)
+
+    def testGalloping(self):
+        self.check(galloping_weightedIntersection)
+
+
+class TestDifferenceStrategies(unittest.TestCase):
+
+    def operands(self, keys):
+        items = [(k, -k) for k in keys]
+        return [IISet(keys), IITreeSet(keys), IIBucket(items), IIBTree(items)]
+
+    def check(self, func):
+        from BTrees import IIBTree as module
+        cases = [
+            (range(0, 3000, 7), range(0, 30000, 3)),
+            (range(0, 30000, 3), range(0, 3000, 7)),
+            (range(1000), range(2000, 3000)),
+            (range(2000, 3000), range(1000)),
+            (range(1000), range(1000)),
+        ]
+        for keys1, keys2 in cases:
+            for o1 in self.operands(keys1):
+                for o2 in self.operands(keys2):
+                    result = func(o1, o2, IISet, IIBucket)
+                    expected = module._old_difference(o1, o2)
+                    self.assertEqual(type(result), type(expected))
+                    if hasattr(expected, 'items'):
+                        self.assertEqual(result.items(), expected.items())
+                    else:
+                        self.assertEqual(list(result), list(expected))
+
+    def testProbe(self):
+        self.check(setpatches.probe_difference)
+
+    def testWalk(self):
+        self.check(walking_difference)
+
+
+class TestSmallSet(unittest.TestCase):
+    # A small set against a tree takes the fast path of the patches
+
+    def setUp(self):
+        from BTrees import _IIBTree
+        self.stock = _IIBTree
+        self.small = IISet(xrange(0, 3000, 70))
+        self.bigs = [IITreeSet(xrange(0, 3000, 3)),
+                     IIBTree([(k, k) for k in xrange(0, 3000, 3)])]
+
+    def testIntersection(self):
+        from experimental.btree.intersection import ciiintersection
+        for cintersection, strategy in ((None, 'probe'),
+                                        (ciiintersection, 'c')):
+            intersection = setpatches.make_intersection(
+                self.stock, IISet, cintersection=cintersection)
+            for big in self.bigs:
+                for o1, o2 in ((self.small, big), (big, self.small)):
+                    path = []
+                    result = intersection(o1, o2, path)
+                    self.assertEqual(path, [strategy])
+                    self.assertEqual(type(result), IISet)
+                    self.assertEqual(list(result),
+                                     list(self.stock.intersection(o1, o2)))
+        # Galloping never probes from the root
+        intersection = setpatches.make_intersection(self.stock, IISet,
+                                                    galloping=True)
+        path = []
+        intersection(self.small, self.bigs[0], path)
+        self.assertNotEqual(path, ['probe'])
+
+    def testDifference(self):
+        difference = setpatches.make_difference(self.stock, IISet)
+        for big in self.bigs:
+            path = []
+            result = difference(self.small, big, path)
+            self.assertEqual(path, ['probe'])
+            self.assertEqual(list(result),
+                             list(self.stock.difference(self.small, big)))
+            # The other way round the whole tree is looked at
+            path = []
+            difference(big, self.small, path)
+            self.assertNotEqual(path, ['probe'])
+
+    def testEmpty(self):
+        intersection = setpatches.make_intersection(self.stock, IISet)
+        path = []
+        result = intersection(IISet(), self.bigs[0], path)
+        self.assertEqual(path, [])
+        self.assertEqual(list(result), [])
+
+
+class TestMultiIntersection(unittest.TestCase):
+
+    def _chained(self, *sets):
+        result = None
+        for o in sets:
+            result = iiintersection(result, o)
+        return result
+
+    def _check(self, *sets):
+        expected = self._chained(*sets)
+        result = multiintersection(*sets)
+        if expected is None:
+            self.assert_(result is None)
+        else:
+            self.assertEqual(list(result), list(expected))
+
+    def testNone(self):
+        self.assert_(multiintersection() is None)
+        self.assert_(multiintersection(None, None) is None)
+        s = IISet([1, 2])
+        self.assert_(multiintersection(None, s, None) is s)
+
+    def testEmpty(self):
+        self._check(IISet(), IITreeSet(xrange(1000)), IISet([1, 2]))
+        self._check(IISet([1, 2]), IISet([3, 4]), IITreeSet(xrange(10)))
+
+    def testMixed(self):
+        builders = (IISet, IITreeSet, testSetOps.makeBuilder(IIBTree),
+                    testSetOps.makeBuilder(IIBucket))
+        keys = (range(0, 1000, 3), range(0, 1000, 5), range(500),
+                range(0, 1000, 7))
+        for b1 in builders:
+            for b2 in builders:
+                for b3 in builders:
+                    for b4 in builders:
+                        self._check(b1(keys[0]), b2(keys[1]),
+                                    b3(keys[2]), b4(keys[3]))
+
+    def testLarge(self):
+        self._check(IITreeSet(xrange(0, 10000, 2)),
+                    IITreeSet(xrange(0, 10000, 3)),
+                    IITreeSet(xrange(0, 10000, 5)))
+
+
+class TestLazy(unittest.TestCase):
+
+    def operands(self, keys):
+        return [IISet(keys), IITreeSet(keys),
+                IIBTree([(k, -k) for k in keys])]
+
+    def testIntersection(self):
+        for o1 in self.operands(range(0, 10000, 2)):
+            for o2 in self.operands(range(0, 10000, 3)):
+                result = lazyintersection(o1, o2)
+                expected = list(iiintersection(o1, o2))
+                self.assertEqual(list(result), expected)
+                self.assertEqual(len(result), len(expected))
+                self.assertEqual(list(result.materialize()), expected)
+
+    def testDifference(self):
+        for o1 in self.operands(range(0, 10000, 2)):
+            for o2 in self.operands(range(0, 10000, 3)):
+                result = lazydifference(o1, o2)
+                expected = iidifference(o1, o2)
+                self.assertEqual(list(result), list(expected))
+                materialized = result.materialize()
+                self.assertEqual(type(materialized), type(expected))
+                if hasattr(expected, 'items'):
+                    self.assertEqual(materialized.items(), expected.items())
+
+    def testOnDemand(self):
+        big = IITreeSet(xrange(100000))
+        result = lazyintersection(IITreeSet(xrange(0, 100000, 2)), big)
+        self.assertEqual(result[:5], [0, 2, 4, 6, 8])
+        self.assertEqual(result[10], 20)
+        self.assert_(result._seen < 100)
+        # All keys matched so far, so we expect the size of the small one
+        self.assert_(abs(result.estimate() - 50000) < 1000)
+        self.assertEqual(len(result), 50000)
+        self.assertEqual(result[-1], 99998)
+
+    def testEmpty(self):
+        self.failIf(lazyintersection(IISet([1, 2]), IITreeSet([3])))
+        self.failIf(lazyintersection(IISet(), IITreeSet([3])))
+        self.failIf(lazydifference(IISet([1, 2]), IISet([1, 2])))
+        self.assertEqual(list(lazydifference(IISet([1, 2]), IISet())), [1, 2])
+        self.assert_(lazyintersection(None, None) is None)
+
+
+class TestEstimateSize(unittest.TestCase):
+
+    def _check(self, o):
+        size = len(o)
+        estimate = estimate_size(o)
+        self.assert_(size * 0.7 <= estimate <= size * 1.3,
+                     '%s estimated as %s' % (size, estimate))
+
+    def testSmall(self):
+        for builder in (IISet, IITreeSet, testSetOps.makeBuilder(IIBTree)):
+            self.assertEqual(estimate_size(builder([])), 0)
+            self.assertEqual(estimate_size(builder(range(10))), 10)
+
+    def testLarge(self):
+        import random
+        self._check(IITreeSet(xrange(100000)))
+        self._check(IITreeSet(random.sample(xrange(1000000), 100000)))
+        self._check(IIBTree(zip(xrange(100000), xrange(100000))))
+        self._check(OOTreeSet(xrange(100000)))
+
+    def testGhosts(self):
+        import transaction
+        from ZODB import DB
+        from ZODB.MappingStorage import MappingStorage
+        db = DB(MappingStorage())
+        conn = db.open()
+        conn.root()['tree'] = IITreeSet(xrange(100000))
+        transaction.commit()
+        conn.close()
+        db.cacheMinimize()
+
+        conn = db.open()
+        tree = conn.root()['tree']
+        estimate = estimate_size(tree)
+        # Only the root and a few nodes below it were loaded, not the more
+        # than 800 buckets.
+        self.assert_(conn._cache.cache_non_ghost_count < 20)
+        self.assert_(100000 * 0.7 <= estimate <= 100000 * 1.5)
+        conn.close()
+        db.close()
+
+    def testRange(self):
+        self.assertEqual(estimate_range(IISet(range(0, 100, 2)), 10, 20), 6)
+        self.assertEqual(estimate_range(IITreeSet(range(10)), 3, 20), 7)
+        tree = IITreeSet(xrange(100000))
+        estimate = estimate_range(tree, 20000, 40000)
+        self.assert_(20000 * 0.7 <= estimate <= 20000 * 1.3, estimate)
+        # At most part of a bucket at the edge
+        self.assert_(estimate_range(tree, -10, -1) < 120)
+        self.assert_(estimate_range(tree, 500, 520) < 120)
+
+
+class TestBuild(unittest.TestCase):
+
+    def testSet(self):
+        for settype in (IISet, IITreeSet, OOSet):
+            new = buildset(settype, [1, 2, 5])
+            self.assertEqual(type(new), settype)
+            self.assertEqual(list(new), [1, 2, 5])
+            new.insert(3)
+            self.assertEqual(list(new), [1, 2, 3, 5])
+
+    def testBucket(self):
+        new = buildbucket(IIBucket, [1, 2, 5], [10, 20, 50])
+        self.assertEqual(new.items(), [(1, 10), (2, 20), (5, 50)])
+
+    def testEmpty(self):
+        self.assertEqual(len(buildset(IISet, [])), 0)
+        self.assertEqual(len(buildbucket(IIBucket, [], [])), 0)
+
+    def testTree(self):
+        # One bucket, one level of buckets and two levels
+        for n in (0, 1, 120, 121, 60001, 200000):
+            keys = range(n)
+            new = buildtree(IITreeSet, keys)
+            new._check()
+            self.assertEqual(list(new), keys)
+            new.insert(-1)
+            new.insert(n + 1)
+            new._check()
+            self.assertEqual(len(new), n + 2)
+            new = buildtree(IIBTree, keys, [2 * k for k in keys])
+            new._check()
+            self.assertEqual(list(new.items()), [(k, 2 * k) for k in keys])
+        new = buildtree(OOTreeSet, [str(k) for k in xrange(10000)])
+        new._check()
+        self.assertEqual(len(new), 10000)
+
+    def testTreeFill(self):
+        keys = range(100000)
+        packed = buildtree(IITreeSet, keys)
+        half = buildtree(IITreeSet, iter(keys), fill=0.5)
+        half._check()
+        self.assertEqual(list(half), keys)
+        self.assertEqual(len(list(iterbuckets(packed))), 834)
+        self.assertEqual(len(list(iterbuckets(half))), 1667)
+        new = buildtree(LLBTree, xrange(10), (k * 3 for k in xrange(10)),
+                        fill=0.01)
+        new._check()
+        self.assertEqual(list(new.values()), range(0, 30, 3))
+
+    def testTreeFromArray(self):
+        from array import array
+        new = buildset(IITreeSet, array('i', [1, 5, 9]))
+        self.assertEqual(type(new), IITreeSet)
+        self.assertEqual(list(new), [1, 5, 9])
+
+
+class TestCostModel(unittest.TestCase):
+
+    strategies = ('merge', 'probe', 'gallop')
+
+    def setUp(self):
+        self.coefficients = costmodel.COEFFICIENTS.copy()
+
+    def tearDown(self):
+        costmodel.COEFFICIENTS.clear()
+        costmodel.COEFFICIENTS.update(self.coefficients)
+
+    def testIntersection(self):
+        small = IISet(xrange(10))
+        big = IISet(xrange(100000))
+        strategy, s, b = costmodel.intersection(
+            big, small, IISet, self.strategies)
+        self.assertEqual(strategy, 'probe')
+        self.assert_(s is small)
+        self.assert_(b is big)
+
+        strategy, s, b = costmodel.intersection(
+            big, IISet(xrange(100000)), IISet, self.strategies)
+        self.assertEqual(strategy, 'merge')
+
+        small = IITreeSet(xrange(10))
+        big = IITreeSet(xrange(100000))
+        strategy, s, b = costmodel.intersection(
+            big, small, IISet, self.strategies)
+        self.assertEqual(strategy, 'probe')
+        self.assert_(s is small)
+
+    def testDifference(self):
+        small = IISet(xrange(10))
+        big = IITreeSet(xrange(100000))
+        self.assertEqual(
+            costmodel.difference(small, big, IISet, self.strategies), 'probe')
+        # Tree sets and mappings as the first argument are probed as well.
+        # Their keys are spread out, the stock merge walks all of big.
+        small = IIBTree([(k, k) for k in xrange(0, 100000, 10000)])
+        self.assertEqual(
+            costmodel.difference(small, big, IISet, self.strategies), 'probe')
+        self.assertEqual(
+            costmodel.difference(big, small, IISet, self.strategies), 'merge')
+
+    def testCompiledDifference(self):
+        # The compiled difference counts the keys of o2, it's only used
+        # where that's cheap
+        o1 = IISet(xrange(0, 100000, 200))
+        strategies = ('merge', 'walk', 'c')
+        self.assertNotEqual(costmodel.difference(
+            o1, IITreeSet(xrange(200000)), IISet, strategies), 'c')
+        self.assertEqual(costmodel.difference(
+            o1, IISet(xrange(200000)), IISet, strategies), 'c')
+
+    def testSmallSet(self):
+        # The size of the tree isn't estimated at all
+        def estimate_size(o):
+            raise AssertionError('Estimated %r' % o)
+        old = costmodel.estimate_size
+        costmodel.estimate_size = estimate_size
+        try:
+            small = IISet(xrange(10))
+            big = IITreeSet(xrange(100000))
+            strategy, s, b = costmodel.intersection(
+                big, small, IISet, self.strategies)
+            self.assertEqual(strategy, 'probe')
+            self.assert_(s is small)
+            self.assert_(b is big)
+            strategy, s, b = costmodel.intersection(
+                small, big, IISet, self.strategies + ('c', ))
+            self.assertEqual(strategy, 'c')
+            self.assertEqual(
+                costmodel.difference(small, big, IISet,
+                                     self.strategies + ('c', )),
+                'probe')
+        finally:
+            costmodel.estimate_size = old
+        # Without probing the cost model decides
+        strategy, s, b = costmodel.intersection(
+            small, big, IISet, ('merge', 'gallop'))
+        self.assertEqual(strategy, 'gallop')
+
+    def testSizeCached(self):
+        import transaction
+        from ZODB import DB
+        from ZODB.MappingStorage import MappingStorage
+        db = DB(MappingStorage())
+        conn = db.open()
+        try:
+            conn.root()['tree'] = IITreeSet(xrange(100000))
+            transaction.commit()
+            tree = conn.root()['tree']
+            estimated = costmodel.size(tree)
+            self.assertEqual(estimated, estimate_size(tree))
+            calls = []
+            old = costmodel.estimate_size
+            costmodel.estimate_size = lambda o: calls.append(o) or 0
+            try:
+                self.assertEqual(costmodel.size(tree), estimated)
+                self.assertEqual(calls, [])
+                # A new serial of the tree is estimated again
+                tree.clear()
+                transaction.commit()
+                self.assertEqual(costmodel.size(tree), 0)
+                self.assertEqual(calls, [tree])
+                # Not persistent, nothing is kept
+                other = IITreeSet(xrange(10))
+                costmodel.size(other)
+                costmodel.size(other)
+                self.assertEqual(calls, [tree, other, other])
+            finally:
+                costmodel.estimate_size = old
+        finally:
+            transaction.abort()
+            conn.close()
+            db.close()
+
+    def testProfile(self):
+        import os
+        import tempfile
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            costmodel.save_profile(path)
+            costmodel.COEFFICIENTS['probe_set'] = 1.0
+            costmodel.load_profile(path)
+            self.assertEqual(costmodel.COEFFICIENTS, self.coefficients)
+        finally:
+            os.remove(path)
+
+
+class TestVectorized(unittest.TestCase):
+
+    def setUp(self):
+        import random
+        rand = random.Random(42)
+        self.keys1 = rand.sample(xrange(100000), 5000)
+        self.keys2 = rand.sample(xrange(100000), 20000)
+        from BTrees import IIBTree
+        self.stock = IIBTree
+
+    def operands(self, keys):
+        items = [(k, k % 7) for k in keys]
+        return [IISet(keys), IITreeSet(keys), IIBucket(items), IIBTree(items)]
+
+    def contents(self, o):
+        if hasattr(o, 'items'):
+            return list(o.items())
+        return list(o)
+
+    def testIntersection(self):
+        for o1 in self.operands(self.keys1):
+            for o2 in self.operands(self.keys2):
+                result = vectorized.intersection(o1, o2, IISet)
+                self.assertEqual(type(result), IISet)
+                self.assertEqual(list(result),
+                                 list(self.stock._old_intersection(o1, o2)))
+
+    def testDifference(self):
+        for o1 in self.operands(self.keys1):
+            for o2 in self.operands(self.keys2):
+                result = vectorized.difference(o1, o2, IISet, IIBucket)
+                expected = self.stock._old_difference(o1, o2)
+                self.assertEqual(type(result), type(expected))
+                self.assertEqual(self.contents(result),
+                                 self.contents(expected))
+
+    def testUnion(self):
+        for o1 in self.operands(self.keys1):
+            for o2 in self.operands(self.keys2):
+                result = vectorized.union(o1, o2, IISet)
+                self.assertEqual(list(result),
+                                 list(self.stock.union(o1, o2)))
+
+    def testWeightedIntersection(self):
+        for o1 in self.operands(self.keys1):
+            for o2 in self.operands(self.keys2):
+                weight, result = vectorized.weightedIntersection(
+                    o1, o2, IISet, IIBucket, 2, 3)
+                eweight, expected = self.stock._old_weightedIntersection(
+                    o1, o2, 2, 3)
+                self.assertEqual(weight, eweight)
+                self.assertEqual(type(result), type(expected))
+                self.assertEqual(self.contents(result),
+                                 self.contents(expected))
+
+    def testLL(self):
+        from BTrees import LLBTree as stock
+        # Keys beyond 32 bits
+        keys1 = [2 ** 40 + k for k in self.keys1]
+        keys2 = [2 ** 40 + k for k in self.keys2]
+        o1 = LLSet(keys1)
+        o2 = LLBTree([(k, 2 ** 35) for k in keys2])
+        self.assertEqual(list(vectorized.intersection(o1, o2, LLSet)),
+                         list(stock._old_intersection(o1, o2)))
+        self.assertEqual(
+            self.contents(vectorized.difference(o2, o1, LLSet, LLBucket)),
+            self.contents(stock._old_difference(o2, o1)))
+        weight, result = vectorized.weightedIntersection(
+            o1, o2, LLSet, LLBucket, 2, 3)
+        self.assertEqual(self.contents(result), self.contents(
+            stock._old_weightedIntersection(o1, o2, 2, 3)[1]))
+
+    def testCostModel(self):
+        coefficients = costmodel.COEFFICIENTS.copy()
+        try:
+            # Make the stock implementation look slow
+            for kind in ('set', 'tree'):
+                costmodel.COEFFICIENTS['merge_' + kind] = 1.0
+            strategy, s, b = costmodel.intersection(
+                IISet(self.keys1), IISet(self.keys2), IISet,
+                ('merge', 'vector'))
+            self.assertEqual(strategy, 'vector')
+            o1 = IIBucket([(k, 1) for k in self.keys1])
+            self.assertEqual(costmodel.difference(
+                o1, IISet(self.keys2), IISet, ('merge', 'vector')),
+                'vector')
+        finally:
+            costmodel.COEFFICIENTS.clear()
+            costmodel.COEFFICIENTS.update(coefficients)
+
+    def testPythonCoefficients(self):
+        # Against the C merge copying the keys doesn't pay, against the
+        # Python implementation of BTrees it does
+        o1 = IITreeSet(self.keys1)
+        o2 = IITreeSet(self.keys2)
+        strategies = ('merge', 'vector')
+        coefficients = costmodel.COEFFICIENTS.copy()
+        try:
+            if not costmodel.PYTHON_BTREES:
+                strategy, s, b = costmodel.intersection(o1, o2, IISet,
+                                                        strategies)
+                self.assertEqual(strategy, 'merge')
+            costmodel.COEFFICIENTS.update(costmodel.PYTHON_COEFFICIENTS)
+            strategy, s, b = costmodel.intersection(o1, o2, IISet,
+                                                    strategies)
+            self.assertEqual(strategy, 'vector')
+            self.assertEqual(costmodel.union(o1, o2, strategies), 'vector')
+        finally:
+            costmodel.COEFFICIENTS.clear()
+            costmodel.COEFFICIENTS.update(coefficients)
+
+
+class TestCompiled(unittest.TestCase):
+
+    def setUp(self):
+        from BTrees import _IOBTree, _OIBTree, _OOBTree
+        from BTrees import _LFBTree, _LLBTree, _LOBTree
+        from experimental.btree.difference import ciodifference
+        from experimental.btree.difference import coidifference
+        from experimental.btree.difference import coodifference
+        from experimental.btree.difference import clfdifference
+        from experimental.btree.difference import clldifference
+        from experimental.btree.difference import clodifference
+        from experimental.btree.intersection import ciointersection
+        from experimental.btree.intersection import coiintersection
+        from experimental.btree.intersection import coointersection
+        from experimental.btree.intersection import clfintersection
+        from experimental.btree.intersection import cllintersection
+        from experimental.btree.intersection import clointersection
+        # The stock module, the types and the compiled functions
+        self.families = [
+            (_IOBTree, IOSet, IOTreeSet, IOBTree,
+             ciointersection, ciodifference),
+            (_OIBTree, OISet, OITreeSet, OIBTree,
+             coiintersection, coidifference),
+            (_OOBTree, OOSet, OOTreeSet, OOBTree,
+             coointersection, coodifference),
+            (_LLBTree, LLSet, LLTreeSet, LLBTree,
+             cllintersection, clldifference),
+            (_LOBTree, LOSet, LOTreeSet, LOBTree,
+             clointersection, clodifference),
+            (_LFBTree, LFSet, LFTreeSet, LFBTree,
+             clfintersection, clfdifference),
+        ]
+
+    def check(self, small, bigkeys):
+        keys = small + bigkeys
+        ints = [k for k in keys if type(k) is int]
+        for (stock, settype, treesettype, treetype, cintersection,
+             cdifference) in self.families:
+            if settype in (OISet, OOSet):
+                pass
+            elif len(ints) < len(keys):
+                continue
+            elif settype is IOSet and max(ints) >= 2 ** 31:
+                continue
+            s = settype(small)
+            for big in (treesettype(bigkeys),
+                        treetype([(k, 1) for k in bigkeys])):
+                expected = list(stock.intersection(s, big))
+                self.assertEqual(list(cintersection(s, big)), expected)
+                self.assertEqual(list(cintersection(big, s)), expected)
+                self.assertEqual(list(cdifference(s, big)),
+                                 list(stock.difference(s, big)))
+
+    def testInts(self):
+        bigkeys = range(100, 2000, 3)
+        self.check(range(0, 3000, 70), bigkeys)
+        self.check([-1, 5, 99], bigkeys)
+        self.check([2001, 2002], bigkeys)
+        # Only the L families take keys beyond 32 bits
+        bigkeys = [2 ** 40 + k for k in bigkeys]
+        self.check([2 ** 40 + k for k in range(0, 3000, 70)], bigkeys)
+
+    def testObjects(self):
+        for key in (str, unicode, lambda i: (i % 3, str(i))):
+            bigkeys = sorted(set(key(i) for i in xrange(100, 2000, 3)))
+            small = sorted(set(key(i) for i in xrange(0, 3000, 70)))
+            small.append(key(10 ** 6))
+            self.check(sorted(small), bigkeys)
+        # Mixed types compare by type name
+        self.check([1, 'a', u'b', (1, )], ['a', u'a', 2, ()])
+
+    def testMerge(self):
+        # Runs of close keys are merged with the keys of the tree, the
+        # scattered ones in between are probed
+        key = lambda i: '%06d' % i
+        bigkeys = [key(i) for i in xrange(0, 20000, 2)]
+        small = (range(500, 600) + range(600, 10000, 97) +
+                 range(10000, 10040) + range(10040, 19000, 333) +
+                 range(19000, 19100, 5) + [20001, 20002])
+        self.check([key(i) for i in sorted(set(small))], bigkeys)
+
+
+class TestParallel(unittest.TestCase):
+
+    def setUp(self):
+        import random
+        rand = random.Random(7)
+        self.keys1 = sorted(rand.sample(xrange(1000000), 100000))
+        self.keys2 = sorted(rand.sample(xrange(1000000), 300000))
+        from BTrees import IIBTree
+        self.stock = IIBTree
+
+    def testBoundaries(self):
+        big = IITreeSet(self.keys2)
+        bounds = parallel.boundaries(big, 8)
+        self.failUnless(1 < len(bounds) < 8)
+        self.assertEqual(bounds, sorted(bounds))
+        self.assertEqual(parallel.boundaries(IISet(self.keys2), 8), [])
+        self.assertEqual(parallel.boundaries(IITreeSet([1, 2]), 8), [])
+
+    def testSplit(self):
+        bounds = [5, 10, 10000]
+        o = IITreeSet(range(20))
+        parts = [list(keys) for keys in parallel.split(o, bounds)]
+        self.assertEqual(parts, [range(5), range(5, 10), range(10, 20), []])
+        parts = list(parallel.split(IITreeSet(), bounds))
+        self.assertEqual(len(parts), 4)
+
+    def testIntersection(self):
+        for o1 in (IISet(self.keys1), IITreeSet(self.keys1),
+                   IIBTree([(k, 1) for k in self.keys1])):
+            for o2 in (IISet(self.keys2), IITreeSet(self.keys2)):
+                expected = list(self.stock._old_intersection(o1, o2))
+                for big in (o1, o2):
+                    result = parallel.parallel_intersection(o1, o2, IISet,
+                                                            big)
+                    self.assertEqual(type(result), IISet)
+                    self.assertEqual(list(result), expected)
+
+    def testOverlap(self):
+        # Every range is handed to the pool as soon as it's copied
+        events = []
+        split = parallel.split
+
+        def recorded(o, bounds):
+            for keys in split(o, bounds):
+                events.append('split')
+                yield keys
+        pool = parallel.pool()
+        apply_async = pool.apply_async
+
+        def recorded_async(func, args):
+            events.append('merge')
+            return apply_async(func, args)
+        parallel.split = recorded
+        pool.apply_async = recorded_async
+        try:
+            o1 = IITreeSet(self.keys1)
+            o2 = IITreeSet(self.keys2)
+            result = parallel.parallel_intersection(o1, o2, IISet)
+        finally:
+            parallel.split = split
+            del pool.apply_async
+        self.assertEqual(list(result),
+                         list(self.stock._old_intersection(o1, o2)))
+        self.assertEqual(events[:3], ['split', 'split', 'merge'])
+
+    def testCostModel(self):
+        o1 = IITreeSet(self.keys1)
+        o2 = IITreeSet(self.keys2)
+        strategies = ('merge', 'probe', 'parallel')
+        size = costmodel.PARALLELSIZE
+        try:
+            costmodel.PARALLELSIZE = 50000
+            self.assertEqual(costmodel.intersection(
+                o1, o2, IISet, strategies)[0], 'parallel')
+            costmodel.PARALLELSIZE = 200000
+            self.assertEqual(costmodel.intersection(
+                o1, o2, IISet, strategies)[0], 'merge')
+        finally:
+            costmodel.PARALLELSIZE = size
+
+
+class TestBitmap(unittest.TestCase):
+
+    def setUp(self):
+        import random
+        rand = random.Random(11)
+        self.sparse = sorted(rand.sample(xrange(-100000, 10000000), 3000))
+        self.dense = sorted(rand.sample(xrange(3 * 65536), 150000))
+        self.runs = range(1000, 70000) + range(100000, 100100)
+        from BTrees import _IIBTree
+        self.stock = _IIBTree
+        self.intersection = setpatches.make_intersection(_IIBTree, IISet)
+        self.difference = setpatches.make_difference(_IIBTree, IISet)
+
+    def testContainers(self):
+        b = bitmap.Bitmap(self.runs)
+        self.assertEqual([c[0] for c in b.containers],
+                         [bitmap.RUN, bitmap.RUN])
+        b = bitmap.Bitmap(self.dense)
+        self.assertEqual([c[0] for c in b.containers], [bitmap.BITMAP] * 3)
+        b = bitmap.Bitmap(self.sparse)
+        self.assertEqual(set(c[0] for c in b.containers), set([bitmap.ARRAY]))
+
+    def testConversion(self):
+        import cPickle
+        for keys in self.sparse, self.dense, self.runs, []:
+            for o in IISet(keys), IITreeSet(keys):
+                b = bitmap.Bitmap.fromset(o)
+                self.assertEqual(list(b), keys)
+                self.assertEqual(len(b), len(keys))
+                self.assertEqual(list(b.toset(IITreeSet)), keys)
+                b = cPickle.loads(cPickle.dumps(b, 2))
+                self.assertEqual(list(b), keys)
+            if keys:
+                b = bitmap.Bitmap(keys)
+                self.assertEqual((b.minKey(), b.maxKey()), (keys[0], keys[-1]))
+                self.failUnless(keys[0] in b)
+                self.failIf(keys[0] - 1 in b)
+
+    def testOperations(self):
+        for k1 in self.sparse, self.dense, self.runs:
+            for k2 in self.sparse, self.dense, self.runs:
+                s1, s2 = IISet(k1), IISet(k2)
+                b1, b2 = bitmap.Bitmap(k1), bitmap.Bitmap(k2)
+                expected = list(self.stock.intersection(s1, s2))
+                for o1, o2 in ((b1, b2), (b1, s2), (s1, b2)):
+                    result = self.intersection(o1, o2)
+                    self.failUnless(isinstance(result, bitmap.Bitmap))
+                    self.assertEqual(list(result), expected)
+                expected = list(self.stock.difference(s1, s2))
+                for o1, o2 in ((b1, b2), (b1, s2)):
+                    result = self.difference(o1, o2)
+                    self.failUnless(isinstance(result, bitmap.Bitmap))
+                    self.assertEqual(list(result), expected)
+                self.assertEqual(list(self.difference(s1, b2)), expected)
+                t1 = IIBTree([(k, 3) for k in k1])
+                self.assertEqual(list(self.difference(t1, b2).items()),
+                                 list(self.stock.difference(t1, s2).items()))
+
+    def testNone(self):
+        b = bitmap.Bitmap(self.runs)
+        self.failUnless(self.intersection(b, None) is b)
+        self.failUnless(self.intersection(None, b) is b)
+        self.failUnless(self.difference(b, None) is b)
+        self.failUnless(self.difference(None, b) is None)
+
+    def testProbeSmaller(self):
+        class TreeSet(IITreeSet):
+            def keys(self, *args):
+                raise AssertionError('Iterated over the bigger operand')
+        small = bitmap.Bitmap(self.sparse[::300])
+        big = TreeSet(self.sparse[::2])
+        self.failIf(bitmap.isdense(big))
+        expected = [k for k in small if big.has_key(k)]
+        self.failUnless(expected)
+        self.assertEqual(list(self.intersection(small, big)), expected)
+        self.assertEqual(list(self.intersection(big, small)), expected)
+        self.assertEqual(list(self.difference(small, big)),
+                         [k for k in small if not big.has_key(k)])
+
+    def testDensity(self):
+        self.failUnless(bitmap.isdense(IISet(self.dense)))
+        self.failUnless(bitmap.isdense(IITreeSet(self.runs)))
+        self.failIf(bitmap.isdense(IISet(self.sparse)))
+
+
+class TestUnion(unittest.TestCase):
+
+    def setUp(self):
+        import random
+        rand = random.Random(17)
+        self.sparse = sorted(rand.sample(xrange(-100000, 10000000), 3000))
+        self.dense = sorted(rand.sample(xrange(3 * 65536), 150000))
+        self.runs = range(1000, 70000) + range(100000, 100100)
+        from BTrees import _IIBTree
+        self.stock = _IIBTree
+        self.union = setpatches.make_union(_IIBTree, IISet)
+        self.multiunion = setpatches.make_multiunion(_IIBTree, IISet)
+
+    def testPlain(self):
+        s1, s2 = IISet(self.sparse), IITreeSet(self.dense)
+        expected = list(self.stock.union(s1, s2))
+        self.assertEqual(list(self.union(s1, s2)), expected)
+        self.assertEqual(list(self.union(s2, s1)), expected)
+        self.failUnless(self.union(s1, None) is s1)
+        self.failUnless(self.union(None, None) is None)
+        sets = [IISet(self.sparse), IITreeSet(self.dense), 7,
+                IIBTree([(k, 1) for k in self.runs])]
+        self.assertEqual(list(self.multiunion(iter(sets))),
+                         list(self.stock.multiunion(sets)))
+
+    def testBitmap(self):
+        for k1 in self.sparse, self.dense, self.runs:
+            for k2 in self.sparse, self.dense, self.runs:
+                s1, s2 = IISet(k1), IITreeSet(k2)
+                b1, b2 = bitmap.Bitmap(k1), bitmap.Bitmap(k2)
+                expected = list(self.stock.union(s1, s2))
+                for o1, o2 in ((b1, b2), (b1, s2), (s1, b2)):
+                    result = self.union(o1, o2)
+                    self.failUnless(isinstance(result, bitmap.Bitmap))
+                    self.assertEqual(list(result), expected)
+        sets = [bitmap.Bitmap(self.sparse), IITreeSet(self.dense), 5,
+                bitmap.Bitmap(self.runs), IISet(self.sparse[::2])]
+        result = self.multiunion(sets)
+        self.failUnless(isinstance(result, bitmap.Bitmap))
+        self.assertEqual(list(result), list(self.stock.multiunion(
+            [IISet(self.sparse), IISet(self.dense), 5, IISet(self.runs)])))
+
+    def testMapped(self):
+        import os
+        import tempfile
+        path = tempfile.mktemp()
+        mapped.dump(IITreeSet(self.dense), path)
+        m = mapped.load(path)
+        try:
+            s = IISet(self.sparse)
+            expected = list(self.stock.union(s, IISet(self.dense)))
+            self.assertEqual(list(self.union(m, s)), expected)
+            self.assertEqual(list(self.union(s, m)), expected)
+            self.assertEqual(list(self.multiunion([s, m, 3])),
+                             list(self.stock.multiunion(
+                                 [s, IISet(self.dense), 3])))
+        finally:
+            m.close()
+            os.remove(path)
+
+    def testVectorized(self):
+        if not vectorized.HAS_NUMPY:
+            return
+        union = setpatches.make_union(self.stock, IISet, vectorized=True)
+        coefficients = costmodel.COEFFICIENTS.copy()
+        costmodel.COEFFICIENTS['vector_set'] = 0.0
+        costmodel.COEFFICIENTS['vector_tree'] = 0.0
+        try:
+            path = []
+            s1, s2 = IISet(self.sparse), IITreeSet(self.dense)
+            self.assertEqual(list(union(s1, s2, path=path)),
+                             list(self.stock.union(s1, s2)))
+            self.assertEqual(path, ['vector'])
+        finally:
+            costmodel.COEFFICIENTS.clear()
+            costmodel.COEFFICIENTS.update(coefficients)
+
+    def testLL(self):
+        from BTrees import _LLBTree
+        union = setpatches.make_union(_LLBTree, LLSet)
+        multiunion = setpatches.make_multiunion(_LLBTree, LLSet)
+        keys = [k + 2 ** 40 for k in self.sparse]
+        s1, s2 = LLSet(keys), LLTreeSet(keys[::3] + [1])
+        self.assertEqual(list(union(s1, s2)), list(_LLBTree.union(s1, s2)))
+        self.assertEqual(list(multiunion([s1, s2, 2 ** 50])),
+                         list(_LLBTree.multiunion([s1, s2, 2 ** 50])))
+
+
+class TestWindow(unittest.TestCase):
+
+    def setUp(self):
+        from BTrees import _IIBTree
+        self.stock = _IIBTree
+        self.intersection = setpatches.make_intersection(_IIBTree, IISet)
+        self.difference = setpatches.make_difference(_IIBTree, IISet)
+
+    def testBounds(self):
+        import random
+        rand = random.Random(19)
+        stock = self.stock
+        for i in xrange(100):
+            k1 = sorted(rand.sample(xrange(1000), rand.randint(0, 50)))
+            k2 = sorted(rand.sample(xrange(1000), rand.randint(0, 300)))
+            lo = rand.choice([None, rand.randint(0, 1000)])
+            hi = rand.choice([None, rand.randint(0, 1000)])
+            inside = [k for k in k1 if (lo is None or k >= lo) and
+                      (hi is None or k <= hi)]
+            for o1 in (IISet(k1), IITreeSet(k1),
+                       IIBTree([(k, 2 * k) for k in k1])):
+                for o2 in (IISet(k2), IITreeSet(k2),
+                           IIBucket([(k, 1) for k in k2])):
+                    result = window.intersection(
+                        o1, o2, IISet, IIBucket, stock.intersection, lo, hi)
+                    self.assertEqual(list(result),
+                                     [k for k in inside if k in k2])
+                    result = window.difference(
+                        o1, o2, IISet, IIBucket, stock.difference, lo, hi)
+                    self.assertEqual(list(result.keys()),
+                                     [k for k in inside if k not in k2])
+                    if ismapping(o1):
+                        self.assertEqual(list(result.values()),
+                                         [2 * k for k in result.keys()])
+
+    def testStrategy(self):
+        big = IITreeSet(xrange(0, 2000000, 2))
+        small = IITreeSet(xrange(900000, 920000))
+        path = []
+        result = self.intersection(small, big, path=path)
+        self.assertEqual(path, ['window'])
+        self.assertEqual(list(result), range(900000, 920000, 2))
+        path = []
+        result = self.difference(small, big, path=path)
+        self.assertEqual(path, ['window'])
+        self.assertEqual(list(result), range(900001, 920000, 2))
+        # Not worth it if they overlap everywhere
+        path = []
+        self.intersection(IITreeSet(xrange(0, 2000000, 3)), big, path=path)
+        self.assertNotEqual(path, ['window'])
+
+    def testKeywords(self):
+        big = IITreeSet(xrange(0, 200000, 2))
+        small = IITreeSet(xrange(100000))
+        path = []
+        result = self.intersection(small, big, path=path, min=500, max=600)
+        self.assertEqual(path, ['window'])
+        self.assertEqual(list(result), range(500, 601, 2))
+        path = []
+        result = self.difference(small, big, path=path, max=10)
+        self.assertEqual(path, ['window'])
+        self.assertEqual(list(result), range(1, 11, 2))
+
+    def testClustered(self):
+        # Against a big tree, o1 at its start leaves nothing to skip. The
+        # stock merge stops at the end of o1 anyway.
+        big = IITreeSet(xrange(1000000))
+        o1 = IISet(xrange(200000))
+        path = []
+        self.difference(o1, big, path=path)
+        self.assertEqual(path, ['merge'])
+
+    def testDisjoint(self):
+        big = IITreeSet(xrange(100000))
+        other = IITreeSet(xrange(200000, 300000))
+        path = []
+        result = self.intersection(other, big, path=path)
+        self.assertEqual(path, ['window'])
+        self.assertEqual(len(result), 0)
+        self.assertEqual(list(self.difference(other, big)),
+                         range(200000, 300000))
+
+    def testDisjointDifference(self):
+        # A new set or bucket, like the stock difference, never o1 itself
+        big = IITreeSet(xrange(5000))
+        for o1, expected in (
+                (IITreeSet(xrange(10000, 25000)), IISet),
+                (IIBTree([(k, k) for k in xrange(10000, 25000)]), IIBucket)):
+            path = []
+            result = self.difference(o1, big, path=path)
+            self.assertEqual(path, ['window'])
+            self.failIf(result is o1)
+            self.assertEqual(type(result), expected)
+            self.assertEqual(type(result),
+                             type(self.stock.difference(o1, big)))
+            self.assertEqual(list(result.keys()), list(o1.keys()))
+
+
+class TestMapped(unittest.TestCase):
+
+    def setUp(self):
+        import random
+        import tempfile
+        rand = random.Random(13)
+        self.keys = sorted(rand.sample(xrange(-100000, 10000000), 20000))
+        self.other = sorted(rand.sample(xrange(-100000, 10000000), 30000))
+        self.other.extend(self.keys[::3])
+        self.other = sorted(set(self.other))
+        self.dir = tempfile.mkdtemp()
+        from BTrees import _IIBTree
+        self.stock = _IIBTree
+        self.intersection = setpatches.make_intersection(_IIBTree, IISet)
+        self.difference = setpatches.make_difference(_IIBTree, IISet)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir)
+
+    def mapped(self, o, name='keys'):
+        import os
+        path = os.path.join(self.dir, name)
+        mapped.dump(o, path)
+        return mapped.load(path)
+
+    def testRoundTrip(self):
+        keys = self.keys
+        items = [(k, 1) for k in keys]
+        for o in (IISet(keys), IITreeSet(keys), IIBucket(items),
+                  IIBTree(items), IITreeSet()):
+            m = self.mapped(o)
+            self.assertEqual(list(m), list(o.keys()))
+            self.assertEqual(len(m), len(o))
+            for settype in (IISet, IITreeSet):
+                new = m.toset(settype)
+                self.assertEqual(type(new), settype)
+                self.assertEqual(list(new), list(o.keys()))
+            m.close()
+        m = self.mapped(LLTreeSet([2 ** 40, 2 ** 41]))
+        self.assertEqual(m.family, 'LL')
+        self.assertEqual(list(m.toset(LLTreeSet)), [2 ** 40, 2 ** 41])
+        self.assertRaises(ValueError, mapped.dump, OOSet(['a']),
+                          self.dir + '/x')
+
+    def testSequence(self):
+        m = self.mapped(IITreeSet(self.keys))
+        keys = self.keys
+        self.assertEqual((m.minKey(), m.maxKey()), (keys[0], keys[-1]))
+        self.assertEqual((m[0], m[-1], m[100]), (keys[0], keys[-1], keys[100]))
+        self.assertEqual(m[10:20], tuple(keys[10:20]))
+        self.failUnless(keys[5] in m)
+        self.failIf(keys[5] + 1 in m or keys[0] - 1 in m)
+        self.assertRaises(IndexError, m.__getitem__, len(keys))
+        if vectorized.HAS_NUMPY:
+            self.assertEqual(m.asarray().tolist(), keys)
+
+    def testInvalid(self):
+        path = self.dir + '/invalid'
+        f = open(path, 'wb')
+        f.write('x' * 64)
+        f.close()
+        self.assertRaises(ValueError, mapped.load, path)
+
+    def testOperations(self):
+        m1 = self.mapped(IITreeSet(self.keys), 'keys')
+        m2 = self.mapped(IITreeSet(self.other), 'other')
+        s1, s2 = IISet(self.keys), IITreeSet(self.other)
+        small = IISet(self.other[:50] + self.keys[:50:2])
+        expected = list(self.stock.intersection(s1, s2))
+        for o1, o2 in ((m1, m2), (m1, s2), (s1, m2)):
+            self.assertEqual(list(self.intersection(o1, o2)), expected)
+        self.assertEqual(list(self.intersection(small, m1)),
+                         list(self.stock.intersection(small, s1)))
+        expected = list(self.stock.difference(s1, s2))
+        for o1, o2 in ((m1, m2), (m1, s2), (s1, m2)):
+            self.assertEqual(list(self.difference(o1, o2)), expected)
+        t1 = IIBTree([(k, 3) for k in self.keys])
+        self.assertEqual(list(self.difference(t1, m2).items()),
+                         list(self.stock.difference(t1, s2).items()))
+        self.failUnless(self.intersection(m1, None) is m1)
+        self.failUnless(self.difference(None, m1) is None)
+
+    def testWithoutNumPy(self):
+        has = vectorized.HAS_NUMPY
+        vectorized.HAS_NUMPY = False
+        try:
+            self.testOperations()
+        finally:
+            vectorized.HAS_NUMPY = has
+
+
 def test_suite():
     from unittest import TestSuite, makeSuite
     suite = TestSuite()
@@ -101,6 +1327,29 @@ def test_suite():
     suite.addTest(makeSuite(TestPureIO))
     suite.addTest(makeSuite(TestPureOO))
     suite.addTest(makeSuite(TestPureOI))
+    suite.addTest(makeSuite(TestPureLL))
+    suite.addTest(makeSuite(TestPureLO))
+    suite.addTest(makeSuite(TestPureLF))
     suite.addTest(makeSuite(TestWeightedII))
     suite.addTest(makeSuite(TestWeightedOI))
+    suite.addTest(makeSuite(TestWeightedLL))
+    suite.addTest(makeSuite(TestWeightedLF))
+    suite.addTest(makeSuite(TestGalloping))
+    suite.addTest(makeSuite(TestWeightedStrategies))
+    suite.addTest(makeSuite(TestDifferenceStrategies))
+    suite.addTest(makeSuite(TestSmallSet))
+    suite.addTest(makeSuite(TestMultiIntersection))
+    suite.addTest(makeSuite(TestLazy))
+    suite.addTest(makeSuite(TestEstimateSize))
+    suite.addTest(makeSuite(TestBuild))
+    suite.addTest(makeSuite(TestCostModel))
+    suite.addTest(makeSuite(TestBitmap))
+    suite.addTest(makeSuite(TestMapped))
+    suite.addTest(makeSuite(TestUnion))
+    suite.addTest(makeSuite(TestWindow))
+    if setpatches.HAS_COPTIMIZATIONS:
+        suite.addTest(makeSuite(TestCompiled))
+        suite.addTest(makeSuite(TestParallel))
+    if vectorized.HAS_NUMPY:
+        suite.addTest(makeSuite(TestVectorized))
     return suite
@@ -0,0 +1,121 @@
+"""Set operations on NumPy arrays of integer keys.
+
+The keys are copied into an array in one go, the operation is done on the
+sorted arrays and the result is built in one go as well. The 32-bit keys
+and values are copied out of the key tuples of the buckets by the compiled
+`ciiextend`, others are iterated over. Copying the keys costs more than
+the stock C merge, so this pays off where the stock operations are slow,
+like with the Python implementation of BTrees. The cost model decides.
+"""
+from array import array
+
+from experimental.btree.buckets import buildbucket
+from experimental.btree.buckets import buildset
+from experimental.btree.buckets import iterbuckets
+
+HAS_NUMPY = True
+try:
+    import numpy
+except ImportError:
+    HAS_NUMPY = False
+
+try:
+    from experimental.btree.intersection import ciiextend
+except ImportError:
+    ciiextend = None
+
+# NumPy types of the keys and values, by the letter in the family name
+DTYPES = {'I': 'int32', 'L': 'int64', 'F': 'float32', 'O': object}
+
+
+def supports(settype):
+    # Only integer keys are copied into an array
+    return HAS_NUMPY and settype.__name__[0] in 'IL'
+
+
+def dtype(o, position=0):
+    # position 0 is the key type, 1 the value type
+    return DTYPES[type(o).__name__[position]]
+
+
+def fromtuples(tuples):
+    # One int32 array of the ints in a sequence of tuples
+    result = array('i')
+    for items in tuples:
+        ciiextend(result, items, 0, len(items))
+    return numpy.frombuffer(result, 'int32')
+
+
+def keyarray(o):
+    t = dtype(o)
+    if t == 'int32' and ciiextend is not None:
+        return fromtuples(keys for keys, values in iterbuckets(o))
+    return numpy.fromiter(iter(o), t)
+
+
+def valuearray(o):
+    if not hasattr(o, 'values'):
+        # A set
+        return None
+    t = dtype(o, 1)
+    if t is object:
+        return numpy.array(list(o.values()), dtype=object)
+    if t == 'int32' and ciiextend is not None:
+        return fromtuples(values for keys, values in iterbuckets(o))
+    return numpy.fromiter(o.itervalues(), t)
+
+
+def positions(small, big):
+    # The positions of the keys of small in big, and which of them match
+    pos = numpy.searchsorted(big, small)
+    found = numpy.zeros(len(small), dtype=bool)
+    inside = pos < len(big)
+    found[inside] = big[pos[inside]] == small[inside]
+    return pos, found
+
+
+def intersection(o1, o2, settype):
+    k1 = keyarray(o1)
+    k2 = keyarray(o2)
+    if len(k1) > len(k2):
+        k1, k2 = k2, k1
+    pos, found = positions(k1, k2)
+    return buildset(settype, k1[found].tolist())
+
+
+def difference(o1, o2, settype, buckettype):
+    k1 = keyarray(o1)
+    pos, found = positions(k1, keyarray(o2))
+    missing = ~found
+    values = valuearray(o1)
+    if values is not None:
+        # Like the stock difference we keep the values of a mapping
+        return buildbucket(buckettype, k1[missing].tolist(),
+                           values[missing].tolist())
+    return buildset(settype, k1[missing].tolist())
+
+
+def union(o1, o2, settype):
+    return buildset(settype,
+                    numpy.union1d(keyarray(o1), keyarray(o2)).tolist())
+
+
+def weightedIntersection(o1, o2, settype, buckettype, w1=1, w2=1):
+    k1 = keyarray(o1)
+    k2 = keyarray(o2)
+    v1 = valuearray(o1)
+    v2 = valuearray(o2)
+    pos, found = positions(k1, k2)
+    keys = k1[found]
+    if v1 is None and v2 is None:
+        return w1 + w2, buildset(settype, keys.tolist())
+    # The members of a set count as a value of 1
+    if v1 is None:
+        values = w1
+    else:
+        values = v1[found] * w1
+    if v2 is None:
+        values = values + w2
+    else:
+        values = values + v2[pos[found]] * w2
+    return 1, buildbucket(buckettype, keys.tolist(), values.tolist())
@@ -0,0 +1,100 @@
+"""Set operations restricted to a window of keys.
+
+A range query of a `DateIndex` or `DateRangeIndex` often yields ids from a
+narrow window, while the other operand spans all ids. The stock merge
+walks the other operand from its first key on, however. These operations
+cut both operands down to the keys inside the window first, with the range
+searches of the trees, which descend straight to the first bucket of the
+window and stop after the last one. Only the cut down operands are merged.
+
+The window is where the keys of both operands overlap, and can be narrowed
+further by min and max. The patched `intersection` and `difference` use
+these if the cost model expects the window to save work. They pass their
+own `min` and `max` keyword arguments on, a range query can bound the
+operation to the ids it knows the result is in::
+
+  from BTrees import IIBTree
+  IIBTree.intersection(o1, o2, min=lo, max=hi)
+"""
+from experimental.btree.buckets import buildbucket
+from experimental.btree.buckets import buildset
+from experimental.btree.buckets import ismapping
+
+
+def bounds(o1, o2, min=None, max=None):
+    """Return the smallest and largest key both o1 and o2 can share, within
+    min and max. Returns None if they can't share any.
+    """
+    lo = o1.minKey()
+    other = o2.minKey()
+    if other > lo:
+        lo = other
+    if min is not None and min > lo:
+        lo = min
+    hi = o1.maxKey()
+    other = o2.maxKey()
+    if other < hi:
+        hi = other
+    if max is not None and max < hi:
+        hi = max
+    if lo > hi:
+        return None
+    return lo, hi
+
+
+def restrict(o, lo, hi, settype, buckettype):
+    """Return the keys of o from lo to hi, as a set of settype, or as a
+    bucket of buckettype with the values of a mapping o.
+    """
+    if lo <= o.minKey() and o.maxKey() <= hi:
+        return o
+    if ismapping(o):
+        items = ()
+        if lo <= hi:
+            items = o.items(lo, hi)
+        return buildbucket(buckettype, [k for k, v in items],
+                           [v for k, v in items])
+    if lo > hi:
+        return settype()
+    return buildset(settype, o.keys(lo, hi))
+
+
+def intersection(o1, o2, settype, buckettype, setintersection,
+                 min=None, max=None):
+    """Intersect the parts of o1 and o2 from min to max with
+    setintersection. The bounds default to where o1 and o2 overlap.
+    """
+    if not o1 or not o2:
+        return setintersection(o1, o2)
+    window = bounds(o1, o2, min, max)
+    if window is None:
+        return settype()
+    lo, hi = window
+    return setintersection(restrict(o1, lo, hi, settype, buckettype),
+                           restrict(o2, lo, hi, settype, buckettype))
+
+
+def difference(o1, o2, settype, buckettype, setdifference,
+               min=None, max=None):
+    """Subtract o2 from the part of o1 from min to max with setdifference.
+
+    Without bounds all of o1 is kept and only the part of o2 which overlaps
+    it is looked at.
+    """
+    if o1 and (min is not None or max is not None):
+        lo = o1.minKey()
+        hi = o1.maxKey()
+        if min is not None and min > lo:
+            lo = min
+        if max is not None and max < hi:
+            hi = max
+        o1 = restrict(o1, lo, hi, settype, buckettype)
+    if not o1 or not o2:
+        return setdifference(o1, o2)
+    window = bounds(o1, o2)
+    if window is None:
+        # Nothing to remove, but like the stock difference return a new set
+        # or bucket, never o1 itself
+        return setdifference(o1, settype())
+    return setdifference(o1, restrict(o2, window[0], window[1], settype,
+                                      buckettype))
@@ -46,6 +46,9 @@ setup(name='experimental.btree',
           'Products.ZCatalog',
           'ZODB3',
       ],
+      extras_require={
+          'numpy': ['numpy'],
+      },
       entry_points="""
       [z3c.autoinclude.plugin]
       target = plone